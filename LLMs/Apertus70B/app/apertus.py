@@ -7,6 +7,8 @@ from langchain_core.language_models import LLM
 from llama_cpp import Llama
 
 from utils import timeit
+from utils import InstancePool
+from utils.llamacpp import BatchedDecoder, PrefixStateCache, common_prefix, prime_prefix, shared_llama
 from utils import setup_logging
 
 LOGGER = setup_logging(app_name='apertus70-inference', to_stdout=True, retention=30)
@@ -14,15 +16,41 @@ LOGGER = setup_logging(app_name='apertus70-inference', to_stdout=True, retention
 class LLM_inference(LLM):
     device: ClassVar[str] = "cuda"
     def __init__(self, model_path: Path, temperature: float, top_p: float, max_tokens: int,
-                 n_ctx: int = 8192, n_gpu_layers: int = -1):
+                 n_ctx: int = 8192, n_gpu_layers: int = -1,
+                 n_threads: Optional[int] = None, n_contexts: int = 1, n_seq: int = 1,
+                 llama_params: Optional[dict] = None):
         super().__init__()
-        object.__setattr__(self, '_llm', Llama(model_path=str(model_path), n_ctx=int(n_ctx),
-                                               n_gpu_layers=int(n_gpu_layers), verbose=True))
+        # n_threads None keeps the llama.cpp default, CPU replicas pass the size of their core set.
+        # n_contexts independent contexts decode in parallel over one loaded model: the weights (GPU
+        # layers included) exist once, every context only adds its own KV cache.
+        # n_seq > 1 instead batches that many requests in one context sharing n_ctx, the Llama
+        # object then only tokenizes and gets a minimal context of its own.
+        batched = int(n_seq) > 1
+        # llama_params are the tuned settings (utils.llamacpp.tune), core sets of replicas override their threads.
+        params = dict(llama_params or {})
+        if n_threads is not None:
+            params.update(n_threads=n_threads, n_threads_batch=n_threads)
+        llm = Llama(model_path=str(model_path), n_ctx=min(int(n_ctx), 512) if batched else int(n_ctx),
+                    n_gpu_layers=int(n_gpu_layers), verbose=True, **params)
+        object.__setattr__(self, '_pool', InstancePool(
+            lambda i: llm if i == 0 else shared_llama(llm),
+            size=1 if batched else n_contexts, name=self._llm_type
+        ))
+        object.__setattr__(self, '_llm', self._pool.instances[0])
+        # saved KV states of recent system prompts, PROMPT_STATE_CACHE_MB / PROMPT_STATE_DISK_MB
+        object.__setattr__(self, '_state_cache', PrefixStateCache.from_env(model_path))
+        object.__setattr__(self, '_decoder', BatchedDecoder(self._llm, n_seq=n_seq, n_ctx=n_ctx,
+                                                            n_batch=params.get("n_batch", 512),
+                                                            name=self._llm_type, cache=self._state_cache)
+                           if batched else None)
+        object.__setattr__(self, '_prefix_memo', {})
+        object.__setattr__(self, '_prefix_lock', threading.Lock())
         object.__setattr__(self, '_temperature', float(temperature))
         object.__setattr__(self, '_top_p', float(top_p))
         object.__setattr__(self, '_max_tokens', int(max_tokens))
         object.__setattr__(self, '_systemmessage', "Du bist ein präziser, detailorientierter medizinischer Schreibassistent.")
-        object.__setattr__(self, "_lock", threading.Lock())
+        # the [ASSISTANT] format has no end-of-turn token, stop once the model opens another block
+        object.__setattr__(self, "_stop_words", ["[/ASSISTANT]", "[USER]", "[SYSTEM]"])
 
     @property
     def _llm_type(self):
@@ -35,32 +63,75 @@ class LLM_inference(LLM):
         do_sample = temp > 0.0
         return temp, nucleus, max_new, do_sample
 
-    def _build_prompt(self, prompt: str, system_prompt: Optional[str]) -> str:
+    def _build_prompt(self, prompt: str, system_prompt: Optional[str]) -> tuple[str, str]:
+        """ the full prompt and its system part, which is what the prompt state cache keys on """
         sys_text = (system_prompt or self._systemmessage).strip()
         user_text = (prompt or "").strip()
 
+        system_part = f"[SYSTEM]\n{sys_text}\n[/SYSTEM]\n\n"
         return (
-            f"[SYSTEM]\n{sys_text}\n[/SYSTEM]\n\n"
+            f"{system_part}"
             f"[USER]\n{user_text}\n[/USER]\n\n"
             f"[ASSISTANT]\n"
-        )
+        ), system_part
+
+    def _prefix_tokens(self, system_part: str) -> list[int]:
+        """ tokens of the system part, memoized per text """
+        with self._prefix_lock:
+            tokens = self._prefix_memo.get(system_part)
+        if tokens is None:
+            # tokenized outside the lock, concurrent misses on the same text just do it twice
+            tokens = self._llm.tokenize(system_part.encode("utf-8"), special=True)
+            with self._prefix_lock:
+                if len(self._prefix_memo) >= 64:
+                    self._prefix_memo.pop(next(iter(self._prefix_memo)))
+                self._prefix_memo[system_part] = tokens
+        return tokens
+
+    def system_prefix_tokens(self, system_prompt: Optional[str]) -> Optional[list[int]]:
+        """ pre-tokenizes a system prompt (server side registry), None if this setup does not use the tokens """
+        if self._decoder is None and self._state_cache is None:
+            return None
+        return self._prefix_tokens(self._build_prompt("", system_prompt)[1])
 
     def _stream_chunks(self, prompt: str, system_prompt: Optional[str],
                        *, temperature: Optional[float], top_p: Optional[float],
-                       max_tokens: Optional[int]) -> Iterator[str]:
+                       max_tokens: Optional[int], stop: Optional[List[str]] = None) -> Iterator[str]:
         temp, nucleus, max_new, _ = self._effective_params(temperature, top_p, max_tokens)
-        full_prompt = self._build_prompt(prompt, system_prompt)
+        full_prompt, system_part = self._build_prompt(prompt, system_prompt)
+        stop_words = self._stop_words + [s for s in (stop or []) if s]
 
         LOGGER.info(f'Sampling: max_tokens={max_new}, temperature={temp}, top_p={nucleus}')
 
-        # Single GPU, big model: serialize generations to avoid thrashing
-        with self._lock:
-            for chunk in self._llm(full_prompt, max_tokens=max_new, temperature=temp,
-                    top_p=nucleus, stream=True,
-            ):
-                text = chunk["choices"][0]["text"] or ""
-                if text:
-                    yield text
+        if self._decoder is not None or self._state_cache is not None:
+            tokens = self._llm.tokenize(full_prompt.encode("utf-8"), special=True)
+            prefix_len = common_prefix(tokens, self._prefix_tokens(system_part))
+        if self._decoder is not None:
+            yield from self._decoder.generate(tokens, max_tokens=max_new, temperature=temp, top_p=nucleus,
+                                              stop=stop_words, prefix_len=prefix_len)
+            return
+
+        # one generation per context, requests queue while all contexts are busy
+        with self._pool.acquire() as llm:
+            if self._state_cache is not None:
+                prime_prefix(llm, self._state_cache, tokens[:min(prefix_len, len(tokens) - 1)])
+            completion = llm(full_prompt, max_tokens=max_new, temperature=temp,
+                    top_p=nucleus, stream=True, stop=stop_words,
+            )
+            try:
+                for chunk in completion:
+                    text = chunk["choices"][0]["text"] or ""
+                    if text:
+                        yield text
+            finally:
+                # closing the llama.cpp generator stops decoding right away (client disconnected)
+                completion.close()
+
+    def context_stats(self) -> dict:
+        if self._decoder is not None:
+            return self._decoder.stats()
+        return {**self._pool.stats(),
+                "prompt_state_cache": None if self._state_cache is None else self._state_cache.stats()}
 
     @timeit
     def _call(self, prompt: str, system_prompt: Optional[str] = None, stop: Optional[List[str]] = None,
@@ -68,16 +139,18 @@ class LLM_inference(LLM):
               max_tokens: Optional[int] = None) -> str:
         parts = []
         for chunk in self._stream_chunks(prompt, system_prompt, temperature=temperature,
-                                         top_p=top_p, max_tokens=max_tokens):
+                                         top_p=top_p, max_tokens=max_tokens, stop=stop):
             parts.append(chunk)
         return "".join(parts)
 
     def invoke(self, prompt: str, system_prompt: Optional[str] = None, *, temperature: Optional[float] = None,
-               top_p: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
-        return self._call(prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+               top_p: Optional[float] = None, max_tokens: Optional[int] = None,
+               stop: Optional[List[str]] = None) -> str:
+        return self._call(prompt, system_prompt, stop, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
 
     @timeit
     def stream(self, prompt: str, system_prompt: Optional[str] = None, *, temperature: Optional[float] = None,
-               top_p: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+               top_p: Optional[float] = None, max_tokens: Optional[int] = None,
+               stop: Optional[List[str]] = None) -> Iterator[str]:
         yield from self._stream_chunks(prompt, system_prompt, temperature=temperature,
-                                       top_p=top_p, max_tokens=max_tokens)
\ No newline at end of file
+                                       top_p=top_p, max_tokens=max_tokens, stop=stop)
\ No newline at end of file
@@ -1,26 +1,34 @@
-from typing import Optional, List, ClassVar, Iterator
+from typing import Optional, List, ClassVar, Iterator, Callable
 from pathlib import Path
 
 from langchain_core.language_models import LLM
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
+from transformers import AutoTokenizer, StoppingCriteriaList
 import torch
 import threading
 
 
 from utils import timeit
 from utils import setup_logging
+from utils.generation import CancelCriteria, IncrementalTextStreamer, StopSequenceCriteria, stop_at
+from utils.generation.loading import load_causal_lm
 
 LOGGER = setup_logging(app_name='apertus-inference', to_stdout=True, retention=30)
 
 class ApertusInferenceLLM(LLM):
     device: ClassVar[str] = 'cuda'
-    def __init__(self, model_path:Path, tokenizer_path:Path, temperature:float, top_p:float, max_tokens:int):
+    def __init__(self, model_path:Path, tokenizer_path:Path, temperature:float, top_p:float, max_tokens:int,
+                 prompt_lookup_num_tokens:int = 10, torch_dtype:Optional[torch.dtype] = None,
+                 on_progress:Optional[Callable[[str, float], None]] = None):
         super().__init__()
-        object.__setattr__(self, "_model", AutoModelForCausalLM.from_pretrained(model_path, local_files_only=True).to(self.device))
+        # shards are streamed straight to the GPU in the checkpoint dtype (no fp32 copy on the host)
+        model, load_report = load_causal_lm(model_path, dtype=torch_dtype, device=self.device, progress=on_progress)
+        object.__setattr__(self, "_model", model)
+        object.__setattr__(self, "_load_report", load_report)
         object.__setattr__(self, "_tokenizer", AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True))
         object.__setattr__(self, "_temperature", temperature)
         object.__setattr__(self, "_top_p", top_p)
         object.__setattr__(self, "_max_tokens", max_tokens)
+        object.__setattr__(self, "_prompt_lookup_tokens", int(prompt_lookup_num_tokens))
 
         object.__setattr__(self, "_systemmessage", {
             'role': 'system', 'content':'Du bist ein präziser, detailorientierter medizinischer Schreibassistent.'
@@ -49,7 +57,10 @@ class ApertusInferenceLLM(LLM):
         ).to(self._model.device)
 
 
-    def _gen_kwargs(self, inputs, max_new: int, temp: float, nucleus: float, do_sample: bool, *, streamer=None):
+    def _gen_kwargs(self, inputs, max_new: int, temp: float, nucleus: float, do_sample: bool, *, streamer=None,
+                    prompt_lookup: bool = False, stopping_criteria=None):
+        # prompt lookup drafting only for greedy decoding, where the output stays identical
+        lookup = prompt_lookup and not do_sample and self._prompt_lookup_tokens > 0
         return dict(
             **inputs,
             max_new_tokens=max_new,
@@ -58,20 +69,28 @@ class ApertusInferenceLLM(LLM):
             do_sample=do_sample,
             pad_token_id=self._tokenizer.eos_token_id,
             eos_token_id=self._tokenizer.eos_token_id,
-            **({"streamer": streamer} if streamer is not None else {})
+            **({"streamer": streamer} if streamer is not None else {}),
+            **({"prompt_lookup_num_tokens": self._prompt_lookup_tokens} if lookup else {}),
+            **({"stopping_criteria": StoppingCriteriaList(stopping_criteria)} if stopping_criteria else {})
         )
 
 
     def _stream_chunks(self, prompt: str, system_prompt: Optional[str],
-            *, temperature: Optional[float], top_p: Optional[float], max_tokens: Optional[int]) -> Iterator[str]:
+            *, temperature: Optional[float], top_p: Optional[float], max_tokens: Optional[int],
+            prompt_lookup: bool = False, stop: Optional[List[str]] = None) -> Iterator[str]:
         temp, nucleus, max_new, do_sample = self._effective_params(temperature, top_p, max_tokens)
-        LOGGER.info(f"Sampling: max_new_tokens={max_new}, temperature={temp}, top_p={nucleus}")
+        LOGGER.info(f"Sampling: max_new_tokens={max_new}, temperature={temp}, top_p={nucleus}, prompt_lookup={prompt_lookup}")
         inputs = self._build_inputs(prompt, system_prompt)
 
-        streamer = TextIteratorStreamer(
-            self._tokenizer, skip_prompt=True, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )
-        generate_kwargs = self._gen_kwargs(inputs, max_new, temp, nucleus, do_sample, streamer=streamer)
+        streamer = IncrementalTextStreamer(self._tokenizer, skip_prompt=True, skip_special_tokens=True)
+        # set when the consumer stops iterating (client disconnected), generate() ends at the next step
+        cancel = CancelCriteria()
+        criteria = [cancel]
+        if stop:
+            # ends decoding at the first stop string instead of running to max_new_tokens
+            criteria.append(StopSequenceCriteria(self._tokenizer, stop, inputs['input_ids'].shape[-1]))
+        generate_kwargs = self._gen_kwargs(inputs, max_new, temp, nucleus, do_sample, streamer=streamer,
+                                           prompt_lookup=prompt_lookup, stopping_criteria=criteria)
 
         def _worker():
             with torch.no_grad():
@@ -80,25 +99,26 @@ class ApertusInferenceLLM(LLM):
         t = threading.Thread(target=_worker, daemon=True)
         t.start()
         try:
-            for text in streamer:
+            for text in stop_at(streamer, stop):
                 if text:
                     yield text
         finally:
+            cancel.cancel()
             t.join(timeout=0.1)
 
 
     @timeit
     def _call(
         self, prompt:str, system_prompt:Optional[str]=None, stop:Optional[List[str]]=None,
-        *, temperature:Optional[float]=None, top_p:Optional[float]=None, max_tokens:Optional[int]=None
+        *, temperature:Optional[float]=None, top_p:Optional[float]=None, max_tokens:Optional[int]=None,
+        prompt_lookup:bool=False
     ) -> str:
 
-        # definiere stop Kriterium
-
         # nutze denselben Streamer unter der Haube, aber sammle die Chunks
         parts = []
         for chunk in self._stream_chunks(
-            prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens
+            prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens,
+            prompt_lookup=prompt_lookup, stop=stop
         ):
             parts.append(chunk)
         return "".join(parts)
@@ -106,13 +126,17 @@ class ApertusInferenceLLM(LLM):
 
     def invoke(self, prompt: str, system_prompt: Optional[str] = None,
                *, temperature: Optional[float] = None, top_p: Optional[float] = None,
-               max_tokens: Optional[int] = None) -> str:
-        return self._call(prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+               max_tokens: Optional[int] = None, prompt_lookup: bool = False,
+               stop: Optional[List[str]] = None) -> str:
+        return self._call(prompt, system_prompt, stop, temperature=temperature, top_p=top_p, max_tokens=max_tokens,
+                          prompt_lookup=prompt_lookup)
 
 
     @timeit
     def stream(self, prompt:str, system_prompt:Optional[str]=None,
-               *, temperature:Optional[float]=None, top_p:Optional[float]=None, max_tokens:Optional[int]=None) -> Iterator[str]:
+               *, temperature:Optional[float]=None, top_p:Optional[float]=None, max_tokens:Optional[int]=None,
+               prompt_lookup:bool=False, stop:Optional[List[str]]=None) -> Iterator[str]:
         yield from self._stream_chunks(
-            prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens
+            prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens,
+            prompt_lookup=prompt_lookup, stop=stop
         )
\ No newline at end of file
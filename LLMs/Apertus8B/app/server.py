@@ -1,23 +1,51 @@
-from typing import Optional, Generator
+from typing import Optional, List, Generator, AsyncGenerator
 from pathlib import Path
+import os
 import json
 
 from pydantic import BaseModel
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from app import ApertusInferenceLLM
+from utils import AsyncEngine, ModelLoader, ResponseCache, request_key, warm_up
+from utils.prompts import SystemPromptRegistry, system_prompts_router, with_system_prompt
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 model_dir = Path(BASE_DIR / "base_model")
 token_dir = model_dir
+load_timeout = float(os.getenv("MODEL_LOAD_TIMEOUT_S", "600"))
 
-llm = ApertusInferenceLLM(
-    model_path=model_dir,
-    tokenizer_path=token_dir,
-    temperature=0.8,
-    top_p=0.9,
-    max_tokens=200
+def load_model(progress) -> ApertusInferenceLLM:
+    progress(f"loading {model_dir.name}", 0.0)
+    return ApertusInferenceLLM(
+        model_path=model_dir,
+        tokenizer_path=token_dir,
+        temperature=0.8,
+        top_p=0.9,
+        max_tokens=200,
+        prompt_lookup_num_tokens=int(os.getenv("PROMPT_LOOKUP_NUM_TOKENS", "10")),
+        on_progress=progress
+    )
+
+def warm_model(llm: ApertusInferenceLLM, progress):
+    warm_up(lambda sample, max_tokens: llm.stream(
+        prompt=sample["prompt"],
+        system_prompt=sample["system_prompt"],
+        temperature=sample.get("temperature"),
+        max_tokens=max_tokens,
+        prompt_lookup=sample["prompt_lookup"]
+    ), progress)
+
+system_prompts = SystemPromptRegistry.from_env()
+
+# the port binds right away, requests wait for the model up to MODEL_LOAD_TIMEOUT_S
+loader = ModelLoader(load_model, warm_model, name="Apertus8B").start()
+
+response_cache = ResponseCache.from_env()
+engine = AsyncEngine(
+    workers=int(os.getenv("ENGINE_WORKERS", "1")),
+    max_pending=int(os.getenv("ENGINE_MAX_PENDING", "1024"))
 )
 
 app = FastAPI(
@@ -29,38 +57,77 @@ app = FastAPI(
 class PromptRequest(BaseModel):
     prompt: str
     system_prompt: Optional[str] = None
+    system_prompt_id: Optional[str] = None
     temperature: Optional[float] = None
     top_p: Optional[float] = None
     max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    prompt_lookup: Optional[bool] = False
 
 class ConfigOut(BaseModel):
     model: str = 'Apertus8B'
     defaults: dict
 
+async def ready_llm() -> ApertusInferenceLLM:
+    try:
+        return await loader.wait(load_timeout)
+    except (TimeoutError, RuntimeError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+def cache_key(request: PromptRequest) -> Optional[str]:
+    temperature = 0.8 if request.temperature is None else request.temperature
+    return request_key(str(model_dir), temperature, request.model_dump(exclude={"prompt_lookup"}))
+
+def generate_tokens(llm: ApertusInferenceLLM, request: PromptRequest, key: Optional[str]) -> Generator[str, None, None]:
+    parts = []
+    for tok in llm.stream(
+        prompt=request.prompt,
+        system_prompt=request.system_prompt,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        max_tokens=request.max_tokens,
+        stop=request.stop,
+        prompt_lookup=bool(request.prompt_lookup)
+    ):
+        if tok:
+            parts.append(tok)
+            yield tok
+    response_cache.put(key, "".join(parts))
+
 @app.post("/generate")
-def generate_text(request:PromptRequest):
-    response = llm.invoke(prompt=request.prompt,
-                          system_prompt=request.system_prompt,
-                          temperature=request.temperature,
-                          top_p=request.top_p,
-                          max_tokens=request.max_tokens)
+async def generate_text(request:PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    key = cache_key(request)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return {"response": cached, "cached": True}
+
+    llm = await ready_llm()
+    # identical deterministic requests in flight share one generation
+    parts = [tok async for tok in engine.stream(lambda: generate_tokens(llm, request, key), key=key)]
+    response = "".join(parts)
     return {"response": response}
 
 def sse_event(data: dict) -> str:
     return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 @app.post("/generate_stream")
-def generate_text_stream(request: PromptRequest):
-    def token_generator() -> Generator[bytes, None, None]:
+async def generate_text_stream(request: PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    key = cache_key(request)
+    cached = response_cache.get(key)
+    # waits (or fails with 503) before the stream starts while the model is still loading
+    llm = await ready_llm() if cached is None else None
+
+    async def token_generator() -> AsyncGenerator[bytes, None]:
+        if cached is not None:
+            yield sse_event({"token": cached}).encode("utf-8")
+            yield sse_event({"finished": True, "cached": True}).encode("utf-8")
+            return
+
         try:
-            for tok in llm.stream(prompt=request.prompt,
-                                  system_prompt=request.system_prompt,
-                                  temperature=request.temperature,
-                                  top_p=request.top_p,
-                                  max_tokens=request.max_tokens
-                                  ):
-                if tok:
-                    yield sse_event({"token": tok}).encode("utf-8")
+            async for tok in engine.stream(lambda: generate_tokens(llm, request, key), key=key):
+                yield sse_event({"token": tok}).encode("utf-8")
             yield sse_event({"finished": True}).encode("utf-8")
         except GeneratorExit:
             return
@@ -81,12 +148,24 @@ def generate_text_stream(request: PromptRequest):
 def get_config() -> ConfigOut:
     return ConfigOut(
         defaults={
-            'temperature':llm._temperature,
-            'top_p':llm._top_p,
-            'max_tokens':llm._max_tokens,
+            'temperature':0.8,
+            'top_p':0.9,
+            'max_tokens':200,
         }
     )
 
+app.include_router(system_prompts_router(system_prompts))
+
 @app.get('/health')
 def health():
-    return {'status': 'ok'}
+    # always 200 while the process is up, 'status' is loading/warming/ready/failed
+    status = {**loader.status(), 'response_cache': response_cache.stats(),
+              'engine': engine.stats()}
+    if loader.model is not None:
+        status['load'] = loader.model._load_report.summary()
+    return status
+
+@app.get('/ready')
+def ready():
+    # 503 until the model is loaded and warmed up
+    return JSONResponse(loader.status(), status_code=200 if loader.ready else 503)
@@ -1,20 +1,22 @@
 from langchain_core.language_models import LLM
 from langchain.prompts import PromptTemplate
 
-from typing import Optional
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from typing import Optional, List, Callable
+from transformers import AutoTokenizer, StoppingCriteriaList
 import torch
 
+from utils.generation import StopSequenceCriteria, stop_at
+from utils.generation.loading import load_causal_lm
+
 from pathlib import Path
 
 class MeditronInstanceLLM(LLM):
-    def __init__(self, model_path: Path, temperature: float=0.0, max_tokens: int = 1000):
+    def __init__(self, model_path: Path, temperature: float=0.0, max_tokens: int = 1000,
+                 on_progress: Optional[Callable[[str, float], None]] = None):
         super().__init__()
-        object.__setattr__(self, '_model', AutoModelForCausalLM.from_pretrained(model_path,
-                                                                                low_cpu_mem_usage=True,
-                                                                                torch_dtype=torch.float16,
-                                                                                device_map='cuda:0',
-                                                                                local_files_only=True))
+        model, load_report = load_causal_lm(model_path, dtype=torch.float16, device='cuda:0', progress=on_progress)
+        object.__setattr__(self, '_model', model)
+        object.__setattr__(self, '_load_report', load_report)
         object.__setattr__(self, '_tokenizer', AutoTokenizer.from_pretrained(model_path, local_files_only=True))
         object.__setattr__(self, '_temperature', temperature)
         object.__setattr__(self, '_max_tokens', max_tokens)
@@ -24,7 +26,8 @@ class MeditronInstanceLLM(LLM):
     def _llm_type(self) -> str:
         return 'meditron-7b'
 
-    def _call(self, prmt: str, s_msg: Optional[str] = None) -> str:
+    def _call(self, prmt: str, s_msg: Optional[str] = None, stop: Optional[List[str]] = None,
+              max_tokens: Optional[int] = None) -> str:
 
         if s_msg is None:
             s_msg = (
@@ -38,24 +41,30 @@ class MeditronInstanceLLM(LLM):
 
         device = next(self._model.parameters()).device
         input = self._tokenizer(full_prompt, return_tensors='pt').to(device)
+        input_len = input['input_ids'].shape[-1]
+
+        # ends decoding at the first stop string instead of running to max_new_tokens
+        stopping_criteria = StoppingCriteriaList([StopSequenceCriteria(self._tokenizer, stop, input_len)]) if stop else None
 
         output = self._model.generate(
             **input,
-            max_new_tokens=self._max_tokens,
+            max_new_tokens=self._max_tokens if max_tokens is None else int(max_tokens),
             temperature=self._temperature,
             do_sample=self._temperature > 0.0,
             top_p=0.95,
             pad_token_id=self._tokenizer.pad_token_id or self._tokenizer.eos_token_id,
-            eos_token_id=self._tokenizer.eos_token_id
+            eos_token_id=self._tokenizer.eos_token_id,
+            stopping_criteria=stopping_criteria
         )
 
-        response = output[0][input['input_ids'].shape[-1]:]
+        response = output[0][input_len:]
         decoded = self._tokenizer.decode(response, skip_special_tokens=True)
+        decoded = "".join(stop_at([decoded], stop))
 
         return decoded.strip()
 
-    def invoke(self, prmt:str) -> str:
-        return self._call(prmt)
+    def invoke(self, prmt:str, stop: Optional[List[str]] = None, max_tokens: Optional[int] = None) -> str:
+        return self._call(prmt, stop=stop, max_tokens=max_tokens)
 
 # change invoke to take optional system_prompt
 
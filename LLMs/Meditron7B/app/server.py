@@ -1,16 +1,30 @@
+from typing import Optional, List
 from pathlib import Path
-from fastapi import FastAPI
+import os
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
 from app import MeditronInstanceLLM
+from utils import ModelLoader, warm_up
 
 
 model_path = Path(__file__).resolve().parents[1] / 'model'
 #model_path = Path("/model")
+load_timeout = float(os.getenv("MODEL_LOAD_TIMEOUT_S", "600"))
 
-llm = MeditronInstanceLLM(
-    model_path=model_path
-)
+def load_model(progress) -> MeditronInstanceLLM:
+    progress("loading meditron-7b", 0.0)
+    return MeditronInstanceLLM(
+        model_path=model_path,
+        on_progress=progress
+    )
+
+def warm_model(llm: MeditronInstanceLLM, progress):
+    warm_up(lambda sample, max_tokens: llm.invoke(sample["prompt"], max_tokens=max_tokens), progress)
+
+# the port binds right away, requests wait for the model up to MODEL_LOAD_TIMEOUT_S
+loader = ModelLoader(load_model, warm_model, name="Meditron7B").start()
 
 app = FastAPI(
     title='Meditron LLM API',
@@ -22,10 +36,31 @@ app = FastAPI(
 
 class PromptRequest(BaseModel):
     prompt: str
+    stop: Optional[List[str]] = None
     # change to take optional system_prompt
 
+def ready_llm() -> MeditronInstanceLLM:
+    try:
+        return loader.get(load_timeout)
+    except (TimeoutError, RuntimeError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
 @app.post("/generate")
 def generate_text(request:PromptRequest):
-    response=llm.invoke(request.prompt)
+    llm = ready_llm()
+    response=llm.invoke(request.prompt, stop=request.stop)
     # change to take optional system_prompt
-    return {'response': response}
\ No newline at end of file
+    return {'response': response}
+
+@app.get('/health')
+def health():
+    # always 200 while the process is up, 'status' is loading/warming/ready/failed
+    status = loader.status()
+    if loader.model is not None:
+        status['load'] = loader.model._load_report.summary()
+    return status
+
+@app.get('/ready')
+def ready():
+    # 503 until the model is loaded and warmed up
+    return JSONResponse(loader.status(), status_code=200 if loader.ready else 503)
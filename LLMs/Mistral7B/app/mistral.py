@@ -1,8 +1,11 @@
 from langchain_core.language_models import LLM
 from typing import Optional, List, Any, Mapping
 
+import torch
+
 from mistral_inference.transformer import Transformer
-from mistral_inference.generate import generate
+from mistral_inference.cache import BufferCache
+from mistral_inference.generate import sample
 from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
 from mistral_common.protocol.instruct.messages import UserMessage, SystemMessage
 from mistral_common.protocol.instruct.request import ChatCompletionRequest
@@ -38,8 +41,39 @@ class MistralInferenceLLM(LLM):
         return 'mistral_inference'
 
 
+    @torch.inference_mode()
+    def _generate(self, tokens: List[int], eos_id: int, stop_words: List[str], max_tokens: int) -> List[int]:
+        """ greedy/sampled decoding like mistral_inference.generate, but ends at the first stop word """
+        model = self._model
+        cache = BufferCache(model.n_local_layers, model.args.max_batch_size, len(tokens) + max_tokens,
+                            model.args.n_kv_heads, model.args.head_dim, model.args.sliding_window)
+        cache.to(device=model.device, dtype=model.dtype)
+        cache.reset()
+
+        logits = model.forward(torch.tensor(tokens, device=model.device, dtype=torch.long),
+                               seqlens=[len(tokens)], cache=cache)
+        last_logits = logits[-1:]
+
+        # a stop word never spans more tokens than it has characters
+        tail = max((len(w) for w in stop_words), default=0)
+        generated = []
+        for _ in range(max_tokens):
+            next_token = sample(last_logits, temperature=self._temperature, top_p=0.8)
+            if eos_id is not None and int(next_token.item()) == eos_id:
+                break
+            generated.append(int(next_token.item()))
+
+            text = self._tokenizer.decode(generated[-tail:]) if tail else ""
+            if any(w in text for w in stop_words):
+                break
+
+            last_logits = model.forward(next_token, seqlens=[1], cache=cache)
+
+        return generated
+
     @timeit
-    def _call(self, prompt: str, system_prompt: Optional[str] = None, stop: Optional[List[str]] = None) -> str:
+    def _call(self, prompt: str, system_prompt: Optional[str] = None, stop: Optional[List[str]] = None,
+              max_tokens: Optional[int] = None) -> str:
         system_message = SystemMessage(role='system', content=system_prompt) if system_prompt else self._system_message
 
         user_message = UserMessage(role='user', content=prompt)
@@ -48,18 +82,15 @@ class MistralInferenceLLM(LLM):
 
         eos_id = self._tokenizer.instruct_tokenizer.tokenizer.eos_id
 
+        stop_words = stop or ["###", "ENDE"]
+
         # Text generieren
-        output = generate([tokens],
-                          self._model,
-                          max_tokens=self._max_tokens,
-                          temperature=self._temperature,
-                          eos_id=eos_id)
+        output = self._generate(tokens, eos_id, stop_words, self._max_tokens if max_tokens is None else int(max_tokens))
 
-        decoded_output = self._tokenizer.decode(output[0])
+        decoded_output = self._tokenizer.decode(output)
         if isinstance(decoded_output, list):
             decoded_output = ''.join(str(x) for x in decoded_output)
 
-        stop_words = stop or ["###", "ENDE"]
         for stop_word in stop_words:
             if stop_word in decoded_output:
                 decoded_output = decoded_output.split(stop_word)[0]
@@ -68,5 +99,6 @@ class MistralInferenceLLM(LLM):
         return decoded_output.strip()
 
 
-    def invoke(self, prompt: str, system_prompt: Optional[str] = None) -> str:
-        return self._call(prompt=prompt, system_prompt=system_prompt)
+    def invoke(self, prompt: str, system_prompt: Optional[str] = None, stop: Optional[List[str]] = None,
+               max_tokens: Optional[int] = None) -> str:
+        return self._call(prompt=prompt, system_prompt=system_prompt, stop=stop, max_tokens=max_tokens)
@@ -1,21 +1,37 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List
+import os
 
 from app import MistralInferenceLLM
+from utils import ModelLoader, warm_up
+from utils.prompts import SystemPromptRegistry, system_prompts_router, with_system_prompt
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent  # -> /app
 
 model_path = str(BASE_DIR / 'mistral-7B-Instruct-v0.3')
 tokenizer_path = str(BASE_DIR / 'mistral-7B-Instruct-v0.3' / 'tokenizer.model.v3')
+load_timeout = float(os.getenv("MODEL_LOAD_TIMEOUT_S", "600"))
 
-llm = MistralInferenceLLM(
-        model_path=model_path,
-        tokenizer_path=tokenizer_path,
-        temperature=0.0,
-        max_tokens=250
-)
+def load_model(progress) -> MistralInferenceLLM:
+    progress("loading mistral-7B-Instruct-v0.3", 0.0)
+    return MistralInferenceLLM(
+            model_path=model_path,
+            tokenizer_path=tokenizer_path,
+            temperature=0.0,
+            max_tokens=250
+    )
+
+def warm_model(llm: MistralInferenceLLM, progress):
+    warm_up(lambda sample, max_tokens: llm.invoke(prompt=sample["prompt"], system_prompt=sample["system_prompt"],
+                                                  max_tokens=max_tokens), progress)
+
+system_prompts = SystemPromptRegistry.from_env()
+
+# the port binds right away, requests wait for the model up to MODEL_LOAD_TIMEOUT_S
+loader = ModelLoader(load_model, warm_model, name="Mistral7B").start()
 
 app = FastAPI(
         docs_url=None,
@@ -25,8 +41,30 @@ app = FastAPI(
 class PromptRequest(BaseModel):
     prompt: str
     system_prompt: Optional[str] = None
+    system_prompt_id: Optional[str] = None
+    stop: Optional[List[str]] = None
+
+def ready_llm() -> MistralInferenceLLM:
+    try:
+        return loader.get(load_timeout)
+    except (TimeoutError, RuntimeError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
 @app.post("/generate")
 def generate_text(request:PromptRequest):
-    response = llm.invoke(prompt=request.prompt, system_prompt=request.system_prompt)
+    request = with_system_prompt(system_prompts, request)
+    llm = ready_llm()
+    response = llm.invoke(prompt=request.prompt, system_prompt=request.system_prompt, stop=request.stop)
     return {"response": response}
+
+app.include_router(system_prompts_router(system_prompts))
+
+@app.get("/health")
+def health():
+    # always 200 while the process is up, "status" is loading/warming/ready/failed
+    return loader.status()
+
+@app.get("/ready")
+def ready():
+    # 503 until the model is loaded and warmed up
+    return JSONResponse(loader.status(), status_code=200 if loader.ready else 503)
@@ -0,0 +1,182 @@
+from typing import Iterator
+from pathlib import Path
+import importlib
+import os
+
+from utils import get_logger
+
+from .registry import ModelRegistry, ModelSpec, weights_size
+
+LOGGER = get_logger(__name__)
+
+# same mount points as the single-backend images (see docker-compose.yml)
+BASE_DIR = Path(os.getenv("MODELS_BASE_DIR", "/app"))
+PROMPT_LOOKUP_NUM_TOKENS = int(os.getenv("PROMPT_LOOKUP_NUM_TOKENS", "10"))
+
+
+def _import(module: str, name: str):
+    """ backend class, None if its dependencies are not installed in this image """
+    try:
+        return getattr(importlib.import_module(module), name)
+    except ImportError as exc:
+        LOGGER.warning(f"Backend {module} not available: {exc}")
+        return None
+
+
+def _sampling(request) -> dict:
+    return dict(
+        prompt=request.prompt,
+        system_prompt=request.system_prompt,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        max_tokens=request.max_tokens,
+        stop=request.stop,
+    )
+
+
+def _defaults(temperature: float, top_p: float, max_tokens: int) -> dict:
+    return {"temperature": temperature, "top_p": top_p, "max_tokens": max_tokens}
+
+
+def _to_cpu(attr: str):
+    """ offload/restore for backends holding a single-device torch model in `attr` """
+    def offload(llm):
+        getattr(llm, attr).to("cpu")
+
+    def restore(llm):
+        getattr(llm, attr).to("cuda")
+
+    return offload, restore
+
+
+def _register_transformers(registry: ModelRegistry):
+    model_id = os.getenv("MODEL_ID")
+    cls = _import("LLMs.TransformersGeneric.app", "TransformersLLM") if model_id and Path(model_id).exists() else None
+    if cls is None:
+        return
+
+    defaults = _defaults(float(os.getenv("TEMPERATURE", "0.8")), float(os.getenv("TOP_P", "0.9")),
+                         int(os.getenv("MAX_TOKENS", "512")))
+
+    def load():
+        return cls(
+            model_id_or_path=model_id,
+            **defaults,
+            torch_dtype=os.getenv("TORCH_DTYPE", "bfloat16"),
+            trust_remote_code=os.getenv("TRUST_REMOTE_CODE", "true").lower() == "true",
+            local_files_only=os.getenv("HF_LOCAL_ONLY", "true").lower() == "true",
+            max_batch_size=int(os.getenv("MAX_BATCH_SIZE", "1")),
+            prefix_cache_mb=int(os.getenv("PREFIX_CACHE_MB", "0")),
+            prompt_lookup_num_tokens=PROMPT_LOOKUP_NUM_TOKENS,
+            draft_model_id_or_path=os.getenv("DRAFT_MODEL_ID") or None,
+        )
+
+    def stream(llm, request) -> Iterator[str]:
+        yield from llm.stream(**_sampling(request), disable_think=bool(request.disable_think),
+                              prompt_lookup=bool(request.prompt_lookup), think_budget=request.think_budget)
+
+    # device_map="auto" may spread the model over several GPUs, so it is dropped instead of offloaded
+    registry.register(ModelSpec(os.getenv("TRANSFORMERS_MODEL_NAME", "Gemma4_31B"), load, stream,
+                                weights_size(Path(model_id)), close=lambda llm: llm.close(), defaults=defaults))
+
+
+def _register_apertus8b(registry: ModelRegistry):
+    model_dir = BASE_DIR / "base_model"
+    cls = _import("LLMs.Apertus8B.app", "ApertusInferenceLLM") if model_dir.exists() else None
+    if cls is None:
+        return
+
+    def load():
+        return cls(model_path=model_dir, tokenizer_path=model_dir, temperature=0.8, top_p=0.9, max_tokens=200,
+                   prompt_lookup_num_tokens=PROMPT_LOOKUP_NUM_TOKENS)
+
+    def stream(llm, request) -> Iterator[str]:
+        yield from llm.stream(**_sampling(request), prompt_lookup=bool(request.prompt_lookup))
+
+    offload, restore = _to_cpu("_model")
+    registry.register(ModelSpec("Apertus8B", load, stream, weights_size(model_dir), offload, restore,
+                                defaults=_defaults(0.8, 0.9, 200)))
+
+
+def _register_qwen3(registry: ModelRegistry):
+    model_dir = BASE_DIR / "model_inference"
+    cls = _import("LLMs.Qwen3.app", "QwenInferenceLLM") if model_dir.exists() else None
+    if cls is None:
+        return
+
+    def load():
+        offload_dir = Path(os.getenv("OFFLOAD_FOLDER") or (BASE_DIR / "offload")) / "qwen3"
+        return cls(model_path=model_dir, tokenizer_path=model_dir, temperature=0.8, top_p=0.9, max_tokens=200,
+                   offload_folder=offload_dir, prompt_lookup_num_tokens=PROMPT_LOOKUP_NUM_TOKENS)
+
+    def stream(llm, request) -> Iterator[str]:
+        yield from llm.stream(**_sampling(request), prompt_lookup=bool(request.prompt_lookup))
+
+    # offloaded layers run through prefetch hooks on cuda:0, moving it as a whole is not possible
+    registry.register(ModelSpec("Qwen3", load, stream, weights_size(model_dir), defaults=_defaults(0.8, 0.9, 200)))
+
+
+def _register_gguf(registry: ModelRegistry, name: str, module: str, model_file: Path,
+                   fields: tuple[str, ...] = ()):
+    cls = _import(module, "LLM_inference") if model_file.exists() else None
+    if cls is None:
+        return
+
+    def load():
+        return cls(model_path=model_file, temperature=0.8, top_p=0.9, max_tokens=200, n_ctx=8192, n_gpu_layers=-1)
+
+    def stream(llm, request) -> Iterator[str]:
+        kwargs = {k: getattr(request, k) for k in fields}
+        yield from llm.stream(**_sampling(request), **kwargs)
+
+    # llama.cpp keeps its weights outside torch: evicting means unloading, the GGUF is mmap'ed again
+    registry.register(ModelSpec(name, load, stream, weights_size(model_file), defaults=_defaults(0.8, 0.9, 200)))
+
+
+def _register_mistral(registry: ModelRegistry):
+    model_dir = BASE_DIR / "mistral-7B-Instruct-v0.3"
+    cls = _import("LLMs.Mistral7B.app", "MistralInferenceLLM") if model_dir.exists() else None
+    if cls is None:
+        return
+
+    def load():
+        return cls(model_path=str(model_dir), tokenizer_path=str(model_dir / "tokenizer.model.v3"),
+                   temperature=0.0, max_tokens=250)
+
+    def stream(llm, request) -> Iterator[str]:
+        yield llm.invoke(prompt=request.prompt, system_prompt=request.system_prompt, stop=request.stop,
+                         max_tokens=request.max_tokens)
+
+    registry.register(ModelSpec("Mistral7B", load, stream, weights_size(model_dir), defaults=_defaults(0.0, 1.0, 250)))
+
+
+def _register_meditron(registry: ModelRegistry):
+    model_dir = BASE_DIR / "model"
+    cls = _import("LLMs.Meditron7B.app", "MeditronInstanceLLM") if model_dir.exists() else None
+    if cls is None:
+        return
+
+    def load():
+        return cls(model_path=model_dir)
+
+    def stream(llm, request) -> Iterator[str]:
+        yield llm.invoke(request.prompt, stop=request.stop, max_tokens=request.max_tokens)
+
+    offload, restore = _to_cpu("_model")
+    registry.register(ModelSpec("Meditron7B-Untrainiert", load, stream, weights_size(model_dir), offload, restore,
+                                defaults=_defaults(0.0, 0.95, 1000)))
+
+
+def register_backends(registry: ModelRegistry):
+    """ registers every backend whose weights are mounted and whose dependencies are installed """
+    _register_transformers(registry)
+    _register_apertus8b(registry)
+    _register_qwen3(registry)
+    _register_gguf(registry, "Nemotron49B-8Bit", "LLMs.Nemotron49B.app",
+                   BASE_DIR / "Nemotron-model-8bit" / "nvidia_Llama-3_3-Nemotron-Super-49B-v1_5-Q8_0-00001-of-00002.gguf",
+                   fields=("disable_think", "think_budget"))
+    _register_gguf(registry, "Apertus70B-8bit", "LLMs.Apertus70B.app",
+                   BASE_DIR / "model8bit" / "swiss-ai_Apertus-70B-Instruct-2509-Q8_0"
+                   / "swiss-ai_Apertus-70B-Instruct-2509-Q8_0-00001-of-00002.gguf")
+    _register_mistral(registry)
+    _register_meditron(registry)
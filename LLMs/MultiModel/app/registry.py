@@ -0,0 +1,226 @@
+from typing import Any, Callable, Iterator, Optional
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+import gc
+import threading
+import time
+
+from utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+_WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".gguf", ".pth")
+
+
+def weights_size(path: Path) -> int:
+    """ bytes of weight files under path (a model folder or one shard of a GGUF model) """
+    path = Path(path)
+    if path.is_file():
+        # split GGUF models: count every shard next to the first one
+        prefix = path.name.split("-00001-of-")[0]
+        return sum(p.stat().st_size for p in path.parent.glob(f"{prefix}*") if p.suffix in _WEIGHT_SUFFIXES)
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file() and p.suffix in _WEIGHT_SUFFIXES)
+
+
+def release_device_memory():
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+@dataclass
+class ModelSpec:
+    """ one backend the host can serve; offload/restore move a loaded model to CPU RAM and back,
+    close releases what a dropped model still holds (threads, contexts),
+    defaults are its sampling defaults (known without loading it) """
+    name: str
+    load: Callable[[], Any]
+    stream: Callable[[Any, Any], Iterator[str]]
+    size_bytes: int
+    offload: Optional[Callable[[Any], None]] = None
+    restore: Optional[Callable[[Any], None]] = None
+    close: Optional[Callable[[Any], None]] = None
+    defaults: dict = field(default_factory=dict)
+
+
+@dataclass
+class _Entry:
+    spec: ModelSpec
+    llm: Any = None
+    location: Optional[str] = None  # None (on disk), "loading", "device" or "cpu"
+    users: int = 0
+    last_used: float = 0.0
+    loads: int = 0
+    load_lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class ModelRegistry:
+    """
+    Lazily loaded backends sharing one memory budget.
+
+    A model is loaded on its first request. When the next one does not fit into
+    device_budget, idle models are evicted least recently used first: to CPU RAM if the
+    backend supports it and cpu_budget has room, otherwise they are dropped and reloaded
+    from disk on demand. Models serving a request are never evicted.
+    """
+
+    def __init__(self, device_budget: int, cpu_budget: int = 0):
+        self._device_budget = int(device_budget)
+        self._cpu_budget = int(cpu_budget)
+        self._entries: dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+        self._evictions = 0
+
+    def register(self, spec: ModelSpec):
+        self._entries[spec.name] = _Entry(spec)
+        LOGGER.info(f"Registered model {spec.name} ({spec.size_bytes / 2**30:.1f} GiB)")
+
+    def names(self) -> list[str]:
+        return list(self._entries)
+
+    def spec(self, name: str) -> ModelSpec:
+        return self._entries[name].spec
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def _used(self, location: str) -> int:
+        return sum(e.spec.size_bytes for e in self._entries.values()
+                   if e.location == location or (location == "device" and e.location == "loading"))
+
+    def _claim(self, candidates: list[_Entry]) -> Optional[_Entry]:
+        """ the least recently used candidate whose load_lock is free, returned with the lock held """
+        for entry in sorted(candidates, key=lambda e: e.last_used):
+            if entry.load_lock.acquire(blocking=False):
+                return entry
+        return None
+
+    def _detach(self, entry: _Entry) -> tuple:
+        """ forgets the loaded model, it is reloaded from disk on its next use """
+        llm, entry.llm, entry.location = entry.llm, None, None
+        return entry, None, llm
+
+    def _evict(self, entry: _Entry, moves: list):
+        """ decides where an idle, claimed model goes; the move itself runs in _apply() """
+        spec = entry.spec
+        if spec.offload is not None and spec.size_bytes <= self._cpu_budget:
+            # the CPU tier is LRU as well: older offloaded models make way for this one
+            while self._used("cpu") + spec.size_bytes > self._cpu_budget:
+                victim = self._claim([e for e in self._entries.values()
+                                      if e.location == "cpu" and e.users == 0 and e.last_used < entry.last_used])
+                if victim is None:
+                    break
+                moves.append(self._detach(victim))
+
+        fits_cpu = self._used("cpu") + spec.size_bytes <= self._cpu_budget
+        if spec.offload is not None and fits_cpu:
+            entry.location = "cpu"
+            moves.append((entry, "cpu", entry.llm))
+        else:
+            moves.append(self._detach(entry))
+        self._evictions += 1
+
+    def _apply(self, moves: list):
+        """ offloads or closes the evicted models outside the registry lock, each under its own load_lock """
+        for entry, location, llm in moves:
+            try:
+                if location == "cpu":
+                    LOGGER.info(f"Evicting {entry.spec.name} to CPU RAM")
+                    try:
+                        entry.spec.offload(llm)
+                        continue
+                    except Exception:
+                        LOGGER.exception(f"Offloading {entry.spec.name} failed, dropping it")
+                        with self._lock:
+                            self._detach(entry)
+                else:
+                    LOGGER.info(f"Evicting {entry.spec.name} from memory")
+                if llm is not None and entry.spec.close is not None:
+                    try:
+                        entry.spec.close(llm)
+                    except Exception:
+                        LOGGER.exception(f"Closing {entry.spec.name} failed")
+            finally:
+                entry.load_lock.release()
+        if moves:
+            release_device_memory()
+
+    def _make_room(self, entry: _Entry) -> bool:
+        """
+        Evicts idle models until entry fits and reserves its share; True if entry sits in CPU RAM.
+        Victims are picked and accounted under the registry lock, the slow offload or close runs
+        after it, so requests for other models are not held up by it.
+        """
+        moves = []
+        with self._lock:
+            # leaving the CPU tier first makes room there for the models evicted below
+            offloaded = entry.location == "cpu"
+            entry.location = "loading"
+
+            while self._used("device") > self._device_budget:
+                victim = self._claim([e for e in self._entries.values()
+                                      if e is not entry and e.location == "device" and e.users == 0])
+                if victim is None:
+                    LOGGER.warning(f"No idle model to evict, loading {entry.spec.name} over budget")
+                    break
+                self._evict(victim, moves)
+
+            # drop offloaded models that no longer fit into the CPU tier
+            while self._used("cpu") > self._cpu_budget:
+                victim = self._claim([e for e in self._entries.values() if e.location == "cpu" and e.users == 0])
+                if victim is None:
+                    break
+                moves.append(self._detach(victim))
+
+        self._apply(moves)
+        return offloaded
+
+    @contextmanager
+    def use(self, name: str):
+        """ the loaded backend for name, pinned in memory while the block runs """
+        entry = self._entries[name]
+        with self._lock:
+            entry.users += 1
+        try:
+            with entry.load_lock:
+                if entry.location != "device":
+                    start = time.perf_counter()
+                    offloaded = self._make_room(entry)
+                    try:
+                        if offloaded:
+                            LOGGER.info(f"Restoring {name} from CPU RAM")
+                            entry.spec.restore(entry.llm)
+                        elif entry.llm is None:
+                            LOGGER.info(f"Loading {name}")
+                            entry.llm = entry.spec.load()
+                            entry.loads += 1
+                        entry.location = "device"
+                    except BaseException:
+                        entry.llm, entry.location = None, None
+                        raise
+                    LOGGER.info(f"{name} ready after {time.perf_counter() - start:.1f}s")
+            yield entry.llm
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "device_budget": self._device_budget,
+                "device_used": self._used("device"),
+                "cpu_budget": self._cpu_budget,
+                "cpu_used": self._used("cpu"),
+                "evictions": self._evictions,
+                "models": {
+                    name: {"location": e.location or "disk", "users": e.users, "loads": e.loads,
+                           "size": e.spec.size_bytes}
+                    for name, e in self._entries.items()
+                },
+            }
@@ -0,0 +1,175 @@
+from typing import Optional, List, Generator, AsyncGenerator
+import os
+import json
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+from app import ModelRegistry
+from app.backends import register_backends
+from utils import AsyncEngine, ModelLoader, ResponseCache, request_key, setup_logging, warm_up
+from utils.prompts import SystemPromptRegistry, system_prompts_router, with_system_prompt
+
+DEVICE_BUDGET_GIB = float(os.getenv("MODEL_DEVICE_BUDGET_GIB", os.getenv("MAX_VRAM_PER_GPU", "45")))
+CPU_BUDGET_GIB = float(os.getenv("MODEL_CPU_BUDGET_GIB", "0"))
+
+registry = ModelRegistry(int(DEVICE_BUDGET_GIB * 2**30), int(CPU_BUDGET_GIB * 2**30))
+register_backends(registry)
+
+# backend modules configure logging on import, claim it back for this service
+LOGGER = setup_logging(app_name='multi-inference', to_stdout=True, retention=30)
+LOGGER.info(f"Models: {registry.names()}")
+
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL") or (registry.names()[0] if registry.names() else None)
+MODEL_LOAD_TIMEOUT_S = float(os.getenv("MODEL_LOAD_TIMEOUT_S", "600"))
+
+response_cache = ResponseCache.from_env()
+engine = AsyncEngine(
+    workers=int(os.getenv("ENGINE_WORKERS", "1")),
+    max_pending=int(os.getenv("ENGINE_MAX_PENDING", "1024"))
+)
+
+app = FastAPI(
+    docs_url=None,
+    redoc_url=None,
+    openapi_url=None,
+)
+
+class PromptRequest(BaseModel):
+    prompt: str
+    model: Optional[str] = None
+    system_prompt: Optional[str] = None
+    system_prompt_id: Optional[str] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    think_budget: Optional[int] = None
+    disable_think: Optional[bool] = False
+    prompt_lookup: Optional[bool] = False
+
+def preload_default(progress) -> ModelRegistry:
+    # other models are still loaded lazily on their first request
+    if DEFAULT_MODEL is not None:
+        progress(f"loading {DEFAULT_MODEL}", 0.0)
+        with registry.use(DEFAULT_MODEL):
+            pass
+    return registry
+
+def warm_default(registry: ModelRegistry, progress):
+    if DEFAULT_MODEL is None:
+        return
+    spec = registry.spec(DEFAULT_MODEL)
+    with registry.use(DEFAULT_MODEL) as llm:
+        warm_up(lambda sample, max_tokens: spec.stream(llm, PromptRequest(max_tokens=max_tokens, **sample)), progress)
+
+system_prompts = SystemPromptRegistry.from_env()
+
+# the port binds right away, requests wait for the default model up to MODEL_LOAD_TIMEOUT_S
+loader = ModelLoader(preload_default, warm_default, name="multi-inference").start()
+
+async def wait_ready():
+    try:
+        await loader.wait(MODEL_LOAD_TIMEOUT_S)
+    except (TimeoutError, RuntimeError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+class ConfigOut(BaseModel):
+    model: str
+    defaults: dict
+    models: list[str]
+
+def model_name(requested: Optional[str]) -> str:
+    name = requested or DEFAULT_MODEL
+    if name not in registry:
+        raise HTTPException(status_code=404, detail=f"Unknown model '{name}', available: {registry.names()}")
+    return name
+
+def cache_key(name: str, request: PromptRequest) -> Optional[str]:
+    temperature = registry.spec(name).defaults.get("temperature") if request.temperature is None else request.temperature
+    return request_key(name, temperature, request.model_dump(exclude={"prompt_lookup", "model"}))
+
+def generate_tokens(name: str, request: PromptRequest, key: Optional[str]) -> Generator[str, None, None]:
+    parts = []
+    # the model stays pinned in memory until the generation is done
+    with registry.use(name) as llm:
+        for tok in registry.spec(name).stream(llm, request):
+            if tok:
+                parts.append(tok)
+                yield tok
+
+    response_cache.put(key, "".join(parts))
+
+@app.post("/generate")
+async def generate_text(request: PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    name = model_name(request.model)
+    key = cache_key(name, request)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return {"response": cached.strip(), "model": name, "cached": True}
+
+    await wait_ready()
+    parts = [tok async for tok in engine.stream(lambda: generate_tokens(name, request, key), key=key)]
+    return {"response": "".join(parts).strip(), "model": name}
+
+def sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/generate_stream")
+async def generate_text_stream(request: PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    name = model_name(request.model)
+    key = cache_key(name, request)
+    cached = response_cache.get(key)
+    if cached is None:
+        # waits (or fails with 503) before the stream starts while the default model is still loading
+        await wait_ready()
+
+    async def token_generator() -> AsyncGenerator[bytes, None]:
+        if cached is not None:
+            yield sse_event({"token": cached}).encode("utf-8")
+            yield sse_event({"finished": True, "cached": True}).encode("utf-8")
+            return
+
+        try:
+            async for tok in engine.stream(lambda: generate_tokens(name, request, key), key=key):
+                yield sse_event({"token": tok}).encode("utf-8")
+            yield sse_event({"finished": True}).encode("utf-8")
+        except GeneratorExit:
+            return
+        except Exception as e:
+            yield sse_event({"error": str(e)}).encode("utf-8")
+
+    return StreamingResponse(
+        token_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+@app.get("/config")
+def get_config(model: Optional[str] = None) -> ConfigOut:
+    name = model_name(model)
+    return ConfigOut(model=name, defaults=registry.spec(name).defaults, models=registry.names())
+
+app.include_router(system_prompts_router(system_prompts))
+
+@app.get("/health")
+def health():
+    # always 200 while the process is up, "status" is loading/warming/ready/failed
+    return {
+        **loader.status(),
+        "models": registry.stats(),
+        "response_cache": response_cache.stats(),
+        "engine": engine.stats(),
+    }
+
+@app.get("/ready")
+def ready():
+    # 503 until the default model is loaded and warmed up
+    return JSONResponse(loader.status(), status_code=200 if loader.ready else 503)
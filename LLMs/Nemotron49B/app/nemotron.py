@@ -2,27 +2,91 @@ from typing import Optional, List, ClassVar, Iterator
 from pathlib import Path
 import threading
 
+import numpy as np
 from langchain_core.language_models import LLM
 
-from llama_cpp import Llama
+from llama_cpp import Llama, LogitsProcessorList
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter
 
 from utils import timeit
+from utils import InstancePool
+from utils.llamacpp import BatchedDecoder, PrefixStateCache, common_prefix, prime_prefix, shared_llama
 from utils import setup_logging
 
 LOGGER = setup_logging(app_name='nemotron49B-inference', to_stdout=True, retention=30)
 
+class ThinkingLogitsProcessor:
+    """
+    llama.cpp counterpart of utils.generation.ThinkingBudgetProcessor (this image has no torch).
+
+    disable: <think> is never sampled, a block opened by the chat template is closed right away.
+    budget: </think> is forced once the block has run for `budget` tokens.
+    """
+
+    def __init__(self, think_ids: tuple[int, int], *, disable: bool = False, budget: Optional[int] = None):
+        self._open_id, self._close_id = think_ids
+        self._disable = bool(disable)
+        self._budget = None if budget is None else max(0, int(budget))
+
+    def __call__(self, input_ids: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        opened = np.flatnonzero(input_ids == self._open_id)
+        closed = np.flatnonzero(input_ids == self._close_id)
+        last_open = int(opened[-1]) if opened.size else -1
+        last_close = int(closed[-1]) if closed.size else -1
+
+        if last_open <= last_close:
+            if self._disable:
+                scores[self._open_id] = -np.inf
+            return scores
+
+        spent = len(input_ids) - 1 - last_open
+        if self._disable or (self._budget is not None and spent >= self._budget):
+            scores[:] = -np.inf
+            scores[self._close_id] = 0.0
+        return scores
+
+
 class LLM_inference(LLM):
     device: ClassVar[str] = "cuda"
     def __init__(self, model_path: Path, temperature: float, top_p: float, max_tokens: int,
-                 n_ctx: int = 16384, n_gpu_layers: int = -1):
+                 n_ctx: int = 16384, n_gpu_layers: int = -1,
+                 n_threads: Optional[int] = None, n_contexts: int = 1, n_seq: int = 1,
+                 llama_params: Optional[dict] = None):
         super().__init__()
-        object.__setattr__(self, '_llm', Llama(model_path=str(model_path), n_ctx=int(n_ctx),
-                                               n_gpu_layers=int(n_gpu_layers), verbose=False))
+        # n_threads None keeps the llama.cpp default, CPU replicas pass the size of their core set.
+        # n_contexts independent contexts decode in parallel over one loaded model: the weights (GPU
+        # layers included) exist once, every context only adds its own KV cache.
+        # n_seq > 1 instead batches that many requests in one context sharing n_ctx, the Llama
+        # object then only tokenizes and gets a minimal context of its own.
+        batched = int(n_seq) > 1
+        # llama_params are the tuned settings (utils.llamacpp.tune), core sets of replicas override their threads.
+        params = dict(llama_params or {})
+        if n_threads is not None:
+            params.update(n_threads=n_threads, n_threads_batch=n_threads)
+        llm = Llama(model_path=str(model_path), n_ctx=min(int(n_ctx), 512) if batched else int(n_ctx),
+                    n_gpu_layers=int(n_gpu_layers), verbose=False, **params)
+        object.__setattr__(self, '_pool', InstancePool(
+            lambda i: llm if i == 0 else shared_llama(llm),
+            size=1 if batched else n_contexts, name=self._llm_type
+        ))
+        object.__setattr__(self, '_llm', self._pool.instances[0])
+        # saved KV states of recent system prompts, PROMPT_STATE_CACHE_MB / PROMPT_STATE_DISK_MB
+        object.__setattr__(self, '_state_cache', PrefixStateCache.from_env(model_path))
+        object.__setattr__(self, '_decoder', BatchedDecoder(self._llm, n_seq=n_seq, n_ctx=n_ctx,
+                                                            n_batch=params.get("n_batch", 512),
+                                                            name=self._llm_type, cache=self._state_cache)
+                           if batched else None)
+        object.__setattr__(self, '_chat_formatter',
+                           self._jinja_formatter() if batched or self._state_cache is not None else None)
+        object.__setattr__(self, '_prefix_memo', {})
+        object.__setattr__(self, '_prefix_lock', threading.Lock())
         object.__setattr__(self, '_temperature', float(temperature))
         object.__setattr__(self, '_top_p', float(top_p))
         object.__setattr__(self, '_max_tokens', int(max_tokens))
         object.__setattr__(self, '_systemmessage', "Du bist ein präziser, detailorientierter medizinischer Schreibassistent.")
-        object.__setattr__(self, "_lock", threading.Lock())
+        object.__setattr__(self, "_think_ids", self._single_token_ids("<think>", "</think>"))
+        if self._think_ids is None:
+            LOGGER.info("<think>/</think> are no single tokens, thinking control is text-only")
 
     @property
     def _llm_type(self):
@@ -37,6 +101,86 @@ class LLM_inference(LLM):
         do_sample = temp > 0.0
         return temp, nucleus, max_new, do_sample
 
+    def _single_token_ids(self, *texts: str) -> Optional[tuple[int, ...]]:
+        ids = [self._llm.tokenize(t.encode("utf-8"), add_bos=False, special=True) for t in texts]
+        return tuple(i[0] for i in ids) if all(len(i) == 1 for i in ids) else None
+
+    def _thinking(self, disable_think: bool, think_budget: Optional[int]) -> Optional[ThinkingLogitsProcessor]:
+        """ suppresses or caps the think block while decoding, so discarded reasoning costs no decode steps """
+        if self._think_ids is None or not (disable_think or think_budget is not None):
+            return None
+        return ThinkingLogitsProcessor(self._think_ids, disable=disable_think, budget=think_budget)
+
+    def _jinja_formatter(self) -> Jinja2ChatFormatter:
+        """ the chat template of the GGUF, rendered the way create_chat_completion renders it """
+        model = self._llm._model
+        return Jinja2ChatFormatter(
+            template=self._llm.metadata["tokenizer.chat_template"],
+            eos_token=model.token_get_text(self._llm.token_eos()),
+            bos_token=model.token_get_text(self._llm.token_bos()),
+            stop_token_ids=[self._llm.token_eos()],
+        )
+
+    def _chat_tokens(self, messages: list[dict]) -> tuple[list[int], list[str]]:
+        formatted = self._chat_formatter(messages=messages)
+        tokens = self._llm.tokenize(formatted.prompt.encode("utf-8"), add_bos=not formatted.added_special, special=True)
+        stops = [formatted.stop] if isinstance(formatted.stop, str) else list(formatted.stop or [])
+        return tokens, stops
+
+    def _prefix_tokens(self, sys_text: str) -> list[int]:
+        """ the system prompt part, everything up to where the user message starts, memoized per text """
+        with self._prefix_lock:
+            tokens = self._prefix_memo.get(sys_text)
+        if tokens is None:
+            # tokenized outside the lock, concurrent misses on the same text just do it twice
+            tokens = self._chat_tokens([{"role": "system", "content": sys_text}, {"role": "user", "content": ""}])[0]
+            with self._prefix_lock:
+                if len(self._prefix_memo) >= 64:
+                    self._prefix_memo.pop(next(iter(self._prefix_memo)))
+                self._prefix_memo[sys_text] = tokens
+        return tokens
+
+    def system_prefix_tokens(self, system_prompt: Optional[str], disable_think: bool = False) -> Optional[list[int]]:
+        """ pre-tokenizes a system prompt (server side registry), None if this setup does not use the tokens """
+        if self._chat_formatter is None:
+            return None
+        return self._prefix_tokens(self._build_messages("", system_prompt, disable_think)[0]["content"])
+
+    def _completion(self, messages: list[dict], max_new: int, temp: float, nucleus: float, stop_words: list[str],
+                    thinking: Optional[ThinkingLogitsProcessor]) -> Iterator[str]:
+        """ text chunks of one chat completion, from the batched decoder or a free context """
+        if self._chat_formatter is not None:
+            tokens, stops = self._chat_tokens(messages)
+            prefix_len = common_prefix(tokens, self._prefix_tokens(messages[0]["content"]))
+        if self._decoder is not None:
+            yield from self._decoder.generate(tokens, max_tokens=max_new, temperature=temp, top_p=nucleus,
+                                              stop=stop_words + stops, logits_processor=thinking,
+                                              prefix_len=prefix_len)
+            return
+
+        # one generation per context, requests queue while all contexts are busy
+        with self._pool.acquire() as llm:
+            if self._state_cache is not None:
+                prime_prefix(llm, self._state_cache, tokens[:min(prefix_len, len(tokens) - 1)])
+            completion = llm.create_chat_completion(
+                    messages=messages,
+                    max_tokens=max_new,
+                    temperature=temp,
+                    top_p=nucleus,
+                    stream=True,
+                    stop=stop_words,
+                    logits_processor=LogitsProcessorList([thinking]) if thinking is not None else None
+            )
+            try:
+                for chunk in completion:
+                    delta = chunk["choices"][0].get("delta", {})
+                    text = delta.get("content") or ""
+                    if text:
+                        yield text
+            finally:
+                # closing the llama.cpp generator stops decoding right away (client disconnected)
+                completion.close()
+
     def _build_messages(self, prompt: str, system_prompt: Optional[str], disable_think: Optional[bool]) -> list[dict]:
         sys_text = (system_prompt or self._systemmessage).strip()
         user_text = (prompt or "").strip()
@@ -51,32 +195,23 @@ class LLM_inference(LLM):
 
     def _stream_chunks(self, prompt: str, system_prompt: Optional[str],
                        *, temperature: Optional[float], top_p: Optional[float],
-                       max_tokens: Optional[int], disable_think: bool = False) -> Iterator[str]:
+                       max_tokens: Optional[int], disable_think: bool = False,
+                       stop: Optional[List[str]] = None, think_budget: Optional[int] = None) -> Iterator[str]:
         temp, nucleus, max_new, _ = self._effective_params(temperature, top_p, max_tokens)
         messages = self._build_messages(prompt, system_prompt, disable_think)
 
-        LOGGER.info(f"Sampling: max_tokens={max_new}, temperature={temp}, top_p={nucleus}")
-        stop = ["<|eot_id|>", "<|end_of_text|>"]
-        if disable_think:
-            stop = ["</think>","<|eot_id|>", "<|end_of_text|>"]
+        LOGGER.info(f"Sampling: max_tokens={max_new}, temperature={temp}, top_p={nucleus}, think_budget={think_budget}")
+        thinking = self._thinking(disable_think, think_budget)
+        stop_words = ["<|eot_id|>", "<|end_of_text|>"]
+        if disable_think and thinking is None:
+            stop_words = ["</think>","<|eot_id|>", "<|end_of_text|>"]
+        # request stop strings end decoding inside llama.cpp, the match itself is not returned
+        stop_words += [s for s in (stop or []) if s]
 
         in_think = False
-
-        # Single GPU, big model: serialize generations to avoid thrashing
-        with self._lock:
-            for chunk in self._llm.create_chat_completion(
-                    messages=messages,
-                    max_tokens=max_new,
-                    temperature=temp,
-                    top_p=nucleus,
-                    stream=True,
-                    stop=stop
-            ):
-                delta = chunk["choices"][0].get("delta", {})
-                text = delta.get("content") or ""
-                if not text:
-                    continue
-
+        chunks = self._completion(messages, max_new, temp, nucleus, stop_words, thinking)
+        try:
+            for text in chunks:
                 if disable_think:
                     if "<think>" in text:
                         in_think = True
@@ -88,23 +223,37 @@ class LLM_inference(LLM):
                         continue
 
                 yield text
+        finally:
+            chunks.close()
+
+    def context_stats(self) -> dict:
+        if self._decoder is not None:
+            return self._decoder.stats()
+        return {**self._pool.stats(),
+                "prompt_state_cache": None if self._state_cache is None else self._state_cache.stats()}
 
     @timeit
     def _call(self, prompt: str, system_prompt: Optional[str] = None, stop: Optional[List[str]] = None,
               *, temperature: Optional[float] = None, top_p: Optional[float] = None,
-              max_tokens: Optional[int] = None, disable_think: bool = False) -> str:
+              max_tokens: Optional[int] = None, disable_think: bool = False,
+              think_budget: Optional[int] = None) -> str:
         parts = []
         for chunk in self._stream_chunks(prompt, system_prompt, temperature=temperature,
-                                         top_p=top_p, max_tokens=max_tokens, disable_think=disable_think):
+                                         top_p=top_p, max_tokens=max_tokens, disable_think=disable_think,
+                                         stop=stop, think_budget=think_budget):
             parts.append(chunk)
         return "".join(parts)
 
     def invoke(self, prompt: str, system_prompt: Optional[str] = None, *, temperature: Optional[float] = None,
-               top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False) -> str:
-        return self._call(prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens, disable_think=disable_think)
+               top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False,
+               stop: Optional[List[str]] = None, think_budget: Optional[int] = None) -> str:
+        return self._call(prompt, system_prompt, stop, temperature=temperature, top_p=top_p, max_tokens=max_tokens,
+                          disable_think=disable_think, think_budget=think_budget)
 
     @timeit
     def stream(self, prompt: str, system_prompt: Optional[str] = None, *, temperature: Optional[float] = None,
-               top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False) -> Iterator[str]:
+               top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False,
+               stop: Optional[List[str]] = None, think_budget: Optional[int] = None) -> Iterator[str]:
         yield from self._stream_chunks(prompt, system_prompt, temperature=temperature,
-                                       top_p=top_p, max_tokens=max_tokens, disable_think=disable_think)
\ No newline at end of file
+                                       top_p=top_p, max_tokens=max_tokens, disable_think=disable_think, stop=stop,
+                                       think_budget=think_budget)
\ No newline at end of file
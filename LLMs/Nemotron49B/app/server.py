@@ -1,23 +1,67 @@
-from typing import Optional, Generator
+from typing import Optional, List, Generator, AsyncGenerator
 from pathlib import Path
+import os
 import json
 
 from pydantic import BaseModel
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from app import LLM_inference
+from utils import AsyncEngine, ModelLoader, ReplicaPool, ResponseCache, replica_count, replica_threads, request_key, warm_up
+from utils.prompts import SystemPromptRegistry, system_prompts_router, with_system_prompt
+from utils.llamacpp import load_tuned
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 model_file = Path(BASE_DIR / 'Nemotron-model-8bit' / 'nvidia_Llama-3_3-Nemotron-Super-49B-v1_5-Q8_0-00001-of-00002.gguf')
+load_timeout = float(os.getenv("MODEL_LOAD_TIMEOUT_S", "600"))
+replicas = replica_count()
+# llama.cpp contexts per process, requests beyond that wait for a free one
+contexts = max(1, int(os.getenv("LLAMA_CONTEXTS", "1")))
+# > 1: that many requests share every forward pass of one context (replaces LLAMA_CONTEXTS)
+sequences = max(1, int(os.getenv("LLAMA_PARALLEL_SEQUENCES", "1")))
+# written by `python -m utils.llamacpp.tune` for this host, read before replicas pin their cores
+tuned = load_tuned(model_file, n_gpu_layers=-1)
 
-llm = LLM_inference(
-    model_path=model_file,
-    temperature=0.8,
-    top_p=0.9,
-    max_tokens=200,
-    n_ctx=8192,
-    n_gpu_layers=-1
+def load_model(progress) -> LLM_inference:
+    progress(f"loading {model_file.name}", 0.0)
+    return LLM_inference(
+        model_path=model_file,
+        temperature=0.8,
+        top_p=0.9,
+        max_tokens=200,
+        n_ctx=8192,
+        n_gpu_layers=-1,
+        n_threads=replica_threads(),
+        n_contexts=contexts,
+        n_seq=sequences,
+        llama_params=tuned
+    )
+
+def warm_model(llm: LLM_inference, progress):
+    if system_prompts is not None:
+        # registered prompts are tokenized once here and after every reload, not per request
+        system_prompts.set_tokenizer(lambda p: llm.system_prefix_tokens(p.text, disable_think=not p.reasoning))
+    warm_up(lambda sample, max_tokens: llm.stream(
+        prompt=sample["prompt"],
+        system_prompt=sample["system_prompt"],
+        temperature=sample.get("temperature"),
+        max_tokens=max_tokens
+    ), progress)
+
+system_prompts = SystemPromptRegistry.from_env()
+
+# the port binds right away, requests wait for the model up to MODEL_LOAD_TIMEOUT_S
+# CPU_REPLICAS > 1: pinned processes share the mapped GGUF, this one only dispatches to them
+if replicas > 1:
+    loader = ReplicaPool(load_model, warm_model, name="Nemotron49B-8Bit", replicas=replicas).start()
+else:
+    loader = ModelLoader(load_model, warm_model, name="Nemotron49B-8Bit").start()
+
+response_cache = ResponseCache.from_env()
+engine = AsyncEngine(
+    workers=int(os.getenv("ENGINE_WORKERS", str(replicas * max(contexts, sequences)))),
+    max_pending=int(os.getenv("ENGINE_MAX_PENDING", "1024"))
 )
 
 app = FastAPI(
@@ -29,44 +73,79 @@ app = FastAPI(
 class PromptRequest(BaseModel):
     prompt: str
     system_prompt: Optional[str] = None
+    system_prompt_id: Optional[str] = None
     temperature: Optional[float] = None
     top_p: Optional[float] = None
     max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    think_budget: Optional[int] = None
     disable_think: Optional[bool] = None
 
 class ConfigOut(BaseModel):
     model: str = "Nemotron49B-8Bit"
     defaults: dict
 
-@app.post("/generate")
-def generate_text(request: PromptRequest):
-    response = llm.invoke(
+async def ready_llm() -> LLM_inference:
+    try:
+        return await loader.wait(load_timeout)
+    except (TimeoutError, RuntimeError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+def cache_key(request: PromptRequest) -> Optional[str]:
+    temperature = 0.8 if request.temperature is None else request.temperature
+    return request_key(str(model_file), temperature, request.model_dump())
+
+def generate_tokens(llm: LLM_inference, request: PromptRequest, key: Optional[str]) -> Generator[str, None, None]:
+    parts = []
+    for tok in llm.stream(
         prompt=request.prompt,
         system_prompt=request.system_prompt,
         temperature=request.temperature,
         top_p=request.top_p,
         max_tokens=request.max_tokens,
+        stop=request.stop,
+        think_budget=request.think_budget,
         disable_think=request.disable_think
-    )
+    ):
+        if tok:
+            parts.append(tok)
+            yield tok
+    response_cache.put(key, "".join(parts))
+
+@app.post("/generate")
+async def generate_text(request: PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    key = cache_key(request)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return {"response": cached, "cached": True}
+
+    llm = await ready_llm()
+    # identical deterministic requests in flight share one generation
+    parts = [tok async for tok in engine.stream(lambda: generate_tokens(llm, request, key), key=key)]
+    response = "".join(parts)
     return {"response": response}
 
 def sse_event(data: dict) -> str:
     return f'data: {json.dumps(data, ensure_ascii=False)}\n\n'
 
 @app.post("/generate_stream")
-def generate_text_stream(request: PromptRequest):
-    def token_generator() -> Generator[bytes, None, None]:
+async def generate_text_stream(request: PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    key = cache_key(request)
+    cached = response_cache.get(key)
+    # waits (or fails with 503) before the stream starts while the model is still loading
+    llm = await ready_llm() if cached is None else None
+
+    async def token_generator() -> AsyncGenerator[bytes, None]:
+        if cached is not None:
+            yield sse_event({"token": cached}).encode("utf-8")
+            yield sse_event({"finished": True, "cached": True}).encode("utf-8")
+            return
+
         try:
-            for tok in llm.stream(
-                prompt=request.prompt,
-                system_prompt=request.system_prompt,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                max_tokens=request.max_tokens,
-                disable_think=request.disable_think
-            ):
-                if tok:
-                    yield sse_event({"token": tok}).encode("utf-8")
+            async for tok in engine.stream(lambda: generate_tokens(llm, request, key), key=key):
+                yield sse_event({"token": tok}).encode("utf-8")
             yield sse_event({"finished": True}).encode("utf-8")
         except GeneratorExit:
             return
@@ -86,12 +165,26 @@ def generate_text_stream(request: PromptRequest):
 def get_config() -> ConfigOut:
     return ConfigOut(
         defaults={
-            "temperature": llm._temperature,
-            "top_p": llm._top_p,
-            "max_tokens": llm._max_tokens
+            "temperature": 0.8,
+            "top_p": 0.9,
+            "max_tokens": 200
         }
     )
 
+app.include_router(system_prompts_router(system_prompts))
+
 @app.get("/health")
 def health():
-    return {"status": "ok"}
\ No newline at end of file
+    # always 200 while the process is up, "status" is loading/warming/ready/failed
+    status = {**loader.status(), "response_cache": response_cache.stats(),
+              "engine": engine.stats()}
+    if replicas > 1 and loader.model is not None:
+        status["replicas"] = loader.model.stats()
+    elif loader.model is not None:
+        status["contexts"] = loader.model.context_stats()
+    return status
+
+@app.get("/ready")
+def ready():
+    # 503 until the model is loaded and warmed up
+    return JSONResponse(loader.status(), status_code=200 if loader.ready else 503)
\ No newline at end of file
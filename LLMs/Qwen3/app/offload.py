@@ -0,0 +1,326 @@
+from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import time
+
+import torch
+
+from utils import get_logger
+from utils.generation.loading import (
+    LoadReport, checkpoint_shards, current_rss, empty_model, stream_checkpoint
+)
+
+LOGGER = get_logger(__name__)
+
+_ALIGN = 64
+_FINGERPRINT = re.compile(r"^[0-9a-f]{16}$")
+
+
+def checkpoint_fingerprint(model_dir: Path, dtype: torch.dtype, budget: dict) -> str:
+    """ config, shard layouts (safetensors headers, sizes, mtimes), compute dtype and memory budget """
+    h = hashlib.sha256()
+    for name in ("config.json", "model.safetensors.index.json"):
+        if (model_dir / name).exists():
+            h.update((model_dir / name).read_bytes())
+    for shard in checkpoint_shards(model_dir):
+        stat = shard.stat()
+        h.update(f"{shard.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        with open(shard, "rb") as f:
+            size = struct.unpack("<Q", f.read(8))[0]
+            h.update(f.read(size))
+    h.update(str(dtype).encode())
+    h.update(json.dumps(budget, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+def decoder_layers(model) -> tuple[str, torch.nn.ModuleList]:
+    """ the ModuleList holding the transformer blocks (model.layers for Qwen2/Qwen3) """
+    n_layers = getattr(model.config, "num_hidden_layers", None)
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.ModuleList) and len(module) == n_layers:
+            return name, module
+    raise ValueError(f"No decoder layer list with {n_layers} entries in {type(model).__name__}")
+
+
+def _param_bytes(module: torch.nn.Module) -> int:
+    return sum(p.numel() * p.element_size() for p in module.parameters())
+
+
+class OffloadStore:
+    """
+    Offloaded decoder layers as one packed file per layer, already in the compute dtype.
+
+    Lives in <root>/<fingerprint>/ and is reused across restarts; the files are memory-mapped
+    on load instead of being rewritten. Writing goes to a temporary folder that is renamed into
+    place once complete, so an interrupted start never leaves a half written cache behind.
+    """
+
+    def __init__(self, root: Path, fingerprint: str):
+        self.root = Path(root)
+        self.fingerprint = fingerprint
+        self.path = self.root / fingerprint
+        self._tmp = self.root / f".{fingerprint}.tmp"
+        self._index: dict = {}
+        self._files: dict[int, int] = {}
+        self._keys: dict[str, tuple[int, str]] = {}
+
+    @property
+    def complete(self) -> bool:
+        return (self.path / "index.json").exists()
+
+    def create(self, prefix: str, layers: dict[int, torch.nn.Module], dtype_of) -> "OffloadStore":
+        """ preallocates one file per layer, dtype_of(name, param) gives the stored dtype """
+        shutil.rmtree(self._tmp, ignore_errors=True)
+        self._tmp.mkdir(parents=True)
+        for idx, layer in layers.items():
+            entries, offset = {}, 0
+            for name, param in layer.named_parameters():
+                dtype = dtype_of(f"{prefix}.{idx}.{name}", param)
+                nbytes = param.numel() * torch.empty((), dtype=dtype).element_size()
+                entries[name] = {"offset": offset, "shape": list(param.shape), "dtype": str(dtype).replace("torch.", "")}
+                self._keys[f"{prefix}.{idx}.{name}"] = (idx, name)
+                offset += -(-nbytes // _ALIGN) * _ALIGN
+            file = self._tmp / f"layer_{idx:03d}.bin"
+            fd = os.open(file, os.O_RDWR | os.O_CREAT, 0o644)
+            os.ftruncate(fd, offset)
+            self._files[idx] = fd
+            self._index[str(idx)] = {"file": file.name, "size": offset, "tensors": entries}
+        return self
+
+    def write(self, key: str, tensor: torch.Tensor):
+        idx, name = self._keys[key]
+        entry = self._index[str(idx)]["tensors"][name]
+        tensor = tensor.to(getattr(torch, entry["dtype"]))
+        data = tensor.contiguous().view(-1).view(torch.uint8).numpy()
+        os.pwrite(self._files[idx], memoryview(data), entry["offset"])
+
+    def commit(self):
+        for fd in self._files.values():
+            os.fsync(fd)
+            os.close(fd)
+        self._files.clear()
+        (self._tmp / "index.json").write_text(json.dumps(self._index))
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self._tmp, self.path)
+        # caches of other checkpoints / budgets are stale, they only cost disk space
+        for other in self.root.iterdir():
+            if other.is_dir() and other != self.path and _FINGERPRINT.match(other.name):
+                shutil.rmtree(other, ignore_errors=True)
+
+    def open(self) -> dict[int, tuple[torch.Tensor, dict]]:
+        """ layer -> (memory-mapped packed uint8 buffer, tensor entries) """
+        index = json.loads((self.path / "index.json").read_text())
+        layers = {}
+        for idx, info in index.items():
+            buffer = torch.from_file(str(self.path / info["file"]), shared=False, size=info["size"], dtype=torch.uint8)
+            layers[int(idx)] = (buffer, info["tensors"])
+        return layers
+
+
+def _views(buffer: torch.Tensor, entries: dict) -> dict[str, torch.Tensor]:
+    views = {}
+    for name, entry in entries.items():
+        dtype = getattr(torch, entry["dtype"])
+        numel = 1
+        for dim in entry["shape"]:
+            numel *= dim
+        nbytes = numel * torch.empty((), dtype=dtype).element_size()
+        views[name] = buffer[entry["offset"]:entry["offset"] + nbytes].view(dtype).view(entry["shape"])
+    return views
+
+
+class LayerPrefetcher:
+    """
+    Runs offloaded decoder layers on the GPU and copies their weights in ahead of time.
+
+    Entering layer k starts the host-to-device copies of the next `depth` offloaded layers
+    (wrapping around to the first ones for the next decode step) on a side stream. Reading the
+    host side (page faults of the memory-mapped cache) happens on a worker thread into pinned
+    staging buffers, so the compute stream only waits when a copy is not done yet. Leaving a
+    layer points its parameters back to host memory and releases the GPU copy.
+    """
+
+    def __init__(self, layers: dict[int, torch.nn.Module], host: dict[int, tuple[torch.Tensor, dict]],
+                 device: torch.device, depth: int = 2, pinned_bytes: int = 0):
+        self._device = device
+        self._order = sorted(layers)
+        self._position = {idx: pos for pos, idx in enumerate(self._order)}
+        self._depth = max(0, min(int(depth), len(self._order) - 1))
+        self._stream = torch.cuda.Stream(device)
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="offload-prefetch")
+        self._pending: dict[int, Future] = {}
+
+        self._host: dict[int, torch.Tensor] = {}
+        self._entries: dict[int, dict] = {}
+        self._params: dict[int, dict[str, torch.nn.Parameter]] = {}
+        self._pinned = 0
+        for idx in self._order:
+            buffer, entries = host[idx]
+            # as many layers as the CPU budget allows stay in page-locked RAM (DMA straight from it)
+            if pinned_bytes >= buffer.numel():
+                buffer = torch.empty(buffer.numel(), dtype=torch.uint8, pin_memory=True).copy_(buffer)
+                pinned_bytes -= buffer.numel()
+                self._pinned += 1
+            self._host[idx] = buffer
+            self._entries[idx] = entries
+
+            layer = layers[idx]
+            params = {}
+            for name, view in _views(buffer, entries).items():
+                module_name, _, attr = name.rpartition(".")
+                module = layer.get_submodule(module_name) if module_name else layer
+                module._parameters[attr] = torch.nn.Parameter(view, requires_grad=False)
+                params[name] = module._parameters[attr]
+            self._params[idx] = params
+            layer.register_forward_pre_hook(self._make_pre_hook(idx))
+            layer.register_forward_hook(self._make_post_hook(idx))
+
+        largest = max((b.numel() for b in self._host.values() if not b.is_pinned()), default=0)
+        self._staging = [torch.empty(largest, dtype=torch.uint8).pin_memory() for _ in range(self._depth + 1)] if largest else []
+        self._staging_events: list[Optional[torch.cuda.Event]] = [None] * len(self._staging)
+        self._slot = 0
+
+        self._fetches = 0
+        self._stalls = 0
+        self._stall_s = 0.0
+
+    def _fetch(self, idx: int):
+        host = self._host[idx]
+        if host.is_pinned():
+            source = host
+        else:
+            slot = self._slot
+            self._slot = (self._slot + 1) % len(self._staging)
+            if self._staging_events[slot] is not None:
+                self._staging_events[slot].synchronize()
+            source = self._staging[slot][:host.numel()]
+            source.copy_(host)
+
+        with torch.cuda.stream(self._stream):
+            gpu = torch.empty(host.numel(), dtype=torch.uint8, device=self._device)
+            gpu.copy_(source, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        if not host.is_pinned():
+            self._staging_events[slot] = event
+        return gpu, event
+
+    def _schedule(self, idx: int):
+        if idx not in self._pending:
+            self._pending[idx] = self._pool.submit(self._fetch, idx)
+            self._fetches += 1
+
+    def _make_pre_hook(self, idx: int):
+        def pre_hook(module, args):
+            self._schedule(idx)
+            future = self._pending.pop(idx)
+            if not future.done():
+                begin = time.perf_counter()
+                future.result()
+                self._stalls += 1
+                self._stall_s += time.perf_counter() - begin
+            gpu, event = future.result()
+
+            stream = torch.cuda.current_stream(self._device)
+            stream.wait_event(event)
+            gpu.record_stream(stream)
+            for name, view in _views(gpu, self._entries[idx]).items():
+                self._params[idx][name].data = view
+
+            position = self._position[idx]
+            for step in range(1, self._depth + 1):
+                self._schedule(self._order[(position + step) % len(self._order)])
+        return pre_hook
+
+    def _make_post_hook(self, idx: int):
+        def post_hook(module, args, output):
+            for name, view in _views(self._host[idx], self._entries[idx]).items():
+                self._params[idx][name].data = view
+        return post_hook
+
+    def stats(self) -> dict:
+        return {
+            "offloaded_layers": len(self._order),
+            "pinned_layers": self._pinned,
+            "prefetch_depth": self._depth,
+            "fetches": self._fetches,
+            "stalls": self._stalls,
+            "stall_s": round(self._stall_s, 3),
+        }
+
+
+def load_offloaded(model_path: Path, *, dtype: torch.dtype, gpu_gib: float, cpu_gib: float, cache_root: Path,
+                   reserve_gib: Optional[float] = None, depth: Optional[int] = None,
+                   trust_remote_code: bool = True, local_files_only: bool = True):
+    """
+    Loads as many decoder layers as fit into gpu_gib (minus reserve_gib for activations and KV
+    cache, env OFFLOAD_GPU_RESERVE_GIB) onto cuda:0, the remaining ones go through the
+    persistent OffloadStore and run via LayerPrefetcher (env OFFLOAD_PREFETCH_LAYERS).
+
+    Returns (model, LoadReport, prefetcher or None).
+    """
+    reserve_gib = float(os.getenv("OFFLOAD_GPU_RESERVE_GIB", "2")) if reserve_gib is None else float(reserve_gib)
+    depth = int(os.getenv("OFFLOAD_PREFETCH_LAYERS", "2")) if depth is None else int(depth)
+    device = torch.device("cuda:0")
+    start = time.perf_counter()
+
+    model, dtype = empty_model(model_path, dtype, trust_remote_code=trust_remote_code, local_files_only=local_files_only)
+    prefix, layers = decoder_layers(model)
+
+    layer_bytes = max(_param_bytes(layer) for layer in layers)
+    other_bytes = _param_bytes(model) - sum(_param_bytes(layer) for layer in layers)
+    free = int((gpu_gib - reserve_gib) * 2**30) - other_bytes
+    resident = max(0, min(len(layers), free // layer_bytes))
+    offloaded = {idx: layers[idx] for idx in range(resident, len(layers))}
+
+    report = LoadReport(path=str(model_path), device=f"{device} (+{len(offloaded)} offloaded layers)",
+                        dtype=str(dtype).replace("torch.", ""))
+    layer_of = re.compile(rf"^{re.escape(prefix)}\.(\d+)\.")
+
+    def placement(name: str) -> Optional[str]:
+        match = layer_of.match(name)
+        return None if match and int(match.group(1)) in offloaded else str(device)
+
+    store = None
+    if offloaded:
+        budget = {"gpu_gib": gpu_gib, "reserve_gib": reserve_gib, "resident_layers": resident}
+        store = OffloadStore(cache_root, checkpoint_fingerprint(Path(model_path), dtype, budget))
+
+    sink = None
+    if store is not None and not store.complete:
+        LOGGER.info(f"Building offload cache {store.path} for {len(offloaded)} layers")
+        store.create(prefix, offloaded, lambda name, param: dtype if param.is_floating_point() else param.dtype)
+        sink = store.write
+    elif store is not None:
+        LOGGER.info(f"Reusing offload cache {store.path}")
+
+    stream_checkpoint(model, Path(model_path), dtype=dtype, placement=placement, report=report,
+                      chunk_bytes=int(os.getenv("MODEL_LOAD_CHUNK_MB", "256")) * 2**20, sink=sink)
+    if sink is not None:
+        store.commit()
+
+    prefetcher = None
+    if store is not None:
+        prefetcher = LayerPrefetcher(offloaded, store.open(), device, depth=depth, pinned_bytes=int(cpu_gib * 2**30))
+
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if missing:
+        raise RuntimeError(f"{len(missing)} weights missing in {model_path}: {missing[:5]}")
+    # non-persistent buffers (rotary tables) were created on the host
+    for module in model.modules():
+        for name, buffer in module._buffers.items():
+            if buffer is not None:
+                module._buffers[name] = buffer.to(device)
+
+    report.seconds = time.perf_counter() - start
+    LOGGER.info(f"Loaded {Path(model_path).name} in {report.seconds:.1f}s: {resident} layers resident, "
+                f"{len(offloaded)} offloaded (cache {'built' if sink else 'reused' if store else 'unused'}), "
+                f"RSS {current_rss() / 2**30:.1f} GiB")
+    return model.eval(), report, prefetcher
@@ -0,0 +1,76 @@
+from typing import Optional
+from pathlib import Path
+import gc
+import time
+
+import torch
+
+from utils import get_logger
+from utils.generation.loading import load_causal_lm
+
+from .offload import decoder_layers
+
+LOGGER = get_logger(__name__)
+
+
+def bnb_config(bits: int, compute_dtype: torch.dtype):
+    """ bitsandbytes config for GPU loading: NF4 with double quantization, or LLM.int8 """
+    from transformers import BitsAndBytesConfig
+
+    if bits == 4:
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_compute_dtype=compute_dtype,
+        )
+    # layers that spill to the CPU stay in fp32 there instead of failing the load
+    return BitsAndBytesConfig(load_in_8bit=True, llm_int8_enable_fp32_cpu_offload=True)
+
+
+def _quantize(module: torch.nn.Module, names: Optional[set] = None):
+    """ swaps the nn.Linear children (or the submodules in `names`) for dynamic int8 ones """
+    spec = names if names is not None else {torch.nn.Linear}
+    torch.ao.quantization.quantize_dynamic(module, spec, dtype=torch.qint8, inplace=True)
+
+
+def load_cpu_int8(model_path: Path, *, dtype: torch.dtype, trust_remote_code: bool = True,
+                  local_files_only: bool = True):
+    """
+    CPU-only int8: linear weights become qint8 with per-tensor scales and activations are
+    quantized on the fly (torch dynamic quantization, no GPU libraries). The checkpoint is
+    streamed in `dtype` and converted one decoder layer at a time, so the peak stays at the
+    half precision model plus a single fp32 layer. Everything that is not a linear layer
+    (embeddings, norms) runs in fp32, the quantized kernels take fp32 activations.
+    """
+    model, report = load_causal_lm(model_path, dtype=dtype, device="cpu", trust_remote_code=trust_remote_code,
+                                   local_files_only=local_files_only)
+    begin = time.perf_counter()
+    _, layers = decoder_layers(model)
+    for layer in layers:
+        _quantize(layer.float())
+        gc.collect()
+
+    # an untied lm_head is the largest single matrix, tied ones share the fp32 embedding
+    head = model.get_output_embeddings()
+    if isinstance(head, torch.nn.Linear) and head.weight is not model.get_input_embeddings().weight:
+        name = next(name for name, module in model.named_modules() if module is head)
+        head.float()
+        _quantize(model, {name})
+    model.float()
+    LOGGER.info(f"Dynamic int8 quantization of {len(layers)} layers took {time.perf_counter() - begin:.1f}s")
+    return model.eval(), report
+
+
+def model_memory_bytes(model: torch.nn.Module) -> int:
+    """ parameters and buffers, including the packed weights of dynamic int8 linears and bnb 4-bit weights """
+    total = 0
+    for module in model.modules():
+        for tensor in list(module._parameters.values()) + list(module._buffers.values()):
+            if tensor is not None:
+                total += tensor.numel() * tensor.element_size()
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(module, "weight") and callable(module.weight):
+            weight = module.weight()
+            total += weight.numel() * weight.element_size()
+    return total
@@ -2,11 +2,13 @@ from queue import Queue
 from typing import Optional, List, ClassVar, Iterator
 from pathlib import Path
 from queue import Queue, Empty
+from contextlib import nullcontext
 from packaging import version
 import os
+import time
 
 from langchain_core.language_models import LLM
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, AutoConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteriaList
 import torch
 import threading
 
@@ -24,14 +26,13 @@ except Exception:
 #     except Exception:
 #         _cpu_offload = None
 
-try:
-    from accelerate import init_empty_weights, load_checkpoint_and_dispatch
-except Exception:
-    init_empty_weights = None
-    load_checkpoint_and_dispatch = None
-
 from utils import timeit
 from utils import setup_logging
+from utils.generation import CancelCriteria, IncrementalTextStreamer, StopSequenceCriteria, stop_at
+from utils.generation.loading import checkpoint_shards, read_manifest, resolve_artifact
+
+from .offload import load_offloaded
+from .quantization import bnb_config, load_cpu_int8, model_memory_bytes
 
 LOGGER = setup_logging(app_name='qwen-inference', to_stdout=True, retention=30)
 LOGGER.info("VERSIONS torch=%s accelerate=%s",
@@ -49,7 +50,8 @@ def _primary_device_of(model: torch.nn.Module) -> torch.device:
 class QwenInferenceLLM(LLM):
 
     def __init__(self, model_path:Path, tokenizer_path:Path, temperature:float,
-                 top_p:float, max_tokens:int, offload_folder:Path):
+                 top_p:float, max_tokens:int, offload_folder:Path, prompt_lookup_num_tokens:int = 10,
+                 tokenizer=None, memory_fraction:float = 1.0):
 
         super().__init__()
 
@@ -62,8 +64,9 @@ class QwenInferenceLLM(LLM):
         dtype = torch.bfloat16 if os.getenv('TORCH_DTYPE', 'bf16').lower() in ("bf16","bfloat16") else torch.float16
 
         # Memory budget
-        per_gpu_gib = int(os.getenv('MAX_VRAM_PER_GPU', '45'))
-        cpu_gib = int(os.getenv('CPU_RAM_BUDGET_GIB', '180'))
+        # memory_fraction < 1: several models share the budget of one server
+        per_gpu_gib = max(1, int(int(os.getenv('MAX_VRAM_PER_GPU', '45')) * memory_fraction))
+        cpu_gib = max(1, int(int(os.getenv('CPU_RAM_BUDGET_GIB', '180')) * memory_fraction))
 
         # device_map + max_memory construct
         n_gpu = torch.cuda.device_count()
@@ -73,20 +76,29 @@ class QwenInferenceLLM(LLM):
         os.makedirs(offload_folder, exist_ok=True)
 
         # ------------------ Quantization --------------------------
-        nb_config = None
-        load_kwargs = {}
-        if use_4bit:
-            pass
-        elif use_8bit:
-            pass
-        else:
-            load_kwargs['dtype'] = dtype
+        # GPU: bitsandbytes NF4 / LLM.int8, CPU-only: torch dynamic int8 (4-bit has no CPU kernel)
+        quantization = '4bit' if use_4bit else '8bit' if use_8bit else None
+        load_kwargs = {'dtype': dtype}
+        if quantization and n_gpu > 0:
+            load_kwargs['quantization_config'] = bnb_config(4 if use_4bit else 8, dtype)
+        elif quantization:
+            if use_4bit:
+                LOGGER.warning("LOAD_IN_4BIT needs CUDA (bitsandbytes), using dynamic int8 on CPU instead")
+            quantization = 'cpu-int8'
+
+        # Converted artifact (utils.generation.convert) next to the checkpoint,
+        # bitsandbytes quantizes from the original weights and skips int8 artifacts
+        artifact = resolve_artifact(model_path)
+        manifest = read_manifest(artifact)
+        if manifest is not None and not (manifest.get('quantization') and 'quantization_config' in load_kwargs):
+            model_id = str(artifact)
 
         # Full model downloaded already make sure to only local processing
         local_only = os.getenv('HF_LOCAL_ONLY', 'true').lower() == 'true'
 
-        # Tokenizer
-        tokenizer = AutoTokenizer.from_pretrained(tok_id, local_files_only=local_only, use_fast=True, trust_remote_code=True,)
+        # Tokenizer (can be shared between checkpoints of the same family)
+        if tokenizer is None:
+            tokenizer = AutoTokenizer.from_pretrained(tok_id, local_files_only=local_only, use_fast=True, trust_remote_code=True,)
 
         # Model with offload
         # model = AutoModelForCausalLM.from_pretrained(model_id, local_files_only=local_only, device_map='cpu',
@@ -94,26 +106,22 @@ class QwenInferenceLLM(LLM):
         # model.to('cpu')
         # model.eval()
 
-        if load_checkpoint_and_dispatch and init_empty_weights and ACC_VERSION >= version.parse('0.26.0'):
-            config = AutoConfig.from_pretrained(model_id, trust_remote_code=True)
-            with init_empty_weights():
-                model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, **load_kwargs)
-
-            # qwen classes are named differently depending on release (few candidates)
-            no_split = ["Qwen2DecoderLayer", "QwenBlock", "TransformerLayer", "Block"]
-
-            model = load_checkpoint_and_dispatch(
-                model,
-                model_id,
-                device_map={'': 'cpu'},
-                no_split_module_classes=no_split,
-                dtype=load_kwargs.get('dtype', None),
-                offload_folder=str(offload_folder),
-                offload_state_dict=True,
-                max_memory=max_memory,
-                sequential_cpu_offload=True
+        # Layers beyond the GPU budget run from a persistent, fingerprinted offload cache with prefetching
+        load_start = time.perf_counter()
+        prefetcher = None
+        if quantization == 'cpu-int8':
+            model, load_report = load_cpu_int8(Path(model_id), dtype=dtype, local_files_only=local_only)
+
+        elif n_gpu > 0 and quantization is None and checkpoint_shards(Path(model_id)):
+            model, load_report, prefetcher = load_offloaded(
+                Path(model_id),
+                dtype=dtype,
+                gpu_gib=per_gpu_gib,
+                cpu_gib=cpu_gib,
+                cache_root=Path(offload_folder),
+                trust_remote_code=True,
+                local_files_only=local_only
             )
-            model.eval()
 
         else:
             model = AutoModelForCausalLM.from_pretrained(
@@ -139,11 +147,17 @@ class QwenInferenceLLM(LLM):
         #         except TypeError:
         #             _cpu_offload(model, 0)
 
+        load_s = time.perf_counter() - load_start
+
         object.__setattr__(self, "_model", model)
+        object.__setattr__(self, "_prefetcher", prefetcher)
+        # the prefetch hooks swap the weights of shared layers on every forward: one generation at a time
+        object.__setattr__(self, "_generate_lock", threading.Lock() if prefetcher is not None else nullcontext())
         object.__setattr__(self, "_tokenizer", tokenizer)
         object.__setattr__(self, "_temperature", temperature)
         object.__setattr__(self, "_top_p", top_p)
         object.__setattr__(self, "_max_tokens", max_tokens)
+        object.__setattr__(self, "_prompt_lookup_tokens", int(prompt_lookup_num_tokens))
 
         object.__setattr__(self, "_systemmessage", {
             'role': 'system', 'content':'Du bist ein präziser, detailorientierter medizinischer Schreibassistent.'
@@ -156,12 +170,40 @@ class QwenInferenceLLM(LLM):
         except Exception as e:
             LOGGER.warning(f"Could not infer primary device: {e}")
 
+        object.__setattr__(self, "_load_stats", {
+            'quantization': quantization or str(dtype).replace('torch.', ''),
+            'memory_gib': round(model_memory_bytes(model) / 2**30, 2),
+            'load_s': round(load_s, 1),
+            'tokens_per_s': self._benchmark(int(os.getenv('STARTUP_BENCH_TOKENS', '16'))),
+        })
+        LOGGER.info(f"Startup report {Path(model_id).name}: {self._load_stats}")
+
+
+    def _benchmark(self, n_tokens: int) -> Optional[float]:
+        """ greedy decode of exactly n_tokens (incl. prefill of a short prompt), 0 skips it """
+        if n_tokens <= 0:
+            return None
+        inputs = self._build_inputs('Fasse den Befund kurz zusammen: Kniegelenkserguss rechts, keine Fraktur.', None)
+        begin = time.perf_counter()
+        with torch.no_grad():
+            self._model.generate(**inputs, max_new_tokens=n_tokens, min_new_tokens=n_tokens, do_sample=False,
+                                 pad_token_id=self._tokenizer.eos_token_id)
+        return round(n_tokens / (time.perf_counter() - begin), 2)
+
+
+    def load_stats(self) -> dict:
+        return dict(self._load_stats)
+
 
     @property
     def _llm_type(self) -> str:
         return 'qwen-inference'
 
 
+    def offload_stats(self) -> Optional[dict]:
+        return None if self._prefetcher is None else self._prefetcher.stats()
+
+
     def _effective_params(self, temperature:Optional[float], top_p:Optional[float], max_tokens:Optional[int]):
         """ helper function for _call and stream """
         temp = self._temperature if temperature is None else float(temperature)
@@ -178,10 +220,13 @@ class QwenInferenceLLM(LLM):
             messages, add_generation_prompt=True,
             tokenize=True, return_dict=True,return_tensors='pt'
         )
-        return inputs
+        return inputs.to(_primary_device_of(self._model))
 
 
-    def _gen_kwargs(self, inputs, max_new: int, temp: float, nucleus: float, do_sample: bool, *, streamer=None):
+    def _gen_kwargs(self, inputs, max_new: int, temp: float, nucleus: float, do_sample: bool, *, streamer=None,
+                    prompt_lookup: bool = False, stopping_criteria=None):
+        # prompt lookup drafting only for greedy decoding, where the output stays identical
+        lookup = prompt_lookup and not do_sample and self._prompt_lookup_tokens > 0
         return dict(
             **inputs,
             max_new_tokens=max_new,
@@ -191,31 +236,40 @@ class QwenInferenceLLM(LLM):
             use_cache=True,
             pad_token_id=self._tokenizer.eos_token_id,
             eos_token_id=self._tokenizer.eos_token_id,
-            **({"streamer": streamer} if streamer is not None else {})
+            **({"streamer": streamer} if streamer is not None else {}),
+            **({"prompt_lookup_num_tokens": self._prompt_lookup_tokens} if lookup else {}),
+            **({"stopping_criteria": StoppingCriteriaList(stopping_criteria)} if stopping_criteria else {})
         )
 
 
     def _stream_chunks(self, prompt: str, system_prompt: Optional[str],
-            *, temperature: Optional[float], top_p: Optional[float], max_tokens: Optional[int]) -> Iterator[str]:
+            *, temperature: Optional[float], top_p: Optional[float], max_tokens: Optional[int],
+            prompt_lookup: bool = False, stop: Optional[List[str]] = None) -> Iterator[str]:
         temp, nucleus, max_new, do_sample = self._effective_params(temperature, top_p, max_tokens)
-        LOGGER.info(f"Sampling: max_new_tokens={max_new}, temperature={temp}, top_p={nucleus}")
+        LOGGER.info(f"Sampling: max_new_tokens={max_new}, temperature={temp}, top_p={nucleus}, prompt_lookup={prompt_lookup}")
         inputs = self._build_inputs(prompt, system_prompt)
 
-        streamer = TextIteratorStreamer(
-            self._tokenizer, skip_prompt=True, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )
-        generate_kwargs = self._gen_kwargs(inputs, max_new, temp, nucleus, do_sample, streamer=streamer)
+        streamer = IncrementalTextStreamer(self._tokenizer, skip_prompt=True, skip_special_tokens=True)
+        # set when the consumer stops iterating (client disconnected), generate() ends at the next step
+        cancel = CancelCriteria()
+        criteria = [cancel]
+        if stop:
+            # ends decoding at the first stop string instead of running to max_new_tokens
+            criteria.append(StopSequenceCriteria(self._tokenizer, stop, inputs['input_ids'].shape[-1]))
+        generate_kwargs = self._gen_kwargs(inputs, max_new, temp, nucleus, do_sample, streamer=streamer,
+                                           prompt_lookup=prompt_lookup, stopping_criteria=criteria)
 
         err_q: Queue[BaseException] = Queue(maxsize=1)
         def _worker():
             try:
-                with torch.no_grad():
+                with self._generate_lock, torch.no_grad():
                     self._model.generate(**generate_kwargs)
             except BaseException as e:
                 err_q.put(e)
 
         t = threading.Thread(target=_worker, daemon=True)
         t.start()
+        chunks = stop_at(streamer, stop)
         try:
             while True:
                 try:
@@ -224,7 +278,7 @@ class QwenInferenceLLM(LLM):
                 except Empty:
                     pass
 
-                chunk = next(streamer, None)
+                chunk = next(chunks, None)
                 if chunk is None:
                     break
                 if chunk:
@@ -237,18 +291,21 @@ class QwenInferenceLLM(LLM):
                 pass
 
         finally:
+            cancel.cancel()
             t.join(timeout=0.1)
 
 
     @timeit
     def _call(
         self, prompt:str, system_prompt:Optional[str]=None, stop:Optional[List[str]]=None,
-        *, temperature:Optional[float]=None, top_p:Optional[float]=None, max_tokens:Optional[int]=None
+        *, temperature:Optional[float]=None, top_p:Optional[float]=None, max_tokens:Optional[int]=None,
+        prompt_lookup:bool=False
     ) -> str:
 
         parts = []
         for chunk in self._stream_chunks(
-            prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens
+            prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens,
+            prompt_lookup=prompt_lookup, stop=stop
         ):
             parts.append(chunk)
         return "".join(parts)
@@ -256,13 +313,17 @@ class QwenInferenceLLM(LLM):
 
     def invoke(self, prompt: str, system_prompt: Optional[str] = None,
                *, temperature: Optional[float] = None, top_p: Optional[float] = None,
-               max_tokens: Optional[int] = None) -> str:
-        return self._call(prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+               max_tokens: Optional[int] = None, prompt_lookup: bool = False,
+               stop: Optional[List[str]] = None) -> str:
+        return self._call(prompt, system_prompt, stop, temperature=temperature, top_p=top_p, max_tokens=max_tokens,
+                          prompt_lookup=prompt_lookup)
 
 
     @timeit
     def stream(self, prompt:str, system_prompt:Optional[str]=None,
-               *, temperature:Optional[float]=None, top_p:Optional[float]=None, max_tokens:Optional[int]=None) -> Iterator[str]:
+               *, temperature:Optional[float]=None, top_p:Optional[float]=None, max_tokens:Optional[int]=None,
+               prompt_lookup:bool=False, stop:Optional[List[str]]=None) -> Iterator[str]:
         yield from self._stream_chunks(
-            prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens
+            prompt, system_prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens,
+            prompt_lookup=prompt_lookup, stop=stop
         )
\ No newline at end of file
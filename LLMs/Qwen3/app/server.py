@@ -1,33 +1,84 @@
-from typing import Optional, Generator
+from typing import Optional, List, Generator
 from pathlib import Path
 import os
 import json
 
 from pydantic import BaseModel
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from app import QwenInferenceLLM
 from utils import setup_logging
+from utils import ResponseCache, ModelLoader, warm_up
+from utils.prompts import SystemPromptRegistry, system_prompts_router, with_system_prompt
 
 LOGGER = setup_logging(app_name='qwen-inference', to_stdout=True, retention=30)
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 # Paths can be set in .env
 model_dir = Path(os.getenv('MODEL_DIR') or (BASE_DIR / 'model_inference'))
+thinking_dir = Path(os.getenv('THINKING_MODEL_DIR') or (BASE_DIR / 'model_thinking'))
 token_dir = Path(os.getenv("TOKEN_DIR", str(model_dir)))
 offload_dir = Path(os.getenv("OFFLOAD_FOLDER") or (BASE_DIR / "offload"))
 offload_dir.mkdir(parents=True, exist_ok=True)
+prompt_lookup_tokens = int(os.getenv("PROMPT_LOOKUP_NUM_TOKENS", "10"))
+# share of MAX_VRAM_PER_GPU / CPU_RAM_BUDGET_GIB for the thinking checkpoint when both are hosted
+thinking_memory_fraction = float(os.getenv("THINKING_MEMORY_FRACTION", "0.5"))
+host_thinking = (os.getenv("QWEN_HOST_THINKING", "true").lower() == "true"
+                 and (thinking_dir / "config.json").exists() and thinking_dir != model_dir)
+load_timeout = float(os.getenv("MODEL_LOAD_TIMEOUT_S", "600"))
 
 
-llm = QwenInferenceLLM(
-    model_path=model_dir,
-    tokenizer_path=token_dir,
-    temperature=0.8,
-    top_p=0.9,
-    max_tokens=200,
-    offload_folder=offload_dir
-)
+def load_models(progress) -> tuple[QwenInferenceLLM, Optional[QwenInferenceLLM]]:
+    progress(f"loading {model_dir.name}", 0.0)
+    llm = QwenInferenceLLM(
+        model_path=model_dir,
+        tokenizer_path=token_dir,
+        temperature=0.8,
+        top_p=0.9,
+        max_tokens=200,
+        offload_folder=offload_dir / "inference" if host_thinking else offload_dir,
+        prompt_lookup_num_tokens=prompt_lookup_tokens,
+        memory_fraction=1.0 - thinking_memory_fraction if host_thinking else 1.0
+    )
+
+    # Reasoning checkpoint next to the instruct one, same tokenizer and offload settings
+    thinking_llm = None
+    if host_thinking:
+        LOGGER.info(f"Hosting thinking model from {thinking_dir}")
+        progress(f"loading {thinking_dir.name}", 0.5)
+        thinking_llm = QwenInferenceLLM(
+            model_path=thinking_dir,
+            tokenizer_path=token_dir,
+            temperature=0.6,
+            top_p=0.95,
+            max_tokens=200,
+            offload_folder=offload_dir / "thinking",
+            prompt_lookup_num_tokens=prompt_lookup_tokens,
+            tokenizer=llm._tokenizer,
+            memory_fraction=thinking_memory_fraction
+        )
+    return llm, thinking_llm
+
+
+def warm_models(models, progress):
+    for target in models:
+        if target is not None:
+            warm_up(lambda sample, max_tokens: target.stream(
+                prompt=sample["prompt"],
+                system_prompt=sample["system_prompt"],
+                temperature=sample.get("temperature"),
+                max_tokens=max_tokens,
+                prompt_lookup=sample["prompt_lookup"]
+            ), progress)
+
+
+system_prompts = SystemPromptRegistry.from_env()
+
+# the port binds right away, requests wait for the models up to MODEL_LOAD_TIMEOUT_S
+loader = ModelLoader(load_models, warm_models, name="Qwen3").start()
+
+response_cache = ResponseCache.from_env()
 
 app = FastAPI(
     docs_url=None,
@@ -38,24 +89,63 @@ app = FastAPI(
 class PromptRequest(BaseModel):
     prompt: str
     system_prompt: Optional[str] = None
+    system_prompt_id: Optional[str] = None
     temperature: Optional[float] = None
     top_p: Optional[float] = None
     max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    prompt_lookup: Optional[bool] = False
+    disable_think: Optional[bool] = False
 
 
 class ConfigOut(BaseModel):
     model: str = 'Qwen3'
     defaults: dict
+    models: Optional[dict] = None
+
+
+def route(request: PromptRequest) -> tuple[QwenInferenceLLM, Path]:
+    """ non-thinking checkpoint whenever reasoning is not wanted (disable_think, set by `reasoning: false` prompts) """
+    try:
+        llm, thinking_llm = loader.get(load_timeout)
+    except (TimeoutError, RuntimeError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if thinking_llm is None or request.disable_think:
+        return llm, model_dir
+    return thinking_llm, thinking_dir
+
+
+def strip_reasoning(text: str) -> str:
+    # the thinking template opens <think> in the prompt, only the closing tag shows up in the output
+    return text.split("</think>")[-1].strip() if "</think>" in text else text
+
+
+def cache_key(request: PromptRequest, path: Path) -> Optional[str]:
+    temperature = (0.6 if path == thinking_dir else 0.8) if request.temperature is None else request.temperature
+    return response_cache.key(str(path), temperature, request.model_dump(exclude={"prompt_lookup"}))
 
 
 @app.post("/generate")
 def generate_text(request:PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    target, path = route(request)
     try:
-        response = llm.invoke(prompt=request.prompt,
+        key = cache_key(request, path)
+        cached = response_cache.get(key)
+        if cached is not None:
+            return {"response": cached, "cached": True}
+
+        LOGGER.info(f"Routing request to {path.name}")
+        response = target.invoke(prompt=request.prompt,
                             system_prompt=request.system_prompt,
                             temperature=request.temperature,
                             top_p=request.top_p,
-                            max_tokens=request.max_tokens)
+                            max_tokens=request.max_tokens,
+                            stop=request.stop,
+                            prompt_lookup=bool(request.prompt_lookup))
+        if path == thinking_dir:
+            response = strip_reasoning(response)
+        response_cache.put(key, response)
         return {"response": response}
     except Exception as e:
         LOGGER.error('Fehler beim /generate')
@@ -65,11 +155,29 @@ def generate_text(request:PromptRequest):
 def get_config() -> ConfigOut:
     return ConfigOut(
         defaults={
-            'temperature':llm._temperature,
-            'top_p':llm._top_p,
-            'max_tokens':llm._max_tokens,
+            'temperature':0.8,
+            'top_p':0.9,
+            'max_tokens':200,
+        },
+        models={
+            'inference': model_dir.name,
+            'thinking': thinking_dir.name if host_thinking else None,
         }
     )
+app.include_router(system_prompts_router(system_prompts))
+
 @app.get('/health')
 def health():
-    return {'status': 'ok'}
\ No newline at end of file
+    # always 200 while the process is up, 'status' is loading/warming/ready/failed
+    status = {**loader.status(), 'response_cache': response_cache.stats()}
+    if loader.model is not None:
+        status['models'] = {path.name: target.load_stats()
+                            for target, path in zip(loader.model, (model_dir, thinking_dir)) if target is not None}
+        status['offload'] = {path.name: target.offload_stats()
+                             for target, path in zip(loader.model, (model_dir, thinking_dir)) if target is not None}
+    return status
+
+@app.get('/ready')
+def ready():
+    # 503 until both checkpoints are loaded and warmed up
+    return JSONResponse(loader.status(), status_code=200 if loader.ready else 503)
\ No newline at end of file
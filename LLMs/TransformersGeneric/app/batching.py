@@ -0,0 +1,331 @@
+from typing import Optional, Iterator, Iterable
+from queue import Queue, Empty
+import threading
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+_DONE = object()
+_STOP = object()
+
+
+class GenerationRequest:
+    """ One sequence inside the running decode batch """
+
+    def __init__(self, input_ids: torch.Tensor, *, max_new_tokens: int, temperature: float,
+                 top_p: float, do_sample: bool, eos_token_ids: Iterable[int], prefix_len: int = 0,
+                 logits_processor=None):
+        self.input_ids = input_ids.reshape(-1)
+        self.prefix_len = int(prefix_len)
+        self.max_new_tokens = int(max_new_tokens)
+        self.temperature = float(temperature)
+        self.top_p = float(top_p)
+        self.do_sample = bool(do_sample)
+        self.eos_token_ids = set(eos_token_ids)
+        self.logits_processor = logits_processor
+
+        self.generated: list[int] = []
+        self.position = 0
+        self.next_token: Optional[int] = None
+        self.finished = False
+
+        self._queue: Queue = Queue()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def token_ids(self) -> Iterator[int]:
+        """ blocking iterator over the token ids produced for this request """
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def _emit(self, token_id: int):
+        self.generated.append(token_id)
+        self._queue.put(token_id)
+
+        if token_id in self.eos_token_ids or len(self.generated) >= self.max_new_tokens:
+            self._finish()
+
+    def _finish(self, error: Optional[BaseException] = None):
+        if self.finished:
+            return
+        self.finished = True
+        if error is not None:
+            self._queue.put(error)
+        self._queue.put(_DONE)
+
+
+def cache_to_layers(cache) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    if hasattr(cache, "to_legacy_cache"):
+        return list(cache.to_legacy_cache())
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return [tuple(layer) for layer in cache]
+
+
+def layers_to_cache(layers: list[tuple[torch.Tensor, torch.Tensor]]) -> DynamicCache:
+    cache = DynamicCache()
+    for idx, (key, value) in enumerate(layers):
+        cache.update(key, value, idx)
+    return cache
+
+
+def _left_pad(t: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - t.shape[dim]
+    if missing <= 0:
+        return t
+    # F.pad counts dimensions from the back, two entries per dimension
+    pad = [0, 0] * (t.dim() - dim - 1) + [missing, 0]
+    return F.pad(t, pad)
+
+
+def sample_next_token(logits: torch.Tensor, temperature: float, top_p: float, do_sample: bool) -> int:
+    """ greedy or temperature/top-p sampling for one row of logits """
+    if not do_sample:
+        return int(torch.argmax(logits, dim=-1))
+
+    probs = torch.softmax(logits.float() / max(temperature, 1e-5), dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_idx = torch.sort(probs, descending=True)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+        # keep the smallest set whose cumulative mass reaches top_p (always at least one token)
+        sorted_probs[(cumulative - sorted_probs) > top_p] = 0.0
+        probs = torch.zeros_like(probs).scatter_(-1, sorted_idx, sorted_probs)
+
+    return int(torch.multinomial(probs, num_samples=1))
+
+
+def _next_token(request: GenerationRequest, logits: torch.Tensor) -> int:
+    if request.logits_processor is not None:
+        generated = torch.tensor(request.generated, dtype=torch.long)
+        ids = torch.cat([request.input_ids.cpu(), generated]).to(logits.device).unsqueeze(0)
+        # logits come out of inference_mode, in-place updates are only allowed inside it
+        with torch.inference_mode():
+            logits = request.logits_processor(ids, logits.unsqueeze(0))[0]
+    return sample_next_token(logits, request.temperature, request.top_p, request.do_sample)
+
+
+class ContinuousBatchScheduler:
+    """
+    Iteration-level batching: new requests are prefilled and merged into the running
+    decode batch between steps, finished sequences leave the batch immediately.
+
+    The KV cache of the batch is kept left-padded to a common length, padding is
+    masked out via the attention mask and every sequence carries its own position ids.
+    """
+
+    def __init__(self, model, max_batch_size: int = 8, prefix_cache=None, lock: Optional[threading.Lock] = None):
+        self._model = model
+        self._prefix_cache = prefix_cache
+        # held around every forward, shared with callers that run the model outside the batch
+        self._lock = lock or threading.Lock()
+        self._max_batch_size = max(1, int(max_batch_size))
+
+        self._waiting: Queue[GenerationRequest] = Queue()
+        self._active: list[GenerationRequest] = []
+        self._layers: Optional[list[tuple[torch.Tensor, torch.Tensor]]] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._closed = threading.Event()
+
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+        LOGGER.info(f"Continuous batching enabled: max_batch_size={self._max_batch_size}")
+
+    @property
+    def max_batch_size(self) -> int:
+        return self._max_batch_size
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        if self._closed.is_set():
+            request._finish(RuntimeError("Batch scheduler is shut down"))
+            return request
+        self._waiting.put(request)
+        return request
+
+    def close(self, timeout: Optional[float] = None):
+        """ stops the scheduler thread so the model can be freed, unfinished requests fail """
+        self._closed.set()
+        self._waiting.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._active),
+            "waiting": self._waiting.qsize(),
+            "max_batch_size": self._max_batch_size,
+        }
+
+    # ------------------------------------------------------------------ loop
+
+    def _loop(self):
+        while not self._closed.is_set():
+            if not self._active:
+                # idle: block until work arrives
+                self._try_admit(self._waiting.get())
+
+            while len(self._active) < self._max_batch_size:
+                try:
+                    request = self._waiting.get_nowait()
+                except Empty:
+                    break
+                self._try_admit(request)
+
+            if self._active:
+                try:
+                    with self._lock:
+                        self._step()
+                except Exception as exc:
+                    LOGGER.exception("Decode step failed, aborting active batch")
+                    for request in self._active:
+                        request._finish(exc)
+                    self._reset()
+
+        error = RuntimeError("Batch scheduler is shut down")
+        for request in self._active:
+            request._finish(error)
+        self._reset()
+        while True:
+            try:
+                request = self._waiting.get_nowait()
+            except Empty:
+                break
+            if request is not _STOP:
+                request._finish(error)
+        LOGGER.info("Continuous batching stopped")
+
+    def _reset(self):
+        self._active = []
+        self._layers = None
+        self._attention_mask = None
+
+    def _try_admit(self, request: GenerationRequest):
+        if request is _STOP:
+            return
+        if request.cancelled:
+            request._finish()
+            return
+        try:
+            with self._lock:
+                self._admit(request)
+        except Exception as exc:
+            LOGGER.exception("Prefill failed")
+            request._finish(exc)
+
+    # --------------------------------------------------------------- prefill
+
+    def _admit(self, request: GenerationRequest):
+        device = self._model.device
+        input_ids = request.input_ids.to(device).unsqueeze(0)
+
+        prefix_len = request.prefix_len if self._prefix_cache is not None else 0
+
+        with torch.inference_mode():
+            if prefix_len:
+                prefix = tuple(request.input_ids[:prefix_len].tolist())
+                past = layers_to_cache(self._prefix_cache.prefill(self._model, prefix))
+                out = self._model(input_ids=input_ids[:, prefix_len:], past_key_values=past, use_cache=True)
+            else:
+                out = self._model(input_ids=input_ids, use_cache=True)
+
+        token = _next_token(request, out.logits[0, -1, :])
+        request.position = input_ids.shape[-1]
+        request.next_token = token
+        request._emit(token)
+
+        if request.finished:
+            return
+
+        self._merge(cache_to_layers(out.past_key_values), input_ids.shape[-1], device)
+        self._active.append(request)
+
+    def _merge(self, layers, prompt_len: int, device):
+        mask = torch.ones((1, prompt_len), dtype=torch.long, device=device)
+
+        if self._layers is None:
+            self._layers = layers
+            self._attention_mask = mask
+            return
+
+        length = max(self._attention_mask.shape[1], prompt_len)
+        self._layers = [
+            (
+                torch.cat([_left_pad(bk, length, 2), _left_pad(nk, length, 2)], dim=0),
+                torch.cat([_left_pad(bv, length, 2), _left_pad(nv, length, 2)], dim=0),
+            )
+            for (bk, bv), (nk, nv) in zip(self._layers, layers)
+        ]
+        self._attention_mask = torch.cat(
+            [_left_pad(self._attention_mask, length, 1), _left_pad(mask, length, 1)], dim=0
+        )
+
+    # ---------------------------------------------------------------- decode
+
+    def _step(self):
+        device = self._model.device
+        batch = self._active
+
+        input_ids = torch.tensor([[r.next_token] for r in batch], dtype=torch.long, device=device)
+        position_ids = torch.tensor([[r.position] for r in batch], dtype=torch.long, device=device)
+        attention_mask = torch.cat(
+            [self._attention_mask, torch.ones((len(batch), 1), dtype=torch.long, device=device)], dim=1
+        )
+
+        with torch.inference_mode():
+            out = self._model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=layers_to_cache(self._layers),
+                use_cache=True,
+            )
+
+        self._layers = cache_to_layers(out.past_key_values)
+        self._attention_mask = attention_mask
+
+        logits = out.logits[:, -1, :]
+        for row, request in enumerate(batch):
+            if request.cancelled:
+                request._finish()
+                continue
+            token = _next_token(request, logits[row])
+            request.position += 1
+            request.next_token = token
+            request._emit(token)
+
+        self._retire()
+
+    def _retire(self):
+        keep = [i for i, r in enumerate(self._active) if not r.finished]
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self._attention_mask.device)
+        mask = self._attention_mask.index_select(0, index)
+
+        # drop leading columns that are padding for every remaining sequence
+        offset = int((mask.sum(dim=0) > 0).long().argmax())
+
+        self._attention_mask = mask[:, offset:]
+        self._layers = [
+            (k.index_select(0, index.to(k.device))[:, :, offset:], v.index_select(0, index.to(v.device))[:, :, offset:])
+            for k, v in self._layers
+        ]
+        self._active = [self._active[i] for i in keep]
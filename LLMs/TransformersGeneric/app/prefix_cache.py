@@ -0,0 +1,106 @@
+from typing import Optional
+from collections import OrderedDict
+import threading
+
+import torch
+
+from utils import get_logger
+
+from .batching import cache_to_layers
+
+LOGGER = get_logger(__name__)
+
+Layers = list[tuple[torch.Tensor, torch.Tensor]]
+
+
+def _nbytes(layers: Layers) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+def common_prefix_len(a: list[int], b: list[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixCache:
+    """
+    LRU cache of past_key_values for shared prompt prefixes (rendered system prompts).
+
+    Keys are the exact prefix token ids. KV entries of a causal model only depend on the
+    tokens up to their position, so any common token prefix can be reused verbatim.
+    Stored tensors are never modified: the model's cache update concatenates new tensors.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int = 8, min_tokens: int = 32):
+        self._max_bytes = int(max_bytes)
+        self._max_entries = max(1, int(max_entries))
+        self._min_tokens = int(min_tokens)
+
+        self._entries: OrderedDict[tuple[int, ...], Layers] = OrderedDict()
+        self._sizes: dict[tuple[int, ...], int] = {}
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+        LOGGER.info(f"Prefix cache enabled: budget={self._max_bytes / 2**20:.0f} MiB, entries={self._max_entries}")
+
+    @property
+    def min_tokens(self) -> int:
+        return self._min_tokens
+
+    def get(self, prefix_ids: tuple[int, ...]) -> Optional[Layers]:
+        with self._lock:
+            layers = self._entries.get(prefix_ids)
+            if layers is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(prefix_ids)
+            self._hits += 1
+            return layers
+
+    def put(self, prefix_ids: tuple[int, ...], layers: Layers):
+        size = _nbytes(layers)
+        if size > self._max_bytes:
+            LOGGER.warning(f"Prefix of {len(prefix_ids)} tokens ({size / 2**20:.1f} MiB) exceeds cache budget")
+            return
+
+        with self._lock:
+            if prefix_ids in self._entries:
+                self._entries.move_to_end(prefix_ids)
+                return
+
+            self._entries[prefix_ids] = layers
+            self._sizes[prefix_ids] = size
+            self._bytes += size
+
+            while self._bytes > self._max_bytes or len(self._entries) > self._max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._bytes -= self._sizes.pop(evicted)
+
+    def prefill(self, model, prefix_ids: tuple[int, ...]) -> Layers:
+        """ returns the KV cache for prefix_ids, computing and storing it on a miss """
+        layers = self.get(prefix_ids)
+        if layers is not None:
+            return layers
+
+        input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=model.device)
+        with torch.inference_mode():
+            out = model(input_ids=input_ids, use_cache=True)
+
+        layers = cache_to_layers(out.past_key_values)
+        self.put(prefix_ids, layers)
+        return layers
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
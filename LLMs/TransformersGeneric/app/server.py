@@ -1,31 +1,73 @@
-from typing import Optional, Generator
+from typing import Optional, List, Generator, AsyncGenerator
 import os
 import json
 
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
 from app import TransformersLLM
+from utils import AsyncEngine, ModelLoader, ReplicaPool, ResponseCache, replica_count, request_key, warm_up
+from utils.prompts import SystemPromptRegistry, system_prompts_router, with_system_prompt
 
 MODEL_ID = os.getenv("MODEL_ID", "/models/current")
 MODEL_NAME = os.getenv("MODEL_NAME", "TransformersModel")
+DRAFT_MODEL_ID = os.getenv("DRAFT_MODEL_ID") or None
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.8"))
 TOP_P = float(os.getenv("TOP_P", "0.9"))
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "512"))
 TORCH_DTYPE = os.getenv("TORCH_DTYPE", "bfloat16")
 TRUST_REMOTE_CODE = os.getenv("TRUST_REMOTE_CODE", "true").lower() == "true"
 HF_LOCAL_ONLY = os.getenv("HF_LOCAL_ONLY", "true").lower() == "true"
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1"))
+PREFIX_CACHE_MB = int(os.getenv("PREFIX_CACHE_MB", "0"))
+PREFIX_CACHE_ENTRIES = int(os.getenv("PREFIX_CACHE_ENTRIES", "8"))
+PROMPT_LOOKUP_NUM_TOKENS = int(os.getenv("PROMPT_LOOKUP_NUM_TOKENS", "10"))
+CPU_REPLICAS = replica_count()
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", str(max(1, MAX_BATCH_SIZE, CPU_REPLICAS))))
+ENGINE_MAX_PENDING = int(os.getenv("ENGINE_MAX_PENDING", "1024"))
+MODEL_LOAD_TIMEOUT_S = float(os.getenv("MODEL_LOAD_TIMEOUT_S", "600"))
 
-llm = TransformersLLM(
-    model_id_or_path=MODEL_ID,
-    temperature=TEMPERATURE,
-    top_p=TOP_P,
-    max_tokens=MAX_TOKENS,
-    torch_dtype=TORCH_DTYPE,
-    trust_remote_code=TRUST_REMOTE_CODE,
-    local_files_only=HF_LOCAL_ONLY
-)
+def load_model(progress) -> TransformersLLM:
+    progress(f"loading {MODEL_ID}", 0.0)
+    return TransformersLLM(
+        model_id_or_path=MODEL_ID,
+        temperature=TEMPERATURE,
+        top_p=TOP_P,
+        max_tokens=MAX_TOKENS,
+        torch_dtype=TORCH_DTYPE,
+        trust_remote_code=TRUST_REMOTE_CODE,
+        local_files_only=HF_LOCAL_ONLY,
+        max_batch_size=MAX_BATCH_SIZE,
+        prefix_cache_mb=PREFIX_CACHE_MB,
+        prefix_cache_entries=PREFIX_CACHE_ENTRIES,
+        prompt_lookup_num_tokens=PROMPT_LOOKUP_NUM_TOKENS,
+        draft_model_id_or_path=DRAFT_MODEL_ID,
+        on_progress=progress,
+    )
+
+def warm_model(llm: TransformersLLM, progress):
+    # goes through stream() so the batch scheduler and prompt lookup paths are compiled as well
+    warm_up(lambda sample, max_tokens: llm.stream(
+        prompt=sample["prompt"],
+        system_prompt=sample["system_prompt"],
+        temperature=sample.get("temperature"),
+        max_tokens=max_tokens,
+        prompt_lookup=sample["prompt_lookup"],
+    ), progress)
+
+system_prompts = SystemPromptRegistry.from_env()
+
+# the port binds right away, requests wait for the model up to MODEL_LOAD_TIMEOUT_S
+# CPU_REPLICAS > 1: pinned processes map the same shards, this one only dispatches to them
+if CPU_REPLICAS > 1:
+    os.environ.setdefault("MODEL_LOAD_MMAP", "true")
+    loader = ReplicaPool(load_model, warm_model, name=MODEL_NAME, replicas=CPU_REPLICAS).start()
+else:
+    loader = ModelLoader(load_model, warm_model, name=MODEL_NAME).start()
+
+response_cache = ResponseCache.from_env()
+engine = AsyncEngine(workers=ENGINE_WORKERS, max_pending=ENGINE_MAX_PENDING)
 
 app = FastAPI(
     docs_url=None,
@@ -36,44 +78,82 @@ app = FastAPI(
 class PromptRequest(BaseModel):
     prompt: str
     system_prompt: Optional[str] = None
+    system_prompt_id: Optional[str] = None
     temperature: Optional[float] = None
     top_p: Optional[float] = None
     max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    think_budget: Optional[int] = None
     disable_think: Optional[bool] = False
+    prompt_lookup: Optional[bool] = False
 
 class ConfigOut(BaseModel):
     model: str
     defaults: dict
+    speculative: Optional[dict] = None
 
-@app.post("/generate")
-def generate_text(request: PromptRequest):
-    response = llm.invoke(
+async def ready_llm() -> TransformersLLM:
+    try:
+        return await loader.wait(MODEL_LOAD_TIMEOUT_S)
+    except (TimeoutError, RuntimeError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+def cache_key(request: PromptRequest) -> Optional[str]:
+    temperature = TEMPERATURE if request.temperature is None else request.temperature
+    return request_key(MODEL_NAME, temperature, request.model_dump(exclude={"prompt_lookup"}))
+
+def generate_tokens(llm: TransformersLLM, request: PromptRequest, key: Optional[str]) -> Generator[str, None, None]:
+    parts = []
+    for tok in llm.stream(
         prompt=request.prompt,
         system_prompt=request.system_prompt,
         temperature=request.temperature,
         top_p=request.top_p,
         max_tokens=request.max_tokens,
+        stop=request.stop,
+        think_budget=request.think_budget,
         disable_think=bool(request.disable_think),
-    )
-    return {"response": response}
+        prompt_lookup=bool(request.prompt_lookup),
+    ):
+        if tok:
+            parts.append(tok)
+            yield tok
+
+    response_cache.put(key, "".join(parts))
+
+@app.post("/generate")
+async def generate_text(request: PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    key = cache_key(request)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return {"response": cached.strip(), "cached": True}
+
+    llm = await ready_llm()
+    # deterministic requests (key set) share one generation with identical in-flight requests
+    parts = [tok async for tok in engine.stream(lambda: generate_tokens(llm, request, key), key=key)]
+    return {"response": "".join(parts).strip()}
 
 def sse_event(data: dict) -> str:
     return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 @app.post("/generate_stream")
-def generate_text_stream(request: PromptRequest):
-    def token_generator() -> Generator[bytes, None, None]:
+async def generate_text_stream(request: PromptRequest):
+    request = with_system_prompt(system_prompts, request)
+    key = cache_key(request)
+    cached = response_cache.get(key)
+    # waits (or fails with 503) before the stream starts while the model is still loading
+    llm = await ready_llm() if cached is None else None
+
+    async def token_generator() -> AsyncGenerator[bytes, None]:
+        if cached is not None:
+            yield sse_event({"token": cached}).encode("utf-8")
+            yield sse_event({"finished": True, "cached": True}).encode("utf-8")
+            return
+
         try:
-            for tok in llm.stream(
-                prompt=request.prompt,
-                system_prompt=request.system_prompt,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                max_tokens=request.max_tokens,
-                disable_think=bool(request.disable_think),
-            ):
-                if tok:
-                    yield sse_event({"token": tok}).encode("utf-8")
+            async for tok in engine.stream(lambda: generate_tokens(llm, request, key), key=key):
+                yield sse_event({"token": tok}).encode("utf-8")
 
             yield sse_event({"finished": True}).encode("utf-8")
 
@@ -94,15 +174,46 @@ def generate_text_stream(request: PromptRequest):
 
 @app.get("/config")
 def get_config() -> ConfigOut:
+    llm = loader.model if CPU_REPLICAS == 1 else None
     return ConfigOut(
         model=MODEL_NAME,
         defaults={
-            "temperature": llm._temperature,
-            "top_p": llm._top_p,
-            "max_tokens": llm._max_tokens,
+            "temperature": TEMPERATURE,
+            "top_p": TOP_P,
+            "max_tokens": MAX_TOKENS,
+            "max_batch_size": MAX_BATCH_SIZE,
+        },
+        speculative=None if llm is None or llm._speculative_stats is None else {
+            "draft_model": DRAFT_MODEL_ID,
+            **llm._speculative_stats.summary(),
         },
     )
 
+app.include_router(system_prompts_router(system_prompts))
+
 @app.get("/health")
 def health():
-    return {"status": "ok", "model": MODEL_NAME}
\ No newline at end of file
+    # always 200 while the process is up, "status" is loading/warming/ready/failed
+    status = {
+        **loader.status(),
+        "model": MODEL_NAME,
+        "response_cache": response_cache.stats(),
+        "engine": engine.stats(),
+    }
+    llm = loader.model
+    if llm is not None and CPU_REPLICAS > 1:
+        # the model objects live in the replica processes
+        status["replicas"] = llm.stats()
+        return status
+    if llm is not None:
+        status["load"] = llm._load_report.summary()
+    if llm is not None and llm._scheduler is not None:
+        status["batch"] = llm._scheduler.stats()
+    if llm is not None and llm._prefix_cache is not None:
+        status["prefix_cache"] = llm._prefix_cache.stats()
+    return status
+
+@app.get("/ready")
+def ready():
+    # 503 until the model is loaded and warmed up
+    return JSONResponse(loader.status(), status_code=200 if loader.ready else 503)
\ No newline at end of file
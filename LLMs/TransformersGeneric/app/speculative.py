@@ -0,0 +1,163 @@
+import argparse
+import threading
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+
+class _PassCounter(LogitsProcessor):
+    """
+    Counts one assisted generate() call. The target processes the logits of every drafted
+    position plus one of its own, so the longest input seen during a pass is the drafted length
+    (the draft, when it runs the same processors, never gets that far). The end of a pass is
+    marked by the stopping criteria.
+    """
+
+    def __init__(self, prompt_len: int):
+        self._length = self._longest = int(prompt_len)
+        self.passes: list[tuple[int, int]] = []  # (drafted, added) per target pass
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self._longest = max(self._longest, input_ids.shape[-1])
+        return scores
+
+    def end_pass(self, length: int):
+        self.passes.append((self._longest - self._length, length - self._length))
+        self._length = self._longest = length
+
+
+class _PassEnd(StoppingCriteria):
+    """ never stops, evaluated once after every target pass """
+
+    def __init__(self, counter: _PassCounter):
+        self._counter = counter
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        self._counter.end_pass(input_ids.shape[-1])
+        return torch.zeros((input_ids.shape[0],), dtype=torch.bool, device=input_ids.device)
+
+
+class SpeculativeStats:
+    """
+    Acceptance statistics for assisted generation with a draft model.
+
+    generate() does not report acceptance itself, every call gets its own counting logits
+    processor and stopping criterion instead: a target pass verifies the drafted tokens and
+    adds the accepted ones plus exactly one token of its own. No hooks are installed on the
+    models, concurrent forwards of other requests do not show up in the counts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self._runs = 0
+        self._new_tokens = 0
+        self._target_passes = 0
+        self._proposed = 0
+        self._accepted = 0
+
+    def begin(self, generation_kwargs: dict) -> _PassCounter:
+        """ adds the counters to the logits processors and stopping criteria of one generate() call """
+        counter = _PassCounter(generation_kwargs["input_ids"].shape[-1])
+        processors = generation_kwargs.get("logits_processor") or LogitsProcessorList()
+        processors.append(counter)
+        generation_kwargs["logits_processor"] = processors
+        criteria = generation_kwargs.get("stopping_criteria") or StoppingCriteriaList()
+        criteria.append(_PassEnd(counter))
+        generation_kwargs["stopping_criteria"] = criteria
+        return counter
+
+    def end(self, counter: _PassCounter) -> dict:
+        new_tokens = sum(added for _, added in counter.passes)
+        target_passes = len(counter.passes)
+        proposed = sum(drafted for drafted, _ in counter.passes)
+        accepted = sum(min(max(added - 1, 0), drafted) for drafted, added in counter.passes)
+
+        with self._lock:
+            self._runs += 1
+            self._new_tokens += new_tokens
+            self._target_passes += target_passes
+            self._proposed += proposed
+            self._accepted += accepted
+
+        run = {
+            "new_tokens": new_tokens,
+            "target_passes": target_passes,
+            "proposed": proposed,
+            "accepted": accepted,
+            "acceptance_rate": round(accepted / proposed, 3) if proposed else 0.0,
+        }
+        LOGGER.info(
+            f"Speculative: tokens={run['new_tokens']}, target_passes={target_passes}, "
+            f"proposed={proposed}, accepted={accepted}, acceptance_rate={run['acceptance_rate']}"
+        )
+        return run
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "runs": self._runs,
+                "new_tokens": self._new_tokens,
+                "proposed": self._proposed,
+                "accepted": self._accepted,
+                "acceptance_rate": round(self._accepted / self._proposed, 3) if self._proposed else 0.0,
+                "tokens_per_target_pass": round(self._new_tokens / self._target_passes, 3)
+                if self._target_passes else 0.0,
+            }
+
+
+def _check(runs: int, max_new_tokens: int, seed: int, noise: float):
+    """ greedy decoding with a draft model must produce exactly the tokens of plain greedy decoding """
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+
+    def tiny(layers: int):
+        config = LlamaConfig(vocab_size=512, hidden_size=128, intermediate_size=256, num_hidden_layers=layers,
+                             num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256,
+                             eos_token_id=None, pad_token_id=0)
+        return LlamaForCausalLM(config).eval()
+
+    # a draft that agrees with the target only part of the time: the target's weights with noise added
+    target, draft = tiny(2), tiny(2)
+    with torch.no_grad():
+        for name, param in draft.named_parameters():
+            source = target.get_parameter(name)
+            param.copy_(source + noise * source.std() * torch.randn_like(source))
+    # only here, as a cross-check: every drafted token costs one forward pass of the draft
+    draft_passes = []
+    draft.register_forward_hook(lambda module, args, output: draft_passes.append(1))
+
+    stats = SpeculativeStats()
+    for run in range(runs):
+        input_ids = torch.randint(1, 512, (1, 12))
+        plain_kwargs = {"input_ids": input_ids, "max_new_tokens": max_new_tokens, "do_sample": False}
+        assisted_kwargs = {**plain_kwargs, "assistant_model": draft}
+        with torch.inference_mode():
+            plain = target.generate(**plain_kwargs)
+            draft_passes.clear()
+            counter = stats.begin(assisted_kwargs)
+            assisted = target.generate(**assisted_kwargs)
+        counted = stats.end(counter)
+
+        assert torch.equal(plain, assisted), f"run {run}: assisted output differs\n{plain}\n{assisted}"
+        assert counted["new_tokens"] == assisted.shape[-1] - input_ids.shape[-1], counted
+        assert counted["new_tokens"] == counted["accepted"] + counted["target_passes"], counted
+        assert counted["proposed"] == len(draft_passes), (counted, len(draft_passes))
+    summary = stats.summary()
+    assert summary["accepted"] > 0, f"no draft token was accepted, the check did not verify anything: {summary}"
+    print(f"{runs} runs identical, {summary}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that assisted greedy decoding matches plain greedy decoding")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=48)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--noise", type=float, default=0.05, help="draft weights = target weights + noise * std")
+    args = parser.parse_args()
+    _check(args.runs, args.tokens, args.seed, args.noise)
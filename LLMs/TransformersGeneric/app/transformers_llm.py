@@ -1,4 +1,4 @@
-from typing import Optional, List, ClassVar, Iterator
+from typing import Optional, List, ClassVar, Iterator, Callable
 import threading
 import torch
 
@@ -7,12 +7,25 @@ from langchain_core.language_models import LLM
 from transformers import (
     AutoTokenizer,
     AutoProcessor,
-    AutoModelForCausalLM,
-    TextIteratorStreamer,
+    LogitsProcessorList,
+    StoppingCriteriaList,
 )
 
 from utils import timeit
 from utils import setup_logging
+from utils.generation import (
+    CancelCriteria,
+    IncrementalDetokenizer,
+    IncrementalTextStreamer,
+    StopSequenceCriteria,
+    ThinkingBudgetProcessor,
+    stop_at,
+)
+from utils.generation.loading import load_causal_lm
+
+from .batching import ContinuousBatchScheduler, GenerationRequest, layers_to_cache
+from .prefix_cache import PrefixCache, common_prefix_len
+from .speculative import SpeculativeStats
 
 
 LOGGER = setup_logging(
@@ -35,6 +48,12 @@ class TransformersLLM(LLM):
         torch_dtype: str = "bfloat16",
         trust_remote_code: bool = True,
         local_files_only: bool = True,
+        max_batch_size: int = 1,
+        prefix_cache_mb: int = 0,
+        prefix_cache_entries: int = 8,
+        prompt_lookup_num_tokens: int = 10,
+        draft_model_id_or_path: Optional[str] = None,
+        on_progress: Optional[Callable[[str, float], None]] = None,
     ):
         super().__init__()
 
@@ -45,7 +64,7 @@ class TransformersLLM(LLM):
             "bf16": torch.bfloat16,
             "float32": torch.float32,
             "fp32": torch.float32,
-            "auto": "auto",
+            "auto": None,
         }
 
         dtype = dtype_map.get(torch_dtype.lower(), torch.bfloat16)
@@ -72,30 +91,82 @@ class TransformersLLM(LLM):
             f"Loading model from: {model_id_or_path}, dtype={torch_dtype}, local_files_only={local_files_only}"
         )
 
-        model = AutoModelForCausalLM.from_pretrained(
+        # shards are streamed into the target dtype and spread over the devices like device_map="auto"
+        model, load_report = load_causal_lm(
             model_id_or_path,
-            torch_dtype=dtype,
-            device_map="auto",
+            dtype=dtype,
+            device="auto",
             trust_remote_code=trust_remote_code,
             local_files_only=local_files_only,
+            progress=on_progress,
         )
 
-        model.eval()
+        # Optional small model with a compatible vocabulary for assisted (speculative) generation
+        draft_model = None
+        draft_tokenizer = None
+        speculative_stats = None
+        if draft_model_id_or_path:
+            LOGGER.info(f"Loading draft model from: {draft_model_id_or_path}, dtype={torch_dtype}")
+            draft_model, _ = load_causal_lm(
+                draft_model_id_or_path,
+                dtype=dtype,
+                device="auto",
+                trust_remote_code=trust_remote_code,
+                local_files_only=local_files_only,
+            )
+
+            draft_tokenizer = AutoTokenizer.from_pretrained(
+                draft_model_id_or_path,
+                trust_remote_code=trust_remote_code,
+                local_files_only=local_files_only,
+            )
+            if draft_tokenizer.get_vocab() == tokenizer.get_vocab():
+                draft_tokenizer = None
+            else:
+                # different vocabularies: generate() re-tokenizes the drafts (universal assisted decoding)
+                LOGGER.warning("Draft tokenizer differs from target tokenizer, using universal assisted decoding")
+
+            speculative_stats = SpeculativeStats()
+
+        # KV cache of recent system prompts, only the user part has to be prefilled
+        prefix_cache = None
+        if int(prefix_cache_mb) > 0:
+            prefix_cache = PrefixCache(int(prefix_cache_mb) * 2**20, max_entries=prefix_cache_entries)
+
+        # max_batch_size > 1: requests share the decode loop instead of queueing on the lock,
+        # speculative requests still run generate() under it and pause the batch meanwhile
+        lock = threading.Lock()
+        scheduler = None
+        if int(max_batch_size) > 1:
+            scheduler = ContinuousBatchScheduler(model, max_batch_size, prefix_cache=prefix_cache, lock=lock)
 
         object.__setattr__(self, "model_id_or_path", model_id_or_path)
         object.__setattr__(self, "tokenizer", tokenizer)
         object.__setattr__(self, "processor", processor)
         object.__setattr__(self, "model", model)
+        object.__setattr__(self, "_load_report", load_report)
         object.__setattr__(self, "_temperature", float(temperature))
         object.__setattr__(self, "_top_p", float(top_p))
         object.__setattr__(self, "_max_tokens", int(max_tokens))
         object.__setattr__(self, "_systemmessage", system_message)
-        object.__setattr__(self, "_lock", threading.Lock())
+        object.__setattr__(self, "_lock", lock)
+        object.__setattr__(self, "_scheduler", scheduler)
+        object.__setattr__(self, "_prefix_cache", prefix_cache)
+        object.__setattr__(self, "_prompt_lookup_tokens", int(prompt_lookup_num_tokens))
+        object.__setattr__(self, "draft_model", draft_model)
+        object.__setattr__(self, "_draft_tokenizer", draft_tokenizer)
+        object.__setattr__(self, "_speculative_stats", speculative_stats)
 
     @property
     def _llm_type(self):
         return "transformers-causal-lm"
 
+    def close(self):
+        """ stops the batch scheduler thread, which otherwise keeps the model alive """
+        if self._scheduler is not None:
+            self._scheduler.close()
+            object.__setattr__(self, "_scheduler", None)
+
     def _effective_params(self, temperature: Optional[float], top_p: Optional[float], max_tokens: Optional[int]):
         temp = self._temperature if temperature is None else float(temperature)
         nucleus = self._top_p if top_p is None else float(top_p)
@@ -155,6 +226,167 @@ class TransformersLLM(LLM):
 
         return {k: v.to(self.model.device) for k, v in inputs.items()}
 
+    def _use_prompt_lookup(self, prompt_lookup: bool, do_sample: bool) -> bool:
+        """ prompt lookup drafting is only used for greedy decoding, where it cannot change the output """
+        if prompt_lookup and do_sample:
+            LOGGER.info("prompt_lookup ignored: only supported for temperature=0")
+        return bool(prompt_lookup) and not do_sample and self._prompt_lookup_tokens > 0
+
+    def _use_draft(self, prompt_lookup: bool) -> bool:
+        """ prompt lookup and a draft model are mutually exclusive in generate(), lookup wins """
+        return self.draft_model is not None and not prompt_lookup
+
+    def _gen_kwargs(self, inputs, max_new: int, temp: float, nucleus: float, do_sample: bool,
+                    *, streamer=None, prompt_lookup: bool = False, assisted: bool = False,
+                    cancel: Optional[CancelCriteria] = None, stop: Optional[List[str]] = None,
+                    thinking: Optional[ThinkingBudgetProcessor] = None) -> dict:
+        generation_kwargs = {
+            **inputs,
+            "max_new_tokens": max_new,
+            "do_sample": do_sample,
+            "pad_token_id": self.tokenizer.eos_token_id,
+        }
+
+        if streamer is not None:
+            generation_kwargs["streamer"] = streamer
+
+        criteria = [] if cancel is None else [cancel]
+        if stop:
+            # ends decoding at the first stop string instead of running to max_new_tokens
+            criteria.append(StopSequenceCriteria(self.tokenizer, stop, inputs["input_ids"].shape[-1]))
+        if criteria:
+            generation_kwargs["stopping_criteria"] = StoppingCriteriaList(criteria)
+
+        if thinking is not None:
+            generation_kwargs["logits_processor"] = LogitsProcessorList([thinking])
+
+        if do_sample:
+            generation_kwargs["temperature"] = temp
+            generation_kwargs["top_p"] = nucleus
+
+        if prompt_lookup:
+            # draft tokens by n-gram match in the prompt, verified in one forward pass
+            generation_kwargs["prompt_lookup_num_tokens"] = self._prompt_lookup_tokens
+        elif assisted:
+            generation_kwargs["assistant_model"] = self.draft_model
+            if self._draft_tokenizer is not None:
+                generation_kwargs["tokenizer"] = self.tokenizer
+                generation_kwargs["assistant_tokenizer"] = self._draft_tokenizer
+
+        return generation_kwargs
+
+    def _generate(self, generation_kwargs: dict, prefix_len: int, assisted: bool,
+                  cancel: Optional[CancelCriteria] = None):
+        """ model.generate() for the non-batched paths, serialized with each other and with the scheduler's forwards """
+        with self._lock:
+            if cancel is not None and cancel.cancelled:
+                # client left while waiting for the lock, hand the slot to the next request
+                LOGGER.info("Generation cancelled before start")
+                return None
+
+            with torch.inference_mode():
+                self._attach_prefix(generation_kwargs, prefix_len)
+                start = self._speculative_stats.begin(generation_kwargs) if assisted else None
+                output = self.model.generate(**generation_kwargs)
+
+            if assisted:
+                self._speculative_stats.end(start)
+
+        return output
+
+    def _eos_token_ids(self) -> set[int]:
+        eos = getattr(self.model.generation_config, "eos_token_id", None)
+        ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+        ids.add(self.tokenizer.eos_token_id)
+        ids.discard(None)
+        return ids
+
+    def _submit(self, inputs, max_new: int, temp: float, nucleus: float, do_sample: bool,
+                prefix_len: int = 0, thinking: Optional[ThinkingBudgetProcessor] = None) -> GenerationRequest:
+        request = GenerationRequest(
+            inputs["input_ids"][0],
+            max_new_tokens=max_new,
+            temperature=temp,
+            top_p=nucleus,
+            do_sample=do_sample,
+            eos_token_ids=self._eos_token_ids(),
+            prefix_len=prefix_len,
+            logits_processor=thinking,
+        )
+        return self._scheduler.submit(request)
+
+    def _scheduled_text(self, request: GenerationRequest) -> Iterator[str]:
+        """ turns the token ids of a scheduled request into text deltas """
+        detokenizer = IncrementalDetokenizer(self.tokenizer, prompt_ids=request.input_ids.tolist())
+        try:
+            for token_id in request.token_ids():
+                text = detokenizer.add([token_id])
+                if text:
+                    yield text
+            text = detokenizer.flush()
+            if text:
+                yield text
+        finally:
+            request.cancel()
+
+    def _attach_prefix(self, generation_kwargs: dict, prefix_len: int):
+        """ seeds generate() with the cached system prompt KV, generate() only prefills the rest """
+        if not prefix_len:
+            return
+        prefix = tuple(generation_kwargs["input_ids"][0, :prefix_len].tolist())
+        layers = self._prefix_cache.prefill(self.model, prefix)
+        generation_kwargs["past_key_values"] = layers_to_cache(layers)
+
+    def _thinking(self, disable_think: bool, think_budget: Optional[int]) -> Optional[ThinkingBudgetProcessor]:
+        """ suppresses or caps the think block while decoding, so discarded reasoning costs no decode steps """
+        return ThinkingBudgetProcessor.create(self.tokenizer, disable=disable_think, budget=think_budget)
+
+    def _filter_thinking(self, chunks: Iterator[str], disable_think: bool) -> Iterator[str]:
+        in_think = False
+
+        for text in chunks:
+            if not text:
+                continue
+
+            if disable_think:
+                if "<think>" in text:
+                    in_think = True
+                    continue
+                if "</think>" in text:
+                    in_think = False
+                    continue
+                if in_think:
+                    continue
+
+            yield text
+
+    def _system_prefix_ids(self, messages) -> list[int]:
+        system_text = messages[0]["content"].strip()
+
+        if bool(getattr(self.tokenizer, "chat_template", None)):
+            try:
+                ids = self.tokenizer.apply_chat_template(messages[:1], add_generation_prompt=False, tokenize=True)
+            except Exception:
+                # some templates refuse a conversation without user turn
+                return []
+            if hasattr(ids, "keys"):
+                ids = ids["input_ids"]
+            return list(ids)
+
+        # head of the fallback prompt in _tokenize_messages
+        return self.tokenizer(f"<start_of_turn>user\n{system_text}\n\n")["input_ids"]
+
+    def _prefix_len(self, messages, inputs) -> int:
+        """ number of leading prompt tokens that can be served from the prefix cache """
+        if self._prefix_cache is None:
+            return 0
+
+        full = inputs["input_ids"][0].tolist()
+        n = common_prefix_len(self._system_prefix_ids(messages), full)
+        # at least one token has to go through the model to get the next-token logits
+        n = min(n, len(full) - 1)
+        return n if n >= self._prefix_cache.min_tokens else 0
+
     def _remove_thinking(self, text: str) -> str:
         while "<think>" in text and "</think>" in text:
             start = text.find("<think>")
@@ -164,7 +396,9 @@ class TransformersLLM(LLM):
 
     @timeit
     def _call(self, prompt: str, system_prompt: Optional[str] = None, *, temperature: Optional[float] = None,
-              top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False) -> str:
+              top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False,
+              prompt_lookup: bool = False, stop: Optional[List[str]] = None,
+              think_budget: Optional[int] = None) -> str:
 
         messages = self._build_messages(prompt, system_prompt, disable_think)
         inputs = self._tokenize_messages(messages)
@@ -176,28 +410,30 @@ class TransformersLLM(LLM):
         )
 
         LOGGER.info(
-            f"Sampling: max_tokens={max_new}, temperature={temp}, top_p={nucleus}, do_sample={do_sample}"
+            f"Sampling: max_tokens={max_new}, temperature={temp}, top_p={nucleus}, do_sample={do_sample}, "
+            f"prompt_lookup={prompt_lookup}, think_budget={think_budget}"
         )
 
-        generation_kwargs = {
-            **inputs,
-            "max_new_tokens": max_new,
-            "do_sample": do_sample,
-            "pad_token_id": self.tokenizer.eos_token_id,
-        }
+        prefix_len = self._prefix_len(messages, inputs)
+        prompt_lookup = self._use_prompt_lookup(prompt_lookup, do_sample)
+        assisted = self._use_draft(prompt_lookup)
+        thinking = self._thinking(disable_think, think_budget)
 
-        if do_sample:
-            generation_kwargs["temperature"] = temp
-            generation_kwargs["top_p"] = nucleus
-
-        with self._lock:
-            with torch.inference_mode():
-                output = self.model.generate(**generation_kwargs)
-
-        input_len = inputs["input_ids"].shape[-1]
-        generated = output[0][input_len:]
+        # speculative modes verify several tokens per step and run outside the batch scheduler
+        if self._scheduler is not None and not (prompt_lookup or assisted):
+            request = self._submit(inputs, max_new, temp, nucleus, do_sample, prefix_len, thinking)
+            # leaving the text generator at a stop string retires the request
+            text = "".join(stop_at(self._scheduled_text(request), stop))
+        else:
+            generation_kwargs = self._gen_kwargs(
+                inputs, max_new, temp, nucleus, do_sample,
+                prompt_lookup=prompt_lookup, assisted=assisted, stop=stop, thinking=thinking
+            )
+            output = self._generate(generation_kwargs, prefix_len, assisted)
 
-        text = self.tokenizer.decode(generated, skip_special_tokens=True)
+            input_len = inputs["input_ids"].shape[-1]
+            text = self.tokenizer.decode(output[0][input_len:], skip_special_tokens=True)
+            text = "".join(stop_at([text], stop))
 
         if disable_think:
             text = self._remove_thinking(text)
@@ -205,7 +441,9 @@ class TransformersLLM(LLM):
         return text.strip()
 
     def invoke(self, prompt: str, system_prompt: Optional[str] = None, *, temperature: Optional[float] = None,
-               top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False) -> str:
+               top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False,
+               prompt_lookup: bool = False, stop: Optional[List[str]] = None,
+               think_budget: Optional[int] = None) -> str:
 
         return self._call(
             prompt,
@@ -214,11 +452,16 @@ class TransformersLLM(LLM):
             top_p=top_p,
             max_tokens=max_tokens,
             disable_think=disable_think,
+            prompt_lookup=prompt_lookup,
+            stop=stop,
+            think_budget=think_budget,
         )
 
     @timeit
     def stream(self, prompt: str, system_prompt: Optional[str] = None, *, temperature: Optional[float] = None,
-               top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False) -> Iterator[str]:
+               top_p: Optional[float] = None, max_tokens: Optional[int] = None, disable_think: bool = False,
+               prompt_lookup: bool = False, stop: Optional[List[str]] = None,
+               think_budget: Optional[int] = None) -> Iterator[str]:
 
         messages = self._build_messages(prompt, system_prompt, disable_think)
         inputs = self._tokenize_messages(messages)
@@ -230,51 +473,45 @@ class TransformersLLM(LLM):
         )
 
         LOGGER.info(
-            f"Streaming: max_tokens={max_new}, temperature={temp}, top_p={nucleus}, do_sample={do_sample}"
+            f"Streaming: max_tokens={max_new}, temperature={temp}, top_p={nucleus}, do_sample={do_sample}, "
+            f"prompt_lookup={prompt_lookup}, think_budget={think_budget}"
         )
 
-        streamer = TextIteratorStreamer(
+        prefix_len = self._prefix_len(messages, inputs)
+        prompt_lookup = self._use_prompt_lookup(prompt_lookup, do_sample)
+        assisted = self._use_draft(prompt_lookup)
+        thinking = self._thinking(disable_think, think_budget)
+
+        if self._scheduler is not None and not (prompt_lookup or assisted):
+            request = self._submit(inputs, max_new, temp, nucleus, do_sample, prefix_len, thinking)
+            yield from stop_at(self._filter_thinking(self._scheduled_text(request), disable_think), stop)
+            return
+
+        streamer = IncrementalTextStreamer(
             self.tokenizer,
             skip_prompt=True,
             skip_special_tokens=True,
         )
 
-        generation_kwargs = {
-            **inputs,
-            "streamer": streamer,
-            "max_new_tokens": max_new,
-            "do_sample": do_sample,
-            "pad_token_id": self.tokenizer.eos_token_id,
-        }
+        # set when the consumer stops iterating (SSE client disconnected), generate() ends at the next step
+        cancel = CancelCriteria()
 
-        if do_sample:
-            generation_kwargs["temperature"] = temp
-            generation_kwargs["top_p"] = nucleus
+        generation_kwargs = self._gen_kwargs(
+            inputs, max_new, temp, nucleus, do_sample,
+            streamer=streamer, prompt_lookup=prompt_lookup, assisted=assisted, cancel=cancel, stop=stop,
+            thinking=thinking,
+        )
 
         def generate():
-            with self._lock:
-                with torch.inference_mode():
-                    self.model.generate(**generation_kwargs)
+            if self._generate(generation_kwargs, prefix_len, assisted, cancel) is None:
+                streamer.end()
 
         thread = threading.Thread(target=generate)
         thread.start()
 
-        in_think = False
-
-        for text in streamer:
-            if not text:
-                continue
-
-            if disable_think:
-                if "<think>" in text:
-                    in_think = True
-                    continue
-                if "</think>" in text:
-                    in_think = False
-                    continue
-                if in_think:
-                    continue
-
-            yield text
+        try:
+            yield from stop_at(self._filter_thinking(streamer, disable_think), stop)
+        finally:
+            cancel.cancel()
 
         thread.join()
\ No newline at end of file
@@ -0,0 +1,24 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture(scope="session")
+def transformers_server(tmp_path_factory):
+    """ LLMs/TransformersGeneric/app/server.py as the image runs it, without a model to load """
+    for module in ("fastapi", "pydantic", "yaml", "jinja2", "torch", "transformers", "langchain_core"):
+        pytest.importorskip(module)
+    mp = pytest.MonkeyPatch()
+    mp.setenv("MODEL_ID", str(tmp_path_factory.mktemp("no-model")))
+    mp.setenv("RESPONSE_CACHE_SIZE", "0")
+    mp.delenv("SYSTEM_PROMPTS_PATH", raising=False)
+    mp.syspath_prepend(str(ROOT / "LLMs" / "TransformersGeneric"))
+    try:
+        yield importlib.import_module("app.server")
+    finally:
+        mp.undo()
@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+
+class _SlowLLM:
+    """ stands in for TransformersLLM: counts generations, each one waits until released """
+
+    def __init__(self):
+        self.started = 0
+        self.release = threading.Event()
+
+    def stream(self, **kwargs):
+        self.started += 1
+        yield "Befund "
+        assert self.release.wait(10), "generation was never released"
+        yield "unauffällig"
+
+
+def test_identical_greedy_requests_share_one_generation(transformers_server, monkeypatch):
+    server = transformers_server
+    llm = _SlowLLM()
+
+    async def ready_llm():
+        return llm
+
+    monkeypatch.setattr(server, "ready_llm", ready_llm)
+    engine = server.engine
+    before = engine.stats()
+
+    async def run():
+        request = server.PromptRequest(prompt="Befund zusammenfassen", temperature=0.0)
+        first = asyncio.ensure_future(server.generate_text(request))
+        second = asyncio.ensure_future(server.generate_text(request.model_copy()))
+        # the generation is held until the second request has attached to it
+        while engine.stats()["coalesced"] == before["coalesced"]:
+            assert not first.done() and not second.done()
+            await asyncio.sleep(0.01)
+        llm.release.set()
+        return await asyncio.wait_for(asyncio.gather(first, second), 10)
+
+    responses = asyncio.run(run())
+    assert llm.started == 1
+    assert engine.stats()["submitted"] == before["submitted"] + 1
+    assert responses == [{"response": "Befund unauffällig"}] * 2
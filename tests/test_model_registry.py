@@ -0,0 +1,58 @@
+import threading
+import time
+
+from LLMs.MultiModel.app.registry import ModelRegistry, ModelSpec
+
+
+def spec(name: str, size: int, events: list, offload_delay: float = 0.0, offload: bool = False) -> ModelSpec:
+    def move_to_cpu(llm):
+        time.sleep(offload_delay)
+        events.append(("offload", llm["name"]))
+
+    return ModelSpec(name, load=lambda: {"name": name}, stream=None, size_bytes=size,
+                     offload=move_to_cpu if offload else None,
+                     restore=lambda llm: events.append(("restore", llm["name"])),
+                     close=lambda llm: events.append(("close", llm["name"])))
+
+
+def test_lru_model_is_dropped_and_reloaded():
+    events = []
+    registry = ModelRegistry(device_budget=10)
+    for name in "ab":
+        registry.register(spec(name, 8, events))
+    for name in "aba":
+        with registry.use(name) as llm:
+            assert llm == {"name": name}
+    assert events == [("close", "a"), ("close", "b")]
+    models = registry.stats()["models"]
+    assert (models["a"]["location"], models["a"]["loads"]) == ("device", 2)
+    assert models["b"]["location"] == "disk"
+
+
+def test_offload_runs_outside_the_registry_lock():
+    events = []
+    registry = ModelRegistry(device_budget=10, cpu_budget=10)
+    registry.register(spec("a", 8, events, offload_delay=0.5, offload=True))
+    registry.register(spec("b", 8, events))
+    registry.register(spec("c", 1, events))
+    with registry.use("a"):
+        pass
+
+    def load_b():
+        with registry.use("b"):
+            pass
+
+    loading_b = threading.Thread(target=load_b)
+    loading_b.start()
+    time.sleep(0.1)  # b is now offloading a
+    begin = time.perf_counter()
+    assert registry.stats()["models"]["a"]["location"] == "cpu"
+    with registry.use("c") as llm:
+        assert llm == {"name": "c"}
+    assert time.perf_counter() - begin < 0.3, "waited for the offload of another model"
+    loading_b.join()
+
+    # a request for a waits until its offload is done, then restores it
+    with registry.use("a") as llm:
+        assert llm == {"name": "a"}
+    assert events.index(("offload", "a")) < events.index(("restore", "a"))
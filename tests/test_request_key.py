@@ -0,0 +1,26 @@
+from utils import ResponseCache, request_key
+
+
+def test_key_from_prompt_request(transformers_server):
+    request = transformers_server.PromptRequest(prompt="Befund zusammenfassen", temperature=0.0)
+    key = transformers_server.cache_key(request)
+    assert key is not None
+    assert key == transformers_server.cache_key(transformers_server.PromptRequest(**request.model_dump()))
+    assert key != transformers_server.cache_key(request.model_copy(update={"prompt": "anders"}))
+
+
+def test_sampled_requests_have_no_key(transformers_server):
+    assert transformers_server.cache_key(transformers_server.PromptRequest(prompt="x", temperature=0.7)) is None
+    # unset temperature resolves to the server default (TEMPERATURE, 0.8)
+    assert transformers_server.cache_key(transformers_server.PromptRequest(prompt="x")) is None
+
+
+def test_resolved_temperature_is_part_of_the_key():
+    fields = {"prompt": "x", "temperature": None}
+    assert request_key("m", 0.0, fields) == request_key("m", 0, {"prompt": "x", "temperature": 0.0})
+    assert request_key("m", 0.0, fields) != request_key("other", 0.0, fields)
+
+
+def test_response_cache_key():
+    assert ResponseCache(max_entries=0).key("m", 0.0, {"prompt": "x"}) is None
+    assert ResponseCache(max_entries=4).key("m", 0.0, {"prompt": "x"}) == request_key("m", 0.0, {"prompt": "x"})
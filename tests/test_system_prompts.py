@@ -0,0 +1,70 @@
+from typing import Optional
+
+import pytest
+
+pytest.importorskip("yaml")
+pytest.importorskip("jinja2")
+fastapi = pytest.importorskip("fastapi")
+from pydantic import BaseModel
+
+from utils.prompts import SystemPromptRegistry, with_system_prompt
+
+MESSAGES = """
+Austrittsbericht:
+  reasoning: false
+  template: "Austrittsbericht für {{ name }}"
+  context:
+    name: Max Mustermann
+Differentialdiagnose:
+  template: "Begründe jede Differentialdiagnose."
+"""
+
+
+class ThinkingRequest(BaseModel):
+    prompt: str
+    system_prompt: Optional[str] = None
+    system_prompt_id: Optional[str] = None
+    disable_think: Optional[bool] = None
+
+
+class PlainRequest(BaseModel):
+    prompt: str
+    system_prompt: Optional[str] = None
+    system_prompt_id: Optional[str] = None
+
+
+@pytest.fixture
+def registry(tmp_path):
+    path = tmp_path / "system_messages.yml"
+    path.write_text(MESSAGES, encoding="utf-8")
+    return SystemPromptRegistry(path)
+
+
+def test_apply_fills_in_the_registered_text(registry):
+    request = with_system_prompt(registry, PlainRequest(prompt="x", system_prompt_id="Austrittsbericht"))
+    assert request.system_prompt == "Austrittsbericht für Max Mustermann"
+    assert request.system_prompt_id is None
+
+    sent = with_system_prompt(registry, PlainRequest(prompt="x", system_prompt="eigener", system_prompt_id="Austrittsbericht"))
+    assert sent.system_prompt == "eigener"
+
+
+def test_prompts_without_reasoning_disable_think(registry):
+    routine = with_system_prompt(registry, ThinkingRequest(prompt="x", system_prompt_id="Austrittsbericht"))
+    assert routine.disable_think is True
+    reasoning = with_system_prompt(registry, ThinkingRequest(prompt="x", system_prompt_id="Differentialdiagnose"))
+    assert reasoning.disable_think is None
+
+
+def test_errors_map_to_http_status(registry):
+    version = registry.get("Austrittsbericht").version
+    assert with_system_prompt(registry, PlainRequest(prompt="x", system_prompt_id=f"Austrittsbericht@{version}")).system_prompt
+    with pytest.raises(fastapi.HTTPException) as unknown:
+        with_system_prompt(registry, PlainRequest(prompt="x", system_prompt_id="Unbekannt"))
+    assert unknown.value.status_code == 404
+    with pytest.raises(fastapi.HTTPException) as outdated:
+        with_system_prompt(registry, PlainRequest(prompt="x", system_prompt_id="Austrittsbericht@000000000000"))
+    assert outdated.value.status_code == 404
+    with pytest.raises(fastapi.HTTPException) as unconfigured:
+        with_system_prompt(None, PlainRequest(prompt="x", system_prompt_id="Austrittsbericht"))
+    assert unconfigured.value.status_code == 400
@@ -1,2 +1,4 @@
 from .decorators import timeit
-from .logger import setup_logging, get_logger
\ No newline at end of file
+from .logger import setup_logging, get_logger
+from .cache import ResponseCache
+from .serving import AsyncEngine, InstancePool, ModelLoader, ReplicaPool, replica_count, replica_threads, request_key, warm_up
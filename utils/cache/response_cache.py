@@ -0,0 +1,117 @@
+from typing import Optional
+from collections import OrderedDict
+from pathlib import Path
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from ..serving.engine import request_key
+
+
+class ResponseCache:
+    """
+    Cache for deterministic (temperature 0) responses.
+
+    In-memory LRU tier, optionally backed by a SQLite file that survives container restarts.
+    Entries are keyed by a hash over model, prompts and sampling parameters.
+    """
+
+    def __init__(self, max_entries: int = 256, db_path: Optional[str] = None, max_disk_entries: int = 10000):
+        self._max_entries = int(max_entries)
+        self._max_disk_entries = int(max_disk_entries)
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._logger = logging.getLogger(__name__)
+
+        self._db = None
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.commit()
+
+        self._logger.info(f"Response cache: entries={self._max_entries}, db={db_path or '-'}")
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        return cls(
+            max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "256")),
+            db_path=os.getenv("RESPONSE_CACHE_DB") or None,
+            max_disk_entries=int(os.getenv("RESPONSE_CACHE_DISK_ENTRIES", "10000")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_entries > 0 or self._db is not None
+
+    def key(self, model: str, temperature: float, fields: dict) -> Optional[str]:
+        """ cache key for a request, None if the request is not deterministic or caching is off """
+        return request_key(model, temperature, fields) if self.enabled else None
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None or not self.enabled:
+            return None
+
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return text
+
+            if self._db is not None:
+                row = self._db.execute("SELECT text FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    self._remember(key, row[0])
+                    self._disk_hits += 1
+                    return row[0]
+
+            self._misses += 1
+            return None
+
+    def put(self, key: Optional[str], text: str):
+        if key is None or not text:
+            return
+
+        with self._lock:
+            self._remember(key, text)
+
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, text, last_used) VALUES (?, ?, ?)",
+                    (key, text, time.time()),
+                )
+                self._db.execute(
+                    "DELETE FROM responses WHERE key NOT IN "
+                    "(SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+                    (self._max_disk_entries,),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, text: str):
+        if self._max_entries <= 0:
+            return
+        self._entries[key] = text
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "disk": self._db is not None,
+            }
@@ -0,0 +1,5 @@
+# Helpers for the transformers based backends. Not re-exported from utils,
+# the webinterface image ships utils/ without torch.
+from .stopping import CancelCriteria, StopSequenceCriteria, StopSequenceFilter, stop_at
+from .detokenizer import IncrementalDetokenizer, IncrementalTextStreamer
+from .thinking import ThinkingBudgetProcessor
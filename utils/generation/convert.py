@@ -0,0 +1,194 @@
+from typing import Optional
+from dataclasses import dataclass, field
+from pathlib import Path
+import argparse
+import json
+import logging
+import shutil
+import time
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import AutoConfig, AutoTokenizer
+
+from .loading import (
+    ARTIFACT_DIR, INT8_SCALE_SUFFIX, SERVING_MANIFEST, checkpoint_shards, empty_model, source_fingerprint,
+    _keep_fp32, _resolve,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# everything but the weights that from_pretrained / AutoTokenizer read from a model folder
+_BUNDLE_PATTERNS = ("*.json", "*.jinja", "*.model", "*.tiktoken", "*.txt", "*.py")
+_BUNDLE_SKIP = {"model.safetensors.index.json", "pytorch_model.bin.index.json", SERVING_MANIFEST}
+
+
+def quantize_int8(weight: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """ symmetric int8 with one fp32 scale per output channel (row) """
+    w = weight.float()
+    scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    q = torch.round(w / scale.unsqueeze(1)).clamp_(-127, 127).to(torch.int8)
+    return q, scale
+
+
+def _int8_weights(model, config) -> set:
+    """ weights of the nn.Linear modules, a tied lm_head shares the embedding and stays as is """
+    names = {f"{name}.weight" for name, module in model.named_modules() if isinstance(module, torch.nn.Linear)}
+    if getattr(config, "tie_word_embeddings", False):
+        head = model.get_output_embeddings()
+        names -= {f"{name}.weight" for name, module in model.named_modules() if module is head}
+    return names
+
+
+@dataclass
+class _ShardWriter:
+    """ collects tensors up to shard_bytes and writes them as numbered safetensors shards """
+    out: Path
+    shard_bytes: int
+    pending: dict = field(default_factory=dict)
+    size: int = 0
+    files: list = field(default_factory=list)
+    weight_map: dict = field(default_factory=dict)
+    total: int = 0
+
+    def add(self, tensors: dict):
+        """ tensors of one dict always land in the same shard (int8 weights and their scales) """
+        nbytes = sum(t.numel() * t.element_size() for t in tensors.values())
+        if self.pending and self.size + nbytes > self.shard_bytes:
+            self.flush()
+        self.pending.update(tensors)
+        self.size += nbytes
+
+    def flush(self):
+        if not self.pending:
+            return
+        name = f"part-{len(self.files) + 1:05d}.safetensors"
+        save_file({k: v.contiguous() for k, v in self.pending.items()}, str(self.out / name), metadata={"format": "pt"})
+        self.files.append((name, list(self.pending)))
+        self.total += self.size
+        LOGGER.info(f"Wrote {name}: {len(self.pending)} tensors, {self.size / 2**20:.0f} MiB")
+        self.pending, self.size = {}, 0
+
+    def close(self):
+        """ renames the parts like save_pretrained does and writes the index """
+        self.flush()
+        for i, (part, names) in enumerate(self.files, start=1):
+            name = f"model-{i:05d}-of-{len(self.files):05d}.safetensors"
+            (self.out / part).rename(self.out / name)
+            self.weight_map.update({tensor: name for tensor in names})
+        index = {"metadata": {"total_size": self.total}, "weight_map": dict(sorted(self.weight_map.items()))}
+        (self.out / "model.safetensors.index.json").write_text(json.dumps(index, indent=2))
+
+
+def _copy_bundle(source: Path, out: Path, dtype: torch.dtype):
+    """ config with the new dtype, generation config, tokenizer files, chat template and remote code """
+    for pattern in _BUNDLE_PATTERNS:
+        for f in source.glob(pattern):
+            if f.is_file() and f.name not in _BUNDLE_SKIP:
+                shutil.copy2(f, out / f.name)
+
+    config = json.loads((out / "config.json").read_text())
+    dtype_name = str(dtype).replace("torch.", "")
+    config["torch_dtype"] = dtype_name
+    if "dtype" in config:
+        config["dtype"] = dtype_name
+    (out / "config.json").write_text(json.dumps(config, indent=2))
+
+
+def convert(source: Path, out: Optional[Path] = None, *, dtype: torch.dtype = torch.bfloat16, int8: bool = False,
+            shard_mb: int = 2048, trust_remote_code: bool = False) -> dict:
+    """
+    Converts a local safetensors checkpoint once into a ready-to-serve artifact: weights in the
+    serving dtype (or int8 linears with per channel scales), keys in the model's own naming,
+    shards of at most shard_mb and the tokenizer / chat template bundle next to them. The
+    artifact goes to <source>/serving by default, where load_causal_lm picks it up.
+
+    Reads one tensor at a time through safetensors' mmap, the host holds at most one output
+    shard. Written into a temporary folder that replaces the old artifact at the end.
+    Returns the manifest.
+    """
+    source = Path(source)
+    out = Path(out) if out is not None else source / ARTIFACT_DIR
+    shards = checkpoint_shards(source)
+    if not shards:
+        raise FileNotFoundError(f"No safetensors shards in {source}")
+
+    begin = time.perf_counter()
+    config = AutoConfig.from_pretrained(source, trust_remote_code=trust_remote_code, local_files_only=True)
+    model, dtype = empty_model(source, dtype, trust_remote_code=trust_remote_code)
+    expected = dict(model.state_dict(keep_vars=True))
+    prefix = getattr(model, "base_model_prefix", "") or ""
+    renames = getattr(model, "_checkpoint_conversion_mapping", None) or {}
+    quantize = _int8_weights(model, config) if int8 else set()
+
+    tmp = out.with_name(out.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    writer = _ShardWriter(tmp, shard_mb * 2**20)
+    skipped, quantized = [], 0
+
+    for i, shard in enumerate(shards, start=1):
+        LOGGER.info(f"Converting shard {i}/{len(shards)} {shard.name}")
+        with safe_open(str(shard), framework="pt", device="cpu") as f:
+            for name in f.keys():
+                key = _resolve(name, expected, prefix, renames)
+                if key is None:
+                    skipped.append(name)
+                    continue
+                tensor = f.get_tensor(name)
+                if key in quantize and tensor.dim() == 2:
+                    q, scale = quantize_int8(tensor)
+                    writer.add({key: q, key + INT8_SCALE_SUFFIX: scale})
+                    quantized += 1
+                    continue
+                if tensor.is_floating_point():
+                    tensor = tensor.to(torch.float32 if _keep_fp32(key, model) else dtype)
+                writer.add({key: tensor})
+    writer.close()
+    del model
+
+    if skipped:
+        LOGGER.warning(f"Dropped {len(skipped)} tensors the model does not use ({skipped[:3]})")
+    _copy_bundle(source, tmp, dtype)
+
+    tokenizer = AutoTokenizer.from_pretrained(tmp, trust_remote_code=trust_remote_code, local_files_only=True)
+    if not getattr(tokenizer, "chat_template", None):
+        LOGGER.warning(f"{source} has no chat template, servers fall back to their own prompt format")
+
+    manifest = {
+        "version": 1,
+        "source": str(source),
+        "source_fingerprint": source_fingerprint(source),
+        "dtype": str(dtype).replace("torch.", ""),
+        "quantization": "int8" if int8 else None,
+        "int8_tensors": quantized,
+        "shards": len(writer.files),
+        "total_bytes": writer.total,
+        "chat_template": bool(getattr(tokenizer, "chat_template", None)),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seconds": round(time.perf_counter() - begin, 1),
+    }
+    # the manifest is what marks the folder as complete
+    (tmp / SERVING_MANIFEST).write_text(json.dumps(manifest, indent=2))
+    shutil.rmtree(out, ignore_errors=True)
+    tmp.rename(out)
+    LOGGER.info(f"Artifact {out}: {manifest['shards']} shards, {writer.total / 2**30:.2f} GiB "
+                f"in {manifest['seconds']}s")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a checkpoint once into a pre-cast / pre-quantized serving artifact")
+    parser.add_argument("model", help="path to a local model folder with safetensors shards")
+    parser.add_argument("--out", default=None, help=f"target folder, default <model>/{ARTIFACT_DIR}")
+    parser.add_argument("--dtype", default="bfloat16", choices=["bfloat16", "float16", "float32"])
+    parser.add_argument("--int8", action="store_true", help="store linear weights as int8 with per channel scales")
+    parser.add_argument("--shard-mb", type=int, default=2048)
+    parser.add_argument("--trust-remote-code", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    result = convert(Path(args.model), None if args.out is None else Path(args.out), dtype=getattr(torch, args.dtype),
+                     int8=args.int8, shard_mb=args.shard_mb, trust_remote_code=args.trust_remote_code)
+    print(json.dumps(result, indent=2))
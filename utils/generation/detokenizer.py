@@ -0,0 +1,137 @@
+from typing import Iterable, Optional
+from queue import Queue
+import argparse
+import time
+
+from transformers.generation.streamers import BaseStreamer
+
+# prompt tokens used as left context, so the first generated word gets its leading space
+_PROMPT_CONTEXT = 5
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing list of token ids into text deltas.
+
+    Only a small window (the tokens of the last emitted piece plus the new ones) is decoded per
+    step, so the cost per token does not grow with the output length. Deltas are held back while
+    the window ends in an incomplete UTF-8 sequence (e.g. the first byte of an umlaut).
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True, prompt_ids: Optional[Iterable[int]] = None):
+        self._tokenizer = tokenizer
+        self._skip_special_tokens = skip_special_tokens
+        self._ids: list[int] = list(prompt_ids or [])[-_PROMPT_CONTEXT:]
+        self._prefix_offset = 0
+        self._read_offset = len(self._ids)
+
+    def _decode(self, ids: list[int]) -> str:
+        return self._tokenizer.decode(
+            ids, skip_special_tokens=self._skip_special_tokens, clean_up_tokenization_spaces=False
+        )
+
+    def add(self, token_ids: Iterable[int]) -> str:
+        """ appends token ids and returns the newly completed text (may be empty) """
+        self._ids.extend(int(t) for t in token_ids)
+
+        prefix_text = self._decode(self._ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self._ids[self._prefix_offset:])
+
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self._ids)
+        return new_text[len(prefix_text):]
+
+    def flush(self) -> str:
+        """ text that is still held back at the end of generation """
+        prefix_text = self._decode(self._ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self._ids[self._prefix_offset:])
+        self._prefix_offset = self._read_offset = len(self._ids)
+        return new_text[len(prefix_text):] if len(new_text) > len(prefix_text) else ""
+
+
+class IncrementalTextStreamer(BaseStreamer):
+    """ drop-in replacement for TextIteratorStreamer backed by IncrementalDetokenizer """
+
+    def __init__(self, tokenizer, skip_prompt: bool = True, skip_special_tokens: bool = True,
+                 timeout: Optional[float] = None):
+        self._tokenizer = tokenizer
+        self._skip_prompt = skip_prompt
+        self._skip_special_tokens = skip_special_tokens
+        self._timeout = timeout
+        self._detokenizer: Optional[IncrementalDetokenizer] = None
+        self._queue: Queue = Queue()
+        self._stop_signal = None
+
+    def put(self, value):
+        ids = value.reshape(-1).tolist() if hasattr(value, "reshape") else list(value)
+
+        if self._detokenizer is None:
+            if self._skip_prompt:
+                # first call of generate() carries the prompt
+                self._detokenizer = IncrementalDetokenizer(self._tokenizer, self._skip_special_tokens, ids)
+                return
+            self._detokenizer = IncrementalDetokenizer(self._tokenizer, self._skip_special_tokens)
+
+        text = self._detokenizer.add(ids)
+        if text:
+            self._queue.put(text, timeout=self._timeout)
+
+    def end(self):
+        if self._detokenizer is not None:
+            text = self._detokenizer.flush()
+            if text:
+                self._queue.put(text, timeout=self._timeout)
+        self._queue.put(self._stop_signal, timeout=self._timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        value = self._queue.get(timeout=self._timeout)
+        if value is self._stop_signal:
+            raise StopIteration()
+        return value
+
+
+def _benchmark(tokenizer_path: str, n_tokens: int, window: int):
+    """ per-token streaming cost: full re-decode (TextIteratorStreamer) vs. incremental window """
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+    text = "Die Patientin wurde am Knie operiert, der Verlauf war unauffällig. Übelkeit trat nicht auf. "
+    ids = (tokenizer(text, add_special_tokens=False)["input_ids"] * (n_tokens // 10 + 1))[:n_tokens]
+
+    def full_decode():
+        cache, printed = [], 0
+        for t in ids:
+            cache.append(t)
+            out = tokenizer.decode(cache, skip_special_tokens=True)
+            yield out[printed:]
+            printed = len(out)
+
+    def incremental():
+        detok = IncrementalDetokenizer(tokenizer)
+        for t in ids:
+            yield detok.add([t])
+
+    for name, fn in (("full re-decode", full_decode), ("incremental", incremental)):
+        timings = []
+        start = time.perf_counter()
+        for i, _ in enumerate(fn(), start=1):
+            if i % window == 0:
+                now = time.perf_counter()
+                timings.append((now - start) / window * 1e6)
+                start = now
+        print(f"{name:>15}: " + " ".join(f"{i * window}:{t:.0f}us" for i, t in enumerate(timings, start=1)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark streaming detokenization cost per token")
+    parser.add_argument("tokenizer", help="path to a local tokenizer / model folder")
+    parser.add_argument("--tokens", type=int, default=8192)
+    parser.add_argument("--window", type=int, default=1024)
+    args = parser.parse_args()
+    _benchmark(args.tokenizer, args.tokens, args.window)
@@ -0,0 +1,596 @@
+from typing import Callable, Optional, Union
+from dataclasses import dataclass, field
+from pathlib import Path
+import argparse
+import gc
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+LOGGER = logging.getLogger(__name__)
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+    **({"F8_E4M3": torch.float8_e4m3fn} if hasattr(torch, "float8_e4m3fn") else {}),
+    **({"F8_E5M2": torch.float8_e5m2} if hasattr(torch, "float8_e5m2") else {}),
+}
+
+
+def current_rss() -> int:
+    """ resident set size of this process in bytes """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+@dataclass
+class ShardStats:
+    shard: str
+    tensors: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    peak_rss: int = 0
+
+    def summary(self) -> dict:
+        return {
+            "shard": self.shard,
+            "tensors": self.tensors,
+            "mib": round(self.bytes / 2**20, 1),
+            "seconds": round(self.seconds, 2),
+            "mib_per_s": round(self.bytes / 2**20 / self.seconds, 1) if self.seconds else None,
+            "peak_rss_mib": round(self.peak_rss / 2**20, 1),
+        }
+
+
+@dataclass
+class LoadReport:
+    path: str
+    device: str
+    dtype: str
+    max_rss: Optional[int] = None
+    shards: list = field(default_factory=list)
+    seconds: float = 0.0
+    streamed: bool = True
+
+    @property
+    def peak_rss(self) -> int:
+        return max((s.peak_rss for s in self.shards), default=0)
+
+    def summary(self) -> dict:
+        return {
+            "path": self.path,
+            "device": self.device,
+            "dtype": self.dtype,
+            "streamed": self.streamed,
+            "seconds": round(self.seconds, 2),
+            "peak_rss_mib": round(self.peak_rss / 2**20, 1),
+            "max_rss_mib": None if self.max_rss is None else round(self.max_rss / 2**20, 1),
+            "shards": [s.summary() for s in self.shards],
+        }
+
+
+def _restore_buffers(model) -> list[str]:
+    """
+    Non-persistent buffers (rotary tables etc.) are not in the checkpoint and come out of the
+    meta build without data. Parameter-free modules that keep their config are built again on
+    the host for them. Returns the buffers still on the meta device.
+    """
+    for module in model.modules():
+        empty = [name for name in module._non_persistent_buffers_set
+                 if module._buffers.get(name) is not None and module._buffers[name].is_meta]
+        if not empty or getattr(module, "config", None) is None or any(True for _ in module.parameters()):
+            continue
+        try:
+            fresh = type(module)(module.config)
+        except (TypeError, ValueError, KeyError, AttributeError):
+            continue
+        for name in empty:
+            value = fresh._buffers.get(name)
+            if value is not None and not value.is_meta:
+                module._buffers[name] = value
+    return [name for name, buffer in model.named_buffers() if buffer.is_meta]
+
+
+def checkpoint_shards(path: Path) -> list[Path]:
+    """ safetensors shards of a local checkpoint folder, empty if there are none """
+    index = path / "model.safetensors.index.json"
+    if index.exists():
+        weight_map = json.loads(index.read_text())["weight_map"]
+        return [path / name for name in sorted(set(weight_map.values()))]
+    return sorted(path.glob("model*.safetensors"))
+
+
+SERVING_MANIFEST = "serving.json"
+ARTIFACT_DIR = "serving"
+INT8_SCALE_SUFFIX = "_scale"
+
+
+def source_fingerprint(path: Path) -> str:
+    """ names, sizes and mtimes of the shards and config, cheap enough to check at every start """
+    files = checkpoint_shards(path) + [path / "config.json"]
+    stamp = [(f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in files if f.exists()]
+    return hashlib.sha1(json.dumps(stamp).encode()).hexdigest()[:16]
+
+
+def read_manifest(path: Path) -> Optional[dict]:
+    """ the manifest of a converted serving artifact, None for a plain checkpoint """
+    manifest = Path(path) / SERVING_MANIFEST
+    if not manifest.is_file():
+        return None
+    return json.loads(manifest.read_text())
+
+
+def resolve_artifact(path: Union[str, Path]) -> Path:
+    """
+    The converted artifact of a checkpoint (<path>/serving, see utils.generation.convert) if
+    there is one and it was built from the current shards, otherwise the path itself.
+    """
+    path = Path(path)
+    artifact = path / ARTIFACT_DIR
+    manifest = read_manifest(artifact) if path.is_dir() else None
+    if manifest is None:
+        return path
+    if checkpoint_shards(path) and manifest.get("source_fingerprint") != source_fingerprint(path):
+        LOGGER.warning(f"Ignoring stale artifact {artifact}, the checkpoint changed since the conversion")
+        return path
+    LOGGER.info(f"Using converted artifact {artifact} ({manifest.get('dtype')}, "
+                f"quantization {manifest.get('quantization')})")
+    return artifact
+
+
+def _read_header(f) -> tuple[dict, int]:
+    size = struct.unpack("<Q", f.read(8))[0]
+    header = json.loads(f.read(size))
+    header.pop("__metadata__", None)
+    return header, 8 + size
+
+
+class _ShardReader:
+    """
+    Copies safetensors tensors into preallocated target tensors in row chunks.
+
+    Reads go through plain file reads instead of mmap, so the host only ever holds one chunk
+    (raw bytes plus its converted copy) on top of what already lives in host memory.
+    """
+
+    def __init__(self, chunk_bytes: int, max_rss: Optional[int]):
+        self._chunk_bytes = max(1, int(chunk_bytes))
+        self._max_rss = max_rss
+
+    def _rows_within_ceiling(self, rows: int, row_cost: int, stats: ShardStats) -> int:
+        rss = current_rss()
+        stats.peak_rss = max(stats.peak_rss, rss)
+        if self._max_rss is None:
+            return rows
+        if rss + rows * row_cost > self._max_rss:
+            gc.collect()
+            rss = current_rss()
+        while rows > 1 and rss + rows * row_cost > self._max_rss:
+            rows //= 2
+        if rss + rows * row_cost > self._max_rss:
+            raise MemoryError(
+                f"Loading needs {(rss + row_cost) / 2**30:.2f} GiB resident memory, "
+                f"ceiling is {self._max_rss / 2**30:.2f} GiB (MODEL_LOAD_MAX_RSS_GIB)"
+            )
+        return rows
+
+    def copy(self, f, offset: int, source_dtype: torch.dtype, target: torch.Tensor, stats: ShardStats,
+             scale: Optional[torch.Tensor] = None):
+        """ scale: per row factors (int8 weights), applied to each chunk after it is converted """
+        if target.numel() == 0:
+            return
+        rows_total = target.shape[0] if target.dim() else 1
+        view = target.view(rows_total, -1)
+        row_elems = view.shape[1]
+        row_bytes = row_elems * torch.empty((), dtype=source_dtype).element_size()
+        # raw bytes plus the converted copy
+        row_cost = row_bytes + row_elems * target.element_size()
+
+        row = 0
+        while row < rows_total:
+            rows = min(rows_total - row, max(1, self._chunk_bytes // row_bytes))
+            rows = self._rows_within_ceiling(rows, row_cost, stats)
+
+            raw = bytearray(rows * row_bytes)
+            f.seek(offset + row * row_bytes)
+            f.readinto(raw)
+            chunk = torch.frombuffer(raw, dtype=source_dtype).view(rows, row_elems)
+            view[row:row + rows].copy_(chunk)
+            if scale is not None:
+                view[row:row + rows].mul_(scale[row:row + rows].unsqueeze(1))
+
+            del chunk, raw
+            row += rows
+            stats.bytes += rows * row_bytes
+
+
+def _keep_fp32(name: str, model) -> bool:
+    return any(part in name.split(".") for part in (getattr(model, "_keep_in_fp32_modules", None) or []))
+
+
+def _placement(name: str, device_map: dict) -> Union[str, int]:
+    """ device of the longest module prefix in an accelerate style device map """
+    while name:
+        if name in device_map:
+            return device_map[name]
+        name = name.rpartition(".")[0]
+    return device_map.get("", "cpu")
+
+
+def _auto_device_map(model, dtype, max_memory: Optional[dict]) -> dict:
+    from accelerate import infer_auto_device_map
+
+    return infer_auto_device_map(
+        model, max_memory=max_memory, no_split_module_classes=getattr(model, "_no_split_modules", None) or [],
+        dtype=dtype,
+    )
+
+
+def _resolve(name: str, expected: dict, prefix: str, renames: dict) -> Optional[str]:
+    """ maps a checkpoint key onto the model, base models are stored with or without their prefix """
+    for pattern, replacement in renames.items():
+        name, n = re.subn(pattern, replacement, name)
+        if n:
+            break
+    if name in expected:
+        return name
+    if prefix and f"{prefix}.{name}" in expected:
+        return f"{prefix}.{name}"
+    if prefix and name.startswith(prefix + ".") and name[len(prefix) + 1:] in expected:
+        return name[len(prefix) + 1:]
+    return None
+
+
+def _set_tensor(model, name: str, value: torch.Tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name) if module_name else model
+    if attr in module._parameters:
+        module._parameters[attr] = torch.nn.Parameter(value, requires_grad=False)
+    else:
+        module._buffers[attr] = value
+
+
+def _read_scale(f, base: int, scale_info: dict, reader: "_ShardReader", stats: ShardStats) -> torch.Tensor:
+    scale = torch.empty(scale_info["shape"], dtype=torch.float32)
+    reader.copy(f, base + scale_info["data_offsets"][0], _SAFETENSORS_DTYPES[scale_info["dtype"]], scale, stats)
+    return scale
+
+
+def _read_int8(f, base: int, info: dict, scale_info: dict, reader: "_ShardReader",
+               stats: ShardStats) -> tuple[torch.Tensor, torch.Tensor]:
+    """ an int8 weight and its per output channel scales, both on the host """
+    q = torch.empty(info["shape"], dtype=torch.int8)
+    reader.copy(f, base + info["data_offsets"][0], torch.int8, q, stats)
+    return q, _read_scale(f, base, scale_info, reader, stats)
+
+
+def _install_int8(model, weights: dict):
+    """ swaps the linears of pre-quantized weights for dynamic int8 ones, their bias is loaded already """
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+
+    for key, (q, scale) in weights.items():
+        module_name = key.rpartition(".")[0]
+        parent_name, _, attr = module_name.rpartition(".")
+        linear = model.get_submodule(module_name)
+        bias = linear.bias
+        layer = DynamicLinear(linear.in_features, linear.out_features, bias_=bias is not None, dtype=torch.qint8)
+        weight = torch._make_per_channel_quantized_tensor(
+            q, scale.double(), torch.zeros(scale.shape, dtype=torch.int64), 0
+        )
+        layer.set_weight_bias(weight, None if bias is None else bias.detach().float())
+        setattr(model.get_submodule(parent_name) if parent_name else model, attr, layer)
+
+
+def empty_model(path: Path, dtype: Optional[torch.dtype], *, trust_remote_code: bool = False,
+                local_files_only: bool = True):
+    """
+    The model with all parameters (and persistent buffers) on the meta device, non-persistent
+    buffers on the host where they can be rebuilt; dtype None takes the dtype of the config.
+    """
+    config = AutoConfig.from_pretrained(path, trust_remote_code=trust_remote_code, local_files_only=local_files_only)
+    if dtype is None:
+        dtype = getattr(config, "torch_dtype", None) or torch.float32
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+    # the default device of this thread only, modules built elsewhere meanwhile are not affected
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype, trust_remote_code=trust_remote_code)
+    _restore_buffers(model)
+    return model, dtype
+
+
+def stream_checkpoint(model, path: Path, *, dtype: torch.dtype, placement: Callable[[str], Optional[str]],
+                      report: LoadReport, chunk_bytes: int, max_rss: Optional[int] = None,
+                      sink: Optional[Callable[[str, torch.Tensor], None]] = None,
+                      int8: Optional[dict] = None, mmap: bool = False,
+                      progress: Optional[Callable[[str, float], None]] = None) -> int:
+    """
+    Copies every checkpoint tensor into the meta model, on the device placement(name) returns.
+    Tensors placed on None are handed to sink(name, cpu_tensor) instead, or not read at all
+    without a sink. Shard stats are appended to the report, returns the number of checkpoint
+    tensors the model does not know.
+
+    Pre-quantized int8 weights (an I8 tensor next to its "<name>_scale") are dequantized into
+    the target dtype, or collected as int8[key] = (weight, scale) when a dict is passed.
+
+    mmap: host tensors already stored in their target dtype become copy-on-write views of the
+    mapped shard instead of copies, processes that load the same shards share the page cache.
+    """
+    shards = checkpoint_shards(path)
+    expected = dict(model.state_dict(keep_vars=True))
+    prefix = getattr(model, "base_model_prefix", "") or ""
+    renames = getattr(model, "_checkpoint_conversion_mapping", None) or {}
+    reader = _ShardReader(chunk_bytes, max_rss)
+    total = sum(shard.stat().st_size for shard in shards)
+    done, skipped = 0, 0
+
+    for i, shard in enumerate(shards, start=1):
+        if progress is not None:
+            progress(f"shard {i}/{len(shards)} {shard.name}", done / total)
+        stats = ShardStats(shard=shard.name)
+        begin = time.perf_counter()
+
+        mapped = torch.from_file(str(shard), shared=False, size=shard.stat().st_size, dtype=torch.uint8) if mmap else None
+        with open(shard, "rb") as f:
+            header, base = _read_header(f)
+            for name, info in header.items():
+                scale_info = header.get(name + INT8_SCALE_SUFFIX)
+                if name.endswith(INT8_SCALE_SUFFIX) and name[:-len(INT8_SCALE_SUFFIX)] in header:
+                    continue  # read together with its weight
+                key = _resolve(name, expected, prefix, renames)
+                if key is None:
+                    skipped += 1
+                    continue
+                device = placement(key)
+                if device is None and sink is None:
+                    continue
+                source_dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+                quantized = scale_info is not None and source_dtype == torch.int8
+                if source_dtype.is_floating_point or quantized:
+                    target_dtype = torch.float32 if _keep_fp32(key, model) else dtype
+                else:
+                    target_dtype = source_dtype
+
+                if quantized and int8 is not None:
+                    int8[key] = _read_int8(f, base, info, scale_info, reader, stats)
+                    stats.tensors += 1
+                    continue
+                if quantized:
+                    # dequantized chunk by chunk on its way in, the int8 tensor is never held as a whole
+                    target = torch.empty(info["shape"], dtype=target_dtype, device=device or "cpu")
+                    scale = _read_scale(f, base, scale_info, reader, stats).to(target.device, target_dtype)
+                    reader.copy(f, base + info["data_offsets"][0], torch.int8, target, stats, scale=scale)
+                    del scale
+                elif mapped is not None and device == "cpu" and source_dtype == target_dtype \
+                        and (base + info["data_offsets"][0]) % torch.empty((), dtype=target_dtype).element_size() == 0:
+                    begin_byte, end_byte = (base + offset for offset in info["data_offsets"])
+                    target = mapped[begin_byte:end_byte].view(target_dtype).view(info["shape"])
+                    stats.bytes += end_byte - begin_byte
+                else:
+                    target = torch.empty(info["shape"], dtype=target_dtype, device=device or "cpu")
+                    reader.copy(f, base + info["data_offsets"][0], source_dtype, target, stats)
+                if device is None:
+                    sink(key, target)
+                else:
+                    _set_tensor(model, key, target)
+                stats.tensors += 1
+                del target
+
+        stats.seconds = time.perf_counter() - begin
+        stats.peak_rss = max(stats.peak_rss, current_rss())
+        done += shard.stat().st_size
+        report.shards.append(stats)
+        LOGGER.info(f"Loaded {shard.name}: {stats.summary()}")
+    return skipped
+
+
+def load_causal_lm(model_path: Union[str, Path], *, dtype: Optional[torch.dtype] = torch.bfloat16,
+                   device: str = "cuda", max_memory: Optional[dict] = None, trust_remote_code: bool = False,
+                   local_files_only: bool = True, max_rss_gib: Optional[float] = None,
+                   chunk_mb: Optional[int] = None, mmap: Optional[bool] = None,
+                   progress: Optional[Callable[[str, float], None]] = None):
+    """
+    Builds the model on the meta device and streams the safetensors shards chunk by chunk straight
+    into the target dtype and device, so peak host memory stays near one chunk instead of a full
+    fp32 copy of the model. device="auto" spreads the layers like device_map="auto" (needs accelerate).
+
+    max_rss_gib (env MODEL_LOAD_MAX_RSS_GIB, 0 = no ceiling) bounds the resident memory of the
+    process while loading, chunks shrink to stay under it and MemoryError is raised if even a
+    single row does not fit. chunk_mb (env MODEL_LOAD_CHUNK_MB) is the read size per copy.
+    mmap (env MODEL_LOAD_MMAP) maps CPU weights that are stored in the target dtype (e.g. a
+    converted artifact) instead of copying them, CPU replicas then share one copy of the weights.
+    Checkpoints without safetensors fall back to from_pretrained(low_cpu_mem_usage=True).
+
+    A converted artifact (see utils.generation.convert) is picked up instead of the checkpoint,
+    dtype None keeps its stored dtype. Its int8 weights become dynamic int8 linears on the CPU
+    (the rest of the model runs in fp32 there) and are dequantized on other devices.
+
+    Returns (model, LoadReport).
+    """
+    path = resolve_artifact(model_path)
+    manifest = read_manifest(path)
+    quantized = manifest is not None and manifest.get("quantization") == "int8"
+    max_rss_gib = float(os.getenv("MODEL_LOAD_MAX_RSS_GIB", "0")) if max_rss_gib is None else float(max_rss_gib)
+    chunk_mb = int(os.getenv("MODEL_LOAD_CHUNK_MB", "256")) if chunk_mb is None else int(chunk_mb)
+    max_rss = int(max_rss_gib * 2**30) if max_rss_gib > 0 else None
+    mmap = os.getenv("MODEL_LOAD_MMAP", "false").lower() == "true" if mmap is None else bool(mmap)
+
+    report = LoadReport(path=str(path), device=str(device), dtype=str(dtype).replace("torch.", ""), max_rss=max_rss)
+    start = time.perf_counter()
+
+    def from_pretrained(reason: str):
+        if quantized:
+            raise RuntimeError(f"{reason}: the int8 artifact {path} can only be loaded by streaming")
+        LOGGER.warning(f"{reason}, falling back to from_pretrained for {path}")
+        report.streamed = False
+        model = AutoModelForCausalLM.from_pretrained(
+            path if path.exists() else model_path, torch_dtype=dtype or "auto", device_map=device, low_cpu_mem_usage=True,
+            max_memory=max_memory, trust_remote_code=trust_remote_code, local_files_only=local_files_only,
+        )
+        report.seconds = time.perf_counter() - start
+        return model.eval(), report
+
+    if not (path.is_dir() and checkpoint_shards(path)):
+        return from_pretrained("No safetensors shards")
+
+    model, dtype = empty_model(path, dtype, trust_remote_code=trust_remote_code, local_files_only=local_files_only)
+    report.dtype = str(dtype).replace("torch.", "")
+    if manifest is not None and manifest.get("dtype") != report.dtype:
+        LOGGER.info(f"Artifact {path} is stored in {manifest.get('dtype')}, casting to {report.dtype}")
+
+    device_map = _auto_device_map(model, dtype, max_memory) if device == "auto" else {"": device}
+    if "disk" in device_map.values():
+        raise MemoryError(f"{path} does not fit into GPU and CPU memory, disk offload is not supported here")
+
+    def device_of(name: str) -> str:
+        placement = _placement(name, device_map)
+        return f"cuda:{placement}" if isinstance(placement, int) else placement
+
+    int8 = {} if quantized and device == "cpu" else None
+    skipped = stream_checkpoint(model, path, dtype=dtype, placement=device_of, report=report,
+                                chunk_bytes=chunk_mb * 2**20, max_rss=max_rss, int8=int8, mmap=mmap,
+                                progress=progress)
+    if int8:
+        _install_int8(model, int8)
+        # the dynamic int8 kernels take fp32 activations
+        model.float()
+        report.dtype = "int8"
+        int8.clear()
+
+    # tied weights (lm_head / embeddings) are stored once
+    model.tie_weights()
+    missing = [name for name, tensor in model.state_dict(keep_vars=True).items() if tensor.device.type == "meta"]
+    missing += [name for name, buffer in model.named_buffers() if buffer.is_meta and name not in missing]
+    if missing:
+        # layout this loader does not know (e.g. multimodal wrappers) or buffers it cannot rebuild,
+        # let transformers map the keys
+        del model
+        gc.collect()
+        return from_pretrained(f"{len(missing)} weights or buffers not found in the shards ({missing[:3]})")
+    if skipped:
+        LOGGER.warning(f"Ignored {skipped} checkpoint tensors that the model does not use")
+
+    # non-persistent buffers were created on the host
+    placements = set(device_map.values())
+    if len(placements) == 1:
+        placement = placements.pop()
+        model.to(f"cuda:{placement}" if isinstance(placement, int) else placement)
+    else:
+        from accelerate import dispatch_model
+        model = dispatch_model(model, device_map=device_map)
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(path, local_files_only=local_files_only)
+    except (OSError, ValueError):
+        pass
+
+    report.seconds = time.perf_counter() - start
+    LOGGER.info(f"Model {path.name} loaded in {report.seconds:.1f}s, peak RSS {report.peak_rss / 2**30:.2f} GiB")
+    return model.eval(), report
+
+
+def _check(max_rss_headroom_mib: int = 512):
+    """
+    Streams a tiny random Llama checkpoint, plain and with int8 linears, under a resident memory
+    ceiling and compares the weights with what from_pretrained loads.
+    """
+    import tempfile
+    from safetensors.torch import save_file
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    from .convert import quantize_int8
+
+    torch.manual_seed(0)
+    # MLP weights of 2 MiB in int8, read in several 1 MiB chunks
+    config = LlamaConfig(vocab_size=1024, hidden_size=512, intermediate_size=4096, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=False)
+    source = LlamaForCausalLM(config).eval()
+
+    def same(model, reference: dict, what: str):
+        loaded = model.state_dict()
+        assert loaded.keys() == reference.keys(), f"{what}: {set(loaded) ^ set(reference)}"
+        for name, tensor in reference.items():
+            assert loaded[name].dtype == tensor.dtype, f"{what}: {name} is {loaded[name].dtype}, not {tensor.dtype}"
+            assert torch.equal(loaded[name], tensor), f"{what}: {name} differs"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        plain, quantized = Path(tmp) / "plain", Path(tmp) / "int8"
+        source.save_pretrained(plain, safe_serialization=True, max_shard_size="16MB")
+
+        weights = {name: tensor.detach().clone() for name, tensor in source.state_dict().items()}
+        tensors, reference = {}, {}
+        for name, tensor in weights.items():
+            if tensor.dim() == 2 and name != "model.embed_tokens.weight":
+                q, scale = quantize_int8(tensor)
+                tensors.update({name: q, name + INT8_SCALE_SUFFIX: scale})
+                reference[name] = q.to(torch.float32) * scale.unsqueeze(1)
+            else:
+                tensors[name] = tensor
+                reference[name] = tensor
+        quantized.mkdir()
+        save_file(tensors, str(quantized / "model.safetensors"))
+        config.save_pretrained(quantized)
+
+        ceiling = (current_rss() + max_rss_headroom_mib * 2**20) / 2**30
+        model, report = load_causal_lm(plain, dtype=torch.bfloat16, device="cpu", max_rss_gib=ceiling, chunk_mb=1)
+        assert report.streamed and len(report.shards) > 1, report.summary()
+        expected = AutoModelForCausalLM.from_pretrained(plain, torch_dtype=torch.bfloat16, local_files_only=True)
+        same(model, expected.state_dict(), "bf16 checkpoint")
+        # the rotary tables are not in the checkpoint, they have to be rebuilt
+        ids = torch.randint(0, config.vocab_size, (1, 16))
+        with torch.inference_mode():
+            assert torch.equal(model(ids).logits, expected(ids).logits), "bf16 checkpoint: logits differ"
+        del model, expected
+
+        # without a serving manifest the int8 weights are dequantized (the GPU path), on the CPU here
+        model, report = load_causal_lm(quantized, dtype=torch.float32, device="cpu", max_rss_gib=ceiling, chunk_mb=1)
+        assert report.streamed, report.summary()
+        same(model, reference, "int8 checkpoint")
+        assert report.peak_rss <= ceiling * 2**30, report.summary()
+    print(f"streamed loads match from_pretrained, peak RSS {report.peak_rss / 2**20:.0f} MiB "
+          f"under a ceiling of {ceiling * 2**10:.0f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a local checkpoint with bounded host memory and print per-shard stats")
+    parser.add_argument("model", nargs="?", help="path to a local model folder with safetensors shards")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="bfloat16")
+    parser.add_argument("--max-rss-gib", type=float, default=0.0)
+    parser.add_argument("--chunk-mb", type=int, default=64)
+    parser.add_argument("--check", action="store_true",
+                        help="compare streamed loads of a tiny random checkpoint with from_pretrained")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.check:
+        _check()
+    elif args.model is None:
+        parser.error("a model folder or --check is required")
+    else:
+        _, load_report = load_causal_lm(args.model, dtype=getattr(torch, args.dtype), device=args.device,
+                                        max_rss_gib=args.max_rss_gib, chunk_mb=args.chunk_mb)
+        print(json.dumps(load_report.summary(), indent=2))
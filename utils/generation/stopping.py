@@ -0,0 +1,51 @@
+from typing import Iterable
+import threading
+
+import torch
+from transformers import StoppingCriteria
+
+# torch-free, shared with the llama.cpp backends
+from ..serving.stopping import StopSequenceFilter, stop_at
+
+
+class CancelCriteria(StoppingCriteria):
+    """ stops generate() at the next decoding step once cancel() was called (e.g. client disconnected) """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self._event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    Stops a sequence once its generated text contains one of the stop strings.
+
+    Only the tokens added since the last step plus a tail as long as the longest stop string are
+    decoded, a stop string never spans more tokens than it has characters.
+    """
+
+    def __init__(self, tokenizer, stop: Iterable[str], prompt_len: int):
+        self._tokenizer = tokenizer
+        self._stop = [s for s in stop if s]
+        self._tail = max((len(s) for s in self._stop), default=0)
+        self._prompt_len = int(prompt_len)
+        self._seen = self._prompt_len
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        start = max(self._prompt_len, self._seen - self._tail)
+        self._seen = input_ids.shape[-1]
+
+        done = []
+        for row in input_ids[:, start:].tolist():
+            text = self._tokenizer.decode(row, skip_special_tokens=True)
+            done.append(any(s in text for s in self._stop))
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,65 @@
+from typing import Optional
+import logging
+
+import torch
+from transformers import LogitsProcessor
+
+LOGGER = logging.getLogger(__name__)
+
+
+def think_token_ids(tokenizer, open_tag: str = "<think>", close_tag: str = "</think>") -> Optional[tuple[int, int]]:
+    """ ids of the think tags, None unless both are single tokens of the vocabulary """
+    ids = []
+    for tag in (open_tag, close_tag):
+        encoded = tokenizer.encode(tag, add_special_tokens=False)
+        if len(encoded) != 1:
+            return None
+        ids.append(int(encoded[0]))
+    return ids[0], ids[1]
+
+
+class ThinkingBudgetProcessor(LogitsProcessor):
+    """
+    Controls reasoning blocks while decoding instead of filtering the text afterwards.
+
+    disable: the opening think token is never sampled; a block already opened by the chat
+    template is closed right away.
+    budget: once a block has run for `budget` tokens the closing think token is forced.
+    """
+
+    def __init__(self, think_ids: tuple[int, int], *, disable: bool = False, budget: Optional[int] = None):
+        self._open_id, self._close_id = think_ids
+        self._disable = bool(disable)
+        self._budget = None if budget is None else max(0, int(budget))
+
+    @classmethod
+    def create(cls, tokenizer, *, disable: bool = False, budget: Optional[int] = None) -> Optional["ThinkingBudgetProcessor"]:
+        """ processor for the tokenizer, None if there is nothing to control or no think tokens exist """
+        if not disable and budget is None:
+            return None
+        think_ids = think_token_ids(tokenizer)
+        if think_ids is None:
+            LOGGER.info("Tokenizer has no single-token think tags, thinking control is text-only")
+            return None
+        return cls(think_ids, disable=disable, budget=budget)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        # stateless: assisted generation rolls input_ids back when drafts are rejected
+        length = input_ids.shape[-1]
+        positions = torch.arange(length, device=input_ids.device)
+        last_open = torch.where(input_ids == self._open_id, positions, -1).max(dim=-1).values
+        last_close = torch.where(input_ids == self._close_id, positions, -1).max(dim=-1).values
+        in_think = last_open > last_close
+
+        if self._disable:
+            scores[~in_think, self._open_id] = -float("inf")
+            force = in_think
+        elif self._budget is not None:
+            force = in_think & (length - 1 - last_open >= self._budget)
+        else:
+            return scores
+
+        if force.any():
+            scores[force] = -float("inf")
+            scores[force, self._close_id] = 0.0
+        return scores
@@ -0,0 +1,6 @@
+# Helpers for the llama.cpp (GGUF) backends. Not re-exported from utils,
+# only the GGUF images install llama-cpp-python.
+from .batch import BatchedDecoder
+from .context import shared_llama
+from .state_cache import PrefixStateCache, common_prefix, prime_prefix
+from .tune import load_tuned, tuned_config_path
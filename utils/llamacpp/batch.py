@@ -0,0 +1,288 @@
+from typing import Callable, Iterable, Iterator, Optional
+from collections import deque
+from dataclasses import dataclass, field
+from queue import Queue
+import codecs
+import logging
+import threading
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+
+from ..serving.stopping import StopSequenceFilter
+from .state_cache import PrefixStateCache, get_seq_state, seq_rm, set_seq_state
+
+_END = object()
+
+
+def _context(llm: Llama, n_ctx: int, n_batch: int, n_seq: int, n_threads: Optional[int]):
+    """ a context of its own over the model of llm, with the thread, attention and KV cache settings of llm's """
+    own = llm.context_params
+    params = llama_cpp.llama_context_default_params()
+    params.n_ctx = n_ctx
+    params.n_batch = n_batch
+    params.n_ubatch = min(n_batch, own.n_ubatch)
+    params.n_seq_max = n_seq
+    params.n_threads = n_threads or own.n_threads
+    params.n_threads_batch = n_threads or own.n_threads_batch
+    for name in ("flash_attn_type", "flash_attn", "type_k", "type_v"):
+        if hasattr(own, name):
+            setattr(params, name, getattr(own, name))
+    init = getattr(llama_cpp, "llama_init_from_model", None) or llama_cpp.llama_new_context_with_model
+    ctx = init(llm.model, params)
+    if not ctx:
+        raise RuntimeError(f"llama.cpp could not create a context for {n_seq} sequences of {n_ctx // n_seq} tokens")
+    return ctx
+
+
+def _end_of_generation(llm: Llama) -> Callable[[int], bool]:
+    if hasattr(llama_cpp, "llama_vocab_is_eog"):
+        vocab = llama_cpp.llama_model_get_vocab(llm.model)
+        return lambda token: bool(llama_cpp.llama_vocab_is_eog(vocab, token))
+    if hasattr(llama_cpp, "llama_token_is_eog"):
+        return lambda token: bool(llama_cpp.llama_token_is_eog(llm.model, token))
+    eos = llm.token_eos()
+    return lambda token: token == eos
+
+
+def sample(logits: np.ndarray, temperature: float, top_p: float, rng: np.random.Generator) -> int:
+    """ greedy for temperature 0, otherwise nucleus sampling on the softmax """
+    if temperature <= 0.0:
+        return int(np.argmax(logits))
+    z = logits.astype(np.float64) / temperature
+    z -= z.max()
+    p = np.exp(z)
+    p /= p.sum()
+    if top_p < 1.0:
+        order = np.argsort(-p)
+        keep = order[:int(np.searchsorted(np.cumsum(p[order]), top_p)) + 1]
+        return int(rng.choice(keep, p=p[keep] / p[keep].sum()))
+    return int(rng.choice(len(p), p=p))
+
+
+@dataclass
+class _Sequence:
+    tokens: list[int]
+    max_tokens: int
+    temperature: float
+    top_p: float
+    stop: StopSequenceFilter
+    logits_processor: Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]]
+    out: Queue = field(default_factory=Queue)
+    seq_id: int = -1
+    pos: int = 0
+    generated: int = 0
+    cancelled: bool = False
+    prefix_len: int = 0
+    snapshot: Optional[str] = None
+    decoder: codecs.IncrementalDecoder = field(default_factory=lambda: codecs.getincrementaldecoder("utf-8")("replace"))
+
+    @property
+    def pending(self) -> int:
+        """ tokens not yet in the KV cache """
+        return len(self.tokens) - self.pos
+
+
+class BatchedDecoder:
+    """
+    Decodes up to n_seq requests together in one llama.cpp context.
+
+    Every step packs one token of each running sequence plus prompt chunks of new ones (up to
+    n_batch tokens) into a single llama_decode, so concurrent requests share the forward pass
+    instead of queueing for it. The KV cache of n_ctx cells is split evenly, each sequence
+    gets n_ctx // n_seq positions and its cells are freed as soon as it finishes.
+
+    Sampling (temperature / top-p) and stop strings run in Python on the logits of each
+    sequence; logits processors get (tokens so far, logits) like in llama-cpp-python.
+
+    With a PrefixStateCache, the first prefix_len tokens of a request (its system prompt) are
+    restored from a saved sequence state when possible, otherwise saved once they are evaluated.
+    """
+
+    def __init__(self, llm: Llama, n_seq: int, n_ctx: int, n_batch: int = 512,
+                 n_threads: Optional[int] = None, name: str = "batched", seed: Optional[int] = None,
+                 cache: Optional[PrefixStateCache] = None):
+        self._llm = llm
+        self._cache = cache
+        self._n_seq = max(1, int(n_seq))
+        self._n_batch = max(self._n_seq, int(n_batch))
+        self._seq_ctx = int(n_ctx) // self._n_seq
+        self._name = name
+        self._logger = logging.getLogger(__name__)
+        self._ctx = _context(llm, self._seq_ctx * self._n_seq, self._n_batch, self._n_seq, n_threads)
+        self._batch = llama_cpp.llama_batch_init(self._n_batch, 0, self._n_seq)
+        self._n_vocab = llm.n_vocab()
+        self._is_eog = _end_of_generation(llm)
+        self._rng = np.random.default_rng(seed)
+
+        self._waiting: deque[_Sequence] = deque()
+        self._running: dict[int, _Sequence] = {}
+        self._free = list(range(self._n_seq))
+        self._steps = 0
+        self._batch_tokens = 0
+        self._batch_seqs = 0
+        self._generated = 0
+
+        self._wake = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name=f"{name}-decoder", daemon=True)
+        self._thread.start()
+
+    @property
+    def seq_ctx(self) -> int:
+        return self._seq_ctx
+
+    def generate(self, tokens: list[int], *, max_tokens: int, temperature: float, top_p: float,
+                 stop: Optional[Iterable[str]] = None,
+                 logits_processor: Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]] = None,
+                 prefix_len: int = 0) -> Iterator[str]:
+        """ streams the text of one request, closing the iterator frees its sequence """
+        if not tokens:
+            raise ValueError("Empty prompt")
+        if len(tokens) >= self._seq_ctx:
+            raise ValueError(f"Prompt has {len(tokens)} tokens, a sequence holds {self._seq_ctx} "
+                             f"(n_ctx split over {self._n_seq} sequences)")
+        seq = _Sequence(
+            tokens=list(tokens), max_tokens=min(int(max_tokens), self._seq_ctx - len(tokens)),
+            temperature=float(temperature), top_p=float(top_p), stop=StopSequenceFilter(stop or []),
+            logits_processor=logits_processor, prefix_len=min(int(prefix_len), len(tokens) - 1),
+        )
+        with self._wake:
+            self._waiting.append(seq)
+            self._wake.notify()
+        try:
+            while True:
+                item = seq.out.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            seq.cancelled = True
+
+    def _admit(self):
+        while self._waiting and self._free:
+            seq = self._waiting.popleft()
+            if seq.cancelled:
+                continue
+            seq.seq_id = self._free.pop()
+            self._running[seq.seq_id] = seq
+            if self._cache is not None and seq.prefix_len >= self._cache.min_tokens:
+                self._restore(seq)
+
+    def _restore(self, seq: _Sequence):
+        key = self._cache.key(seq.tokens[:seq.prefix_len])
+        data = self._cache.get(key)
+        if data is not None and set_seq_state(self._ctx, seq.seq_id, data):
+            seq.pos = seq.prefix_len
+            self._cache.restored(seq.prefix_len)
+        else:
+            seq.snapshot = key
+
+    def _finish(self, seq: _Sequence, error: Optional[BaseException] = None):
+        if error is None:
+            tail = seq.stop.feed(seq.decoder.decode(b"", final=True)) + seq.stop.flush()
+            if tail:
+                seq.out.put(tail)
+        seq.out.put(error if error is not None else _END)
+        seq_rm(self._ctx, seq.seq_id)
+        del self._running[seq.seq_id]
+        self._free.append(seq.seq_id)
+
+    def _fill(self) -> list[tuple[_Sequence, int]]:
+        """ one token per decoding sequence first, the remaining room goes to prompt chunks """
+        entries, logits_at = [], []
+        decoding = [s for s in self._running.values() if s.pending == 1]
+        prefilling = [s for s in self._running.values() if s.pending > 1]
+        for seq in decoding + prefilling:
+            room = self._n_batch - len(entries)
+            if room <= 0:
+                break
+            take = min(seq.pending, room)
+            if seq.snapshot is not None:
+                # the chunk must end at the prefix so its state can be saved on its own
+                take = min(take, seq.prefix_len - seq.pos)
+            for offset in range(take):
+                entries.append((seq, seq.tokens[seq.pos + offset], seq.pos + offset))
+            seq.pos += take
+            if seq.pending == 0:
+                logits_at.append((seq, len(entries) - 1))
+
+        batch = self._batch
+        wants = {index for _, index in logits_at}
+        for i, (seq, token, pos) in enumerate(entries):
+            batch.token[i] = token
+            batch.pos[i] = pos
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = seq.seq_id
+            batch.logits[i] = i in wants
+        batch.n_tokens = len(entries)
+        self._batch_tokens += len(entries)
+        self._batch_seqs += len({id(seq) for seq, _, _ in entries})
+        return logits_at
+
+    def _emit(self, seq: _Sequence, token: int):
+        piece = self._llm.detokenize([token])
+        text = seq.stop.feed(seq.decoder.decode(piece))
+        if text:
+            seq.out.put(text)
+
+    def _step(self):
+        for seq in [s for s in self._running.values() if s.cancelled]:
+            self._finish(seq)
+        if not self._running:
+            return
+
+        logits_at = self._fill()
+        status = llama_cpp.llama_decode(self._ctx, self._batch)
+        self._steps += 1
+        if status != 0:
+            raise RuntimeError(f"llama_decode returned {status} with {len(self._running)} sequences")
+
+        for seq in self._running.values():
+            if seq.snapshot is not None and seq.pos == seq.prefix_len:
+                self._cache.put(seq.snapshot, get_seq_state(self._ctx, seq.seq_id))
+                seq.snapshot = None
+
+        for seq, index in logits_at:
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self._ctx, index), shape=(self._n_vocab,))
+            if seq.logits_processor is not None:
+                logits = seq.logits_processor(np.asarray(seq.tokens, dtype=np.intc), logits.copy())
+            token = sample(logits, seq.temperature, seq.top_p, self._rng)
+            seq.generated += 1
+            self._generated += 1
+
+            if self._is_eog(token):
+                self._finish(seq)
+                continue
+            seq.tokens.append(token)
+            self._emit(seq, token)
+            if seq.stop.stopped or seq.generated >= seq.max_tokens:
+                self._finish(seq)
+
+    def _loop(self):
+        while True:
+            with self._wake:
+                while not self._waiting and not self._running:
+                    self._wake.wait()
+                self._admit()
+            try:
+                self._step()
+            except Exception as exc:
+                self._logger.exception(f"{self._name}: decoding step failed")
+                for seq in list(self._running.values()):
+                    self._finish(seq, exc)
+
+    def stats(self) -> dict:
+        return {
+            "sequences": self._n_seq,
+            "ctx_per_sequence": self._seq_ctx,
+            "running": len(self._running),
+            "waiting_requests": len(self._waiting),
+            "steps": self._steps,
+            "generated_tokens": self._generated,
+            "avg_batch_tokens": round(self._batch_tokens / self._steps, 1) if self._steps else None,
+            "avg_batch_sequences": round(self._batch_seqs / self._steps, 2) if self._steps else None,
+            "prompt_state_cache": None if self._cache is None else self._cache.stats(),
+        }
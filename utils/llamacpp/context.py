@@ -0,0 +1,33 @@
+import contextlib
+import copy
+import ctypes
+
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp import _internals as internals
+
+
+def shared_llama(llm: Llama) -> Llama:
+    """
+    A Llama over the model of llm with a context of its own: KV cache, batch, token and logit
+    buffers are separate, the weights (GPU layers included) are loaded once. Built with llm's
+    context parameters; llm is kept alive as long as the copy uses its model.
+    """
+    clone = copy.copy(llm)
+    clone._owner = llm
+    clone._stack = contextlib.ExitStack()
+    clone._ctx = clone._stack.enter_context(contextlib.closing(
+        internals.LlamaContext(model=llm._model, params=llm.context_params, verbose=llm.verbose)
+    ))
+    clone._batch = clone._stack.enter_context(contextlib.closing(
+        internals.LlamaBatch(n_tokens=llm.n_batch, embd=0, n_seq_max=llm.context_params.n_ctx, verbose=llm.verbose)
+    ))
+    clone._candidates = internals.LlamaTokenDataArray(n_vocab=llm._n_vocab)
+    clone._chat_handlers = {}
+    clone._sampler = None
+    clone._mirostat_mu = ctypes.c_float(2.0 * 5.0)
+    clone.input_ids = np.ndarray(llm.input_ids.shape, dtype=np.intc)
+    clone.scores = np.ndarray(llm.scores.shape, dtype=np.single)
+    clone.n_tokens = 0
+    clone._requires_eval = True
+    return clone
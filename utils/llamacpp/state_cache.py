@@ -0,0 +1,204 @@
+from typing import Optional, Sequence
+from collections import OrderedDict
+from pathlib import Path
+import ctypes
+import hashlib
+import os
+import threading
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+
+
+def seq_rm(ctx, seq: int):
+    """ drops the KV cells of a sequence, the name moved between llama.cpp versions """
+    if hasattr(llama_cpp, "llama_memory_seq_rm"):
+        llama_cpp.llama_memory_seq_rm(llama_cpp.llama_get_memory(ctx), seq, -1, -1)
+    elif hasattr(llama_cpp, "llama_kv_self_seq_rm"):
+        llama_cpp.llama_kv_self_seq_rm(ctx, seq, -1, -1)
+    else:
+        llama_cpp.llama_kv_cache_seq_rm(ctx, seq, -1, -1)
+
+
+def common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def get_seq_state(ctx, seq: int) -> bytes:
+    """ the KV cells of one sequence, serialized by llama.cpp """
+    size = llama_cpp.llama_state_seq_get_size(ctx, seq)
+    buffer = (ctypes.c_uint8 * size)()
+    if len(llama_cpp.llama_state_seq_get_data.argtypes) == 4:
+        written = llama_cpp.llama_state_seq_get_data(ctx, buffer, size, seq)
+    else:
+        written = llama_cpp.llama_state_seq_get_data(ctx, buffer, seq)
+    return bytes(buffer[:written])
+
+
+def set_seq_state(ctx, seq: int, data: bytes) -> bool:
+    """ restores saved cells into (an emptied) sequence, False if llama.cpp rejects them """
+    seq_rm(ctx, seq)
+    buffer = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+    if len(llama_cpp.llama_state_seq_set_data.argtypes) == 4:
+        read = llama_cpp.llama_state_seq_set_data(ctx, buffer, len(data), seq)
+    else:
+        read = llama_cpp.llama_state_seq_set_data(ctx, buffer, seq)
+    return read > 0
+
+
+class PrefixStateCache:
+    """
+    Saved llama.cpp KV states of prompt prefixes (the long system prompts), most recent first.
+
+    A RAM tier of ram_mb holds the hot entries; entries evicted from it move to the optional disk
+    tier (disk_dir, disk_mb), which survives restarts and is shared by replicas. Keys cover the
+    model file and the prefix tokens, so states never mix between models. Prefixes shorter than
+    min_tokens are not worth a restore and are skipped.
+    """
+
+    def __init__(self, model_id: str, ram_mb: int = 0, disk_dir: Optional[Path] = None, disk_mb: int = 0,
+                 min_tokens: int = 64):
+        self._model_id = model_id
+        self._ram_bytes = int(ram_mb) * 2**20
+        self._disk_dir = Path(disk_dir) if disk_dir and int(disk_mb) > 0 else None
+        self._disk_bytes = int(disk_mb) * 2**20
+        self.min_tokens = int(min_tokens)
+
+        self._ram: OrderedDict[str, bytes] = OrderedDict()
+        self._ram_used = 0
+        self._lock = threading.Lock()
+        self._hits = {"resident": 0, "ram": 0, "disk": 0}
+        self._misses = 0
+        self._saved_tokens = 0
+        if self._disk_dir is not None:
+            self._disk_dir.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, model_path: Path) -> Optional["PrefixStateCache"]:
+        """ PROMPT_STATE_CACHE_MB (0 = off), PROMPT_STATE_DISK_DIR / _DISK_MB, PROMPT_STATE_MIN_TOKENS """
+        ram_mb = int(os.getenv("PROMPT_STATE_CACHE_MB", "0"))
+        disk_mb = int(os.getenv("PROMPT_STATE_DISK_MB", "0"))
+        if ram_mb <= 0 and disk_mb <= 0:
+            return None
+        stat = Path(model_path).stat()
+        model_id = f"{Path(model_path).name}:{stat.st_size}:{stat.st_mtime_ns}"
+        return cls(model_id, ram_mb=ram_mb, disk_dir=os.getenv("PROMPT_STATE_DISK_DIR") or None, disk_mb=disk_mb,
+                   min_tokens=int(os.getenv("PROMPT_STATE_MIN_TOKENS", "64")))
+
+    def key(self, tokens: Sequence[int]) -> str:
+        digest = hashlib.sha1(self._model_id.encode())
+        digest.update(np.asarray(tokens, dtype=np.int32).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._ram.get(key)
+            if data is not None:
+                self._ram.move_to_end(key)
+                self._hits["ram"] += 1
+                return data
+        path = None if self._disk_dir is None else self._disk_dir / f"{key}.state"
+        if path is not None and path.exists():
+            data = path.read_bytes()
+            path.touch()
+            with self._lock:
+                self._hits["disk"] += 1
+            self._remember(key, data)
+            return data
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def hit_resident(self):
+        """ the context still held the prefix from its previous request, nothing to restore """
+        with self._lock:
+            self._hits["resident"] += 1
+
+    def restored(self, tokens: int):
+        """ a saved state replaced the evaluation of `tokens` prompt tokens """
+        with self._lock:
+            self._saved_tokens += tokens
+
+    def put(self, key: str, data: bytes):
+        self._remember(key, data)
+
+    def _remember(self, key: str, data: bytes):
+        evicted = []
+        with self._lock:
+            if key in self._ram:
+                return
+            if len(data) <= self._ram_bytes:
+                self._ram[key] = data
+                self._ram_used += len(data)
+                while self._ram_used > self._ram_bytes:
+                    old_key, old = self._ram.popitem(last=False)
+                    self._ram_used -= len(old)
+                    evicted.append((old_key, old))
+            else:
+                evicted.append((key, data))
+        for old_key, old in evicted:
+            self._spill(old_key, old)
+
+    def _spill(self, key: str, data: bytes):
+        if self._disk_dir is None or len(data) > self._disk_bytes:
+            return
+        path = self._disk_dir / f"{key}.state"
+        if not path.exists():
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(data)
+            tmp.replace(path)
+        # oldest files first until the tier fits
+        files = sorted(self._disk_dir.glob("*.state"), key=lambda f: f.stat().st_mtime)
+        used = sum(f.stat().st_size for f in files)
+        for f in files:
+            if used <= self._disk_bytes:
+                break
+            used -= f.stat().st_size
+            f.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = sum(self._hits.values())
+            lookups = hits + self._misses
+            return {
+                "entries": len(self._ram),
+                "ram_mb": round(self._ram_used / 2**20, 1),
+                "ram_limit_mb": round(self._ram_bytes / 2**20, 1),
+                "disk_entries": 0 if self._disk_dir is None else len(list(self._disk_dir.glob("*.state"))),
+                "hits": dict(self._hits),
+                "misses": self._misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else None,
+                "saved_prefill_tokens": self._saved_tokens,
+            }
+
+
+def prime_prefix(llm: Llama, cache: PrefixStateCache, prefix: Sequence[int]):
+    """
+    Makes the context of a (high level) Llama hold `prefix` before the completion call, which
+    then only evaluates the tokens after it: resident prefix, restored state, or evaluated once
+    and saved for the next request.
+    """
+    n = len(prefix)
+    if n < cache.min_tokens:
+        return
+    if llm.n_tokens >= n and common_prefix(llm.input_ids[:n].tolist(), prefix) == n:
+        cache.hit_resident()
+        return
+
+    key = cache.key(prefix)
+    data = cache.get(key)
+    if data is not None and set_seq_state(llm.ctx, 0, data):
+        llm.input_ids[:n] = prefix
+        llm.n_tokens = n
+        cache.restored(n)
+        return
+
+    llm.reset()
+    llm.eval(list(prefix))
+    cache.put(key, get_seq_state(llm.ctx, 0))
@@ -0,0 +1,307 @@
+from typing import Optional
+from multiprocessing.connection import Connection
+from pathlib import Path
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import time
+
+from ..serving.warmup import WARMUP_PROMPTS
+
+LOGGER = logging.getLogger(__name__)
+
+TUNED_SUFFIX = ".tuned.json"
+TUNED_VERSION = 1
+# KV cache types by name, the values are the ggml type ids llama.cpp expects for type_k / type_v
+KV_TYPES = {"f16": 1, "q8_0": 8, "q4_0": 2}
+TUNED_KEYS = ("n_threads", "n_threads_batch", "n_batch", "n_ubatch", "flash_attn", "kv_type", "use_mlock")
+
+
+def tuned_config_path(model_path: Path) -> Optional[Path]:
+    """ LLAMA_TUNED_CONFIG, default <model>.tuned.json next to the GGUF, "off" disables it """
+    value = os.getenv("LLAMA_TUNED_CONFIG", "")
+    if value.lower() == "off":
+        return None
+    model_path = Path(model_path)
+    return Path(value) if value else model_path.with_name(model_path.name + TUNED_SUFFIX)
+
+
+def model_fingerprint(model_path: Path) -> str:
+    stat = Path(model_path).stat()
+    return f"{Path(model_path).name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def physical_cores() -> int:
+    """ usable cores without their SMT siblings """
+    allowed = os.sched_getaffinity(0)
+    cores = set()
+    for cpu in allowed:
+        siblings = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+        cores.add(siblings.read_text().strip() if siblings.exists() else str(cpu))
+    return max(1, len(cores))
+
+
+def host_fingerprint(n_gpu_layers: int) -> dict:
+    """ what a tuned config depends on besides the model, it is ignored on any other host """
+    cpu_model = platform.processor()
+    cpuinfo = Path("/proc/cpuinfo")
+    if cpuinfo.exists():
+        for line in cpuinfo.read_text().splitlines():
+            if line.startswith("model name"):
+                cpu_model = line.split(":", 1)[1].strip()
+                break
+    return {"cpu_model": cpu_model, "cpus": len(os.sched_getaffinity(0)), "n_gpu_layers": int(n_gpu_layers)}
+
+
+def llama_kwargs(params: dict) -> dict:
+    """ tuned parameters as Llama(...) keyword arguments """
+    kwargs = {k: v for k, v in params.items() if k in TUNED_KEYS and k != "kv_type"}
+    if "kv_type" in params:
+        kwargs["type_k"] = kwargs["type_v"] = KV_TYPES[params["kv_type"]]
+    return kwargs
+
+
+def load_tuned(model_path: Path, n_gpu_layers: int) -> dict:
+    """
+    Llama(...) keyword arguments from the tuned config of a model, empty without one or when it
+    was tuned for another model file or host.
+    """
+    path = tuned_config_path(model_path)
+    if path is None or not path.exists() or not Path(model_path).exists():
+        return {}
+    try:
+        config = json.loads(path.read_text())
+    except (OSError, ValueError) as e:
+        LOGGER.warning(f"Ignoring tuned config {path}: {e}")
+        return {}
+    if config.get("version") != TUNED_VERSION or config.get("model") != model_fingerprint(model_path):
+        LOGGER.warning(f"Ignoring tuned config {path}: tuned for another model file, run the tuner again")
+        return {}
+    if config.get("host") != host_fingerprint(n_gpu_layers):
+        LOGGER.warning(f"Ignoring tuned config {path}: tuned on another host ({config.get('host')})")
+        return {}
+    LOGGER.info(f"Using tuned llama.cpp settings from {path}: {config['params']}")
+    return llama_kwargs(config["params"])
+
+
+def _render(sample: dict) -> str:
+    return f"{sample['system_prompt']}\n\n{sample['prompt']}"
+
+
+def _locked_gib() -> float:
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith("VmLck:"):
+            return int(line.split()[1]) / 2**20
+    return 0.0
+
+
+def _trial(conn: Connection, model_path: str, params: dict, prompts: list, n_ctx: int, n_gpu_layers: int,
+           decode_tokens: int):
+    """ child process: load with `params`, then time prefill and greedy decoding of every prompt """
+    try:
+        from llama_cpp import Llama
+
+        begin = time.perf_counter()
+        llm = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False,
+                    **llama_kwargs(params))
+        load_s = time.perf_counter() - begin
+
+        # pages the weights in before anything is timed
+        llm.reset()
+        llm.eval(llm.tokenize(b"Warm-up", add_bos=True))
+
+        prefill_tokens = decode_done = 0
+        prefill_s = decode_s = 0.0
+        for sample in prompts:
+            tokens = llm.tokenize(_render(sample).encode("utf-8"), add_bos=True, special=True)
+            llm.reset()
+            begin = time.perf_counter()
+            llm.eval(tokens)
+            prefill_s += time.perf_counter() - begin
+            prefill_tokens += len(tokens)
+
+            begin = time.perf_counter()
+            for _ in range(decode_tokens):
+                token = llm.sample(temp=0.0)
+                if llm.n_tokens >= n_ctx:
+                    break
+                llm.eval([token])
+                decode_done += 1
+            decode_s += time.perf_counter() - begin
+
+        conn.send({
+            "load_s": round(load_s, 2),
+            "prefill_tok_s": round(prefill_tokens / prefill_s, 2),
+            "decode_tok_s": round(decode_done / decode_s, 2),
+            "prompt_tokens": prefill_tokens / len(prompts),
+            "peak_rss_gib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20, 2),
+            "locked_gib": round(_locked_gib(), 2),
+        })
+    except Exception as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        conn.close()
+
+
+def measure(model_path: Path, params: dict, prompts: list, *, n_ctx: int, n_gpu_layers: int,
+            decode_tokens: int, timeout_s: float) -> dict:
+    """ one trial in a fresh process, so memory is measured per config and a crash only fails the trial """
+    mp = multiprocessing.get_context("spawn")
+    parent, child = mp.Pipe(duplex=False)
+    process = mp.Process(target=_trial, args=(child, str(model_path), params, prompts, n_ctx, n_gpu_layers,
+                                              decode_tokens), daemon=True)
+    process.start()
+    child.close()
+    try:
+        result = parent.recv() if parent.poll(timeout_s) else None
+    except EOFError:
+        # the child died before reporting, e.g. killed for memory
+        result = None
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+    if result is None:
+        result = {"error": f"no result (exit code {process.exitcode}, timeout {timeout_s:.0f}s)"}
+    return {"params": dict(params), **result}
+
+
+def request_seconds(result: dict, new_tokens: int) -> float:
+    """ modelled latency of a typical request: its prompt at prefill speed plus new_tokens at decode speed """
+    return result["prompt_tokens"] / result["prefill_tok_s"] + new_tokens / result["decode_tok_s"]
+
+
+def _stages(threads: list[int], batches: list[int], kv_types: list[str], mlock: bool) -> list:
+    # one knob at a time from the best setting so far, a full grid would mean hundreds of model loads
+    return [
+        ("n_threads", threads),
+        ("n_threads_batch", sorted(set(threads + [len(os.sched_getaffinity(0))]))),
+        ("n_batch", batches),
+        ("n_ubatch", sorted({min(b, 512) for b in batches} | {128, 256})),
+        ("flash_attn", [False, True]),
+        ("kv_type", kv_types),
+        ("use_mlock", [False, True] if mlock else [False]),
+    ]
+
+
+def _preferred(key: str, result: dict, best: dict, new_tokens: int, tolerance: float) -> bool:
+    """
+    Faster wins. Within `tolerance` of the best time a smaller footprint wins, and mlock wins
+    when it actually locked the weights (no page-outs under memory pressure).
+    """
+    seconds, best_seconds = request_seconds(result, new_tokens), request_seconds(best, new_tokens)
+    if seconds < best_seconds * (1 - tolerance):
+        return True
+    if seconds > best_seconds * (1 + tolerance):
+        return False
+    if key == "use_mlock":
+        return result["params"]["use_mlock"] and result["locked_gib"] > 0
+    return result["peak_rss_gib"] < best["peak_rss_gib"]
+
+
+def tune(model_path: Path, *, prompts: Optional[list] = None, n_ctx: int = 8192, n_gpu_layers: int = -1,
+         decode_tokens: int = 64, new_tokens: int = 200, tolerance: float = 0.03,
+         threads: Optional[list[int]] = None, batches: Optional[list[int]] = None,
+         kv_types: Optional[list[str]] = None, mlock: bool = True, max_rss_gib: float = 0.0,
+         timeout_s: float = 1800, out: Optional[Path] = None) -> dict:
+    """ sweeps the llama.cpp settings on this host and writes the fastest as a tuned config """
+    model_path = Path(model_path)
+    prompts = WARMUP_PROMPTS if prompts is None else prompts
+    cores, logical = physical_cores(), len(os.sched_getaffinity(0))
+    threads = threads or sorted({max(1, cores // 2), cores, logical})
+    batches = batches or [256, 512, 1024, 2048]
+    kv_types = kv_types or list(KV_TYPES)
+    begin = time.perf_counter()
+
+    def run(params: dict) -> dict:
+        result = measure(model_path, params, prompts, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers,
+                         decode_tokens=decode_tokens, timeout_s=timeout_s)
+        if "error" not in result and max_rss_gib and result["peak_rss_gib"] > max_rss_gib:
+            result["error"] = f"peak RSS {result['peak_rss_gib']} GiB over the {max_rss_gib} GiB limit"
+        LOGGER.info(f"{params} -> " + (result["error"] if "error" in result else
+                    f"prefill {result['prefill_tok_s']} tok/s, decode {result['decode_tok_s']} tok/s, "
+                    f"{request_seconds(result, new_tokens):.1f}s/request, RSS {result['peak_rss_gib']} GiB"))
+        trials.append(result)
+        return result
+
+    trials: list[dict] = []
+    params = {"n_threads": cores, "n_threads_batch": logical, "n_batch": 512, "n_ubatch": 512,
+              "flash_attn": False, "kv_type": "f16", "use_mlock": False}
+    baseline = best = run(params)
+    if "error" in best:
+        raise RuntimeError(f"Baseline trial failed: {best['error']}")
+
+    for key, candidates in _stages(threads, batches, kv_types, mlock):
+        for value in candidates:
+            if value == best["params"][key]:
+                continue
+            candidate = {**best["params"], key: value}
+            if candidate["n_ubatch"] > candidate["n_batch"]:
+                continue
+            # llama.cpp only quantizes the V cache with flash attention
+            if candidate["kv_type"] != "f16" and not candidate["flash_attn"]:
+                continue
+            result = run(candidate)
+            if "error" not in result and _preferred(key, result, best, new_tokens, tolerance):
+                best = result
+
+    config = {
+        "version": TUNED_VERSION,
+        "model": model_fingerprint(model_path),
+        "host": host_fingerprint(n_gpu_layers),
+        "params": best["params"],
+        "measured": {k: v for k, v in best.items() if k != "params"},
+        "baseline": {k: v for k, v in baseline.items() if k != "params"},
+        "speedup": round(request_seconds(baseline, new_tokens) / request_seconds(best, new_tokens), 2),
+        "settings": {"n_ctx": n_ctx, "decode_tokens": decode_tokens, "new_tokens": new_tokens,
+                     "prompts": len(prompts)},
+        "trials": trials,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seconds": round(time.perf_counter() - begin, 1),
+    }
+    target = Path(out) if out is not None else tuned_config_path(model_path)
+    if target is None:
+        raise ValueError("LLAMA_TUNED_CONFIG is off, pass --out")
+    tmp = target.with_suffix(".tmp")
+    tmp.write_text(json.dumps(config, indent=2, ensure_ascii=False))
+    tmp.replace(target)
+    LOGGER.info(f"Wrote {target}: {best['params']} ({config['speedup']}x over the defaults)")
+    return config
+
+
+def _ints(value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep llama.cpp settings for a GGUF model on this host and "
+                                                 "write a tuned config the servers load at startup")
+    parser.add_argument("model", help="path to the (first shard of the) GGUF model")
+    parser.add_argument("--out", default=None, help=f"target file, default <model>{TUNED_SUFFIX}")
+    parser.add_argument("--prompts", default=None,
+                        help="JSON list of {system_prompt, prompt}, default the warm-up prompts")
+    parser.add_argument("--n-ctx", type=int, default=8192, help="as configured in the server")
+    parser.add_argument("--n-gpu-layers", type=int, default=-1, help="as configured in the server")
+    parser.add_argument("--decode-tokens", type=int, default=64, help="greedy tokens timed per prompt")
+    parser.add_argument("--new-tokens", type=int, default=200, help="typical response length for the objective")
+    parser.add_argument("--tolerance", type=float, default=0.03,
+                        help="within this fraction of the best time the smaller footprint wins")
+    parser.add_argument("--threads", type=_ints, default=None, help="e.g. 8,16,32")
+    parser.add_argument("--batches", type=_ints, default=None, help="e.g. 256,512,1024")
+    parser.add_argument("--kv-types", default=None, help=f"subset of {','.join(KV_TYPES)}")
+    parser.add_argument("--no-mlock", action="store_true", help="do not try use_mlock")
+    parser.add_argument("--max-rss-gib", type=float, default=0.0, help="reject settings above this peak RSS")
+    parser.add_argument("--trial-timeout", type=float, default=1800)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    result = tune(Path(args.model), prompts=None if args.prompts is None else json.loads(Path(args.prompts).read_text()),
+                  n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, decode_tokens=args.decode_tokens,
+                  new_tokens=args.new_tokens, tolerance=args.tolerance, threads=args.threads,
+                  batches=args.batches, kv_types=None if args.kv_types is None else args.kv_types.split(","),
+                  mlock=not args.no_mlock, max_rss_gib=args.max_rss_gib, timeout_s=args.trial_timeout,
+                  out=None if args.out is None else Path(args.out))
+    print(json.dumps({k: v for k, v in result.items() if k != "trials"}, indent=2))
@@ -0,0 +1,5 @@
+# System prompt templates (system_messages.yml), shared by the webinterface and the
+# inference servers. Not re-exported from utils, it needs PyYAML, Jinja2 and FastAPI.
+from .store import TemplateStore, compile_template
+from .registry import SystemPrompt, SystemPromptRegistry
+from .routes import system_prompts_router, with_system_prompt
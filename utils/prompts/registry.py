@@ -0,0 +1,112 @@
+from typing import Callable, Optional, Sequence
+from dataclasses import dataclass, replace
+from pathlib import Path
+import hashlib
+import logging
+import os
+import threading
+
+from .store import TemplateStore
+
+
+@dataclass(frozen=True)
+class SystemPrompt:
+    key: str
+    version: str
+    text: str
+    reasoning: bool = True
+    tokens: Optional[int] = None
+
+
+class SystemPromptRegistry:
+    """
+    System prompts of system_messages.yml, held by the inference server.
+
+    Requests send system_prompt_id instead of the rendered text: "<key>" for the current prompt
+    or "<key>@<version>" for an exact one. The version is a hash of the rendered text and only
+    changes with it. Prompts are rendered (and, with a tokenizer, tokenized) once per file
+    version. The file is reloaded when it changes.
+    """
+
+    def __init__(self, path: Path, tokenize: Optional[Callable[[SystemPrompt], Optional[Sequence[int]]]] = None):
+        self._store = TemplateStore(path)
+        self._tokenize = tokenize
+        self._lock = threading.Lock()
+        self._generation = -1
+        self._prompts: dict[str, SystemPrompt] = {}
+        self._logger = logging.getLogger(__name__)
+
+    @classmethod
+    def from_env(cls) -> Optional["SystemPromptRegistry"]:
+        """ SYSTEM_PROMPTS_PATH (system_messages.yml, reloaded when it changes), None if unset or missing """
+        path = os.getenv("SYSTEM_PROMPTS_PATH")
+        if not path:
+            return None
+        if not Path(path).exists():
+            logging.getLogger(__name__).warning(f"SYSTEM_PROMPTS_PATH {path} does not exist, no system_prompt_id support")
+            return None
+        return cls(Path(path))
+
+    def set_tokenizer(self, tokenize: Callable[[SystemPrompt], Optional[Sequence[int]]]):
+        """ e.g. once the model is loaded, tokenizes all prompts now and again after every reload """
+        with self._lock:
+            self._tokenize = tokenize
+            self._generation = -1
+        self.prompts()
+
+    def _build(self, key: str) -> SystemPrompt:
+        text = self._store.render(key).strip()
+        prompt = SystemPrompt(key=key, version=hashlib.sha1(text.encode("utf-8")).hexdigest()[:12], text=text,
+                              reasoning=bool(self._store.entry(key).get("reasoning", True)))
+        if self._tokenize is not None:
+            tokens = self._tokenize(prompt)
+            prompt = replace(prompt, tokens=None if tokens is None else len(tokens))
+        return prompt
+
+    def prompts(self) -> dict[str, SystemPrompt]:
+        messages = self._store.messages()
+        if self._generation == self._store.generation:
+            return self._prompts
+        with self._lock:
+            generation = self._store.generation
+            if self._generation != generation:
+                self._prompts = {key: self._build(key) for key in messages}
+                self._generation = generation
+                self._logger.info("System prompts: " + ", ".join(f"{p.key}@{p.version}" for p in self._prompts.values()))
+            return self._prompts
+
+    def get(self, prompt_id: str) -> SystemPrompt:
+        key, _, version = prompt_id.partition("@")
+        prompt = self.prompts().get(key)
+        if prompt is None:
+            raise LookupError(f"Unknown system_prompt_id '{key}', available: {list(self.prompts())}")
+        if version and version != prompt.version:
+            raise LookupError(f"System prompt '{key}' is at version {prompt.version}, not {version}")
+        return prompt
+
+    def resolve(self, system_prompt: Optional[str], system_prompt_id: Optional[str]) -> Optional[str]:
+        """ the text to use: a sent system_prompt overrides the referenced one """
+        if system_prompt and system_prompt.strip():
+            return system_prompt
+        if system_prompt_id:
+            return self.get(system_prompt_id).text
+        return system_prompt
+
+    def apply(self, request):
+        """
+        request (a pydantic model) with system_prompt_id replaced by the registered text, a sent
+        system_prompt overrides it. Prompts marked `reasoning: false` also set disable_think on
+        requests that have it. Raises LookupError for unknown ids.
+        """
+        if not request.system_prompt_id:
+            return request
+        prompt = self.get(request.system_prompt_id)
+        text = request.system_prompt if request.system_prompt and request.system_prompt.strip() else prompt.text
+        update = {"system_prompt": text, "system_prompt_id": None}
+        if not prompt.reasoning and "disable_think" in type(request).model_fields:
+            update["disable_think"] = True
+        return request.model_copy(update=update)
+
+    def listing(self) -> list[dict]:
+        return [{"id": f"{p.key}@{p.version}", "key": p.key, "version": p.version, "reasoning": p.reasoning,
+                 "chars": len(p.text), "tokens": p.tokens} for p in self.prompts().values()]
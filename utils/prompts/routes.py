@@ -0,0 +1,28 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException
+
+from .registry import SystemPromptRegistry
+
+
+def with_system_prompt(registry: Optional[SystemPromptRegistry], request):
+    """ SystemPromptRegistry.apply() for a server endpoint, failures as 400 / 404 """
+    if not request.system_prompt_id:
+        return request
+    if registry is None:
+        raise HTTPException(status_code=400, detail="system_prompt_id needs SYSTEM_PROMPTS_PATH on the server")
+    try:
+        return registry.apply(request)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+def system_prompts_router(registry: Optional[SystemPromptRegistry]) -> APIRouter:
+    """ GET /system_prompts: the ids to send as system_prompt_id, "<key>" always means the current version """
+    router = APIRouter()
+
+    @router.get("/system_prompts")
+    def get_system_prompts():
+        return {"system_prompts": [] if registry is None else registry.listing()}
+
+    return router
@@ -0,0 +1,92 @@
+from typing import Optional
+from functools import lru_cache
+from pathlib import Path
+import logging
+import threading
+
+import yaml
+from jinja2 import Template
+
+
+@lru_cache(maxsize=64)
+def compile_template(source: str) -> Template:
+    """ compiled once per source text, overrides edited in the UI included """
+    return Template(source)
+
+
+class TemplateStore:
+    """
+    Parsed system_messages.yml with its templates compiled, reloaded when the file changes.
+
+    Every access stats the file (mtime, size, inode) and re-parses only if that changed, so
+    edits show up without a restart. A file that fails to parse, or that is missing or unreadable
+    for a while (e.g. an editor saving by rename), keeps the previous version.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._unreadable = False
+        self._data: dict = {}
+        self._templates: dict[str, Template] = {}
+        self.generation = 0
+
+    def _keep_previous(self, error: Exception):
+        if self._stamp is None:
+            raise error
+        if not self._unreadable:
+            self._logger.warning(f"Keeping the previous {self.path.name}, the file cannot be read: {error}")
+            self._unreadable = True
+
+    def _refresh(self):
+        try:
+            stat = self.path.stat()
+        except OSError as e:
+            self._keep_previous(e)
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = yaml.safe_load(f) or {}
+            except OSError as e:
+                # gone between stat() and open(), tried again on the next access
+                self._keep_previous(e)
+                return
+            except yaml.YAMLError as e:
+                if self._stamp is None:
+                    raise
+                self._logger.warning(f"Keeping the previous {self.path.name}, the new one does not parse: {e}")
+                self._stamp = stamp
+                return
+            self._data, self._templates, self._stamp = data, {}, stamp
+            self._unreadable = False
+            self.generation += 1
+            self._logger.info(f"Loaded {len(data)} templates from {self.path} (version {self.generation})")
+
+    def messages(self) -> dict:
+        """ the parsed YAML, shared: do not modify """
+        self._refresh()
+        return self._data
+
+    def entry(self, key: str) -> dict:
+        return self.messages().get(key) or {}
+
+    def template(self, key: str) -> Template:
+        entry = self.entry(key)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = compile_template(entry.get("template", ""))
+        return template
+
+    def render(self, key: str, source: Optional[str] = None) -> str:
+        """ renders the template of `key` with its context, `source` replaces the template text """
+        entry = self.entry(key)
+        template = compile_template(source) if source else self.template(key)
+        return template.render(entry.get("context", {}) or {})
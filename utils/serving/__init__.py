@@ -0,0 +1,5 @@
+from .engine import AsyncEngine, request_key
+from .loader import ModelLoader
+from .warmup import WARMUP_PROMPTS, warm_up
+from .replicas import ReplicaPool, replica_count, replica_threads
+from .pool import InstancePool
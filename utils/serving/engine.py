@@ -0,0 +1,213 @@
+from typing import AsyncIterator, Callable, Iterator, Optional
+from queue import Queue
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+
+_END = object()
+_CANCELLED = object()
+
+
+def request_key(model: str, temperature: Optional[float], fields: dict) -> Optional[str]:
+    """
+    Identity of a deterministic (temperature 0) request, None for sampled ones. Identical keys
+    in flight share one generation, and the response cache stores finished ones under it.
+    fields are the request as sent (e.g. model_dump()), temperature the one it resolves to.
+    """
+    if temperature is None or float(temperature) > 0.0:
+        return None
+    payload = json.dumps({**fields, "model": model, "temperature": float(temperature)},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Subscriber:
+    """ one consumer (SSE connection) of a job, fed from the engine thread """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_pending: int):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.max_pending = max_pending
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.gone = threading.Event()
+
+    def push(self, chunk: str) -> bool:
+        """ never blocks the producer, a client max_pending chunks behind is dropped instead """
+        if self.gone.is_set():
+            return False
+        with self.pending_lock:
+            self.pending += 1
+            behind = self.pending
+        if behind > self.max_pending:
+            self.gone.set()
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (
+                RuntimeError(f"Client fell {self.max_pending} chunks behind the generation and was dropped"), False))
+            return False
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (chunk, True))
+        return True
+
+    def delivered(self):
+        with self.pending_lock:
+            self.pending -= 1
+
+    def replay(self, chunk: str):
+        self.queue.put_nowait((chunk, False))
+
+    def finish(self, item):
+        if not self.gone.is_set():
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (item, False))
+
+
+class _Job:
+    def __init__(self, key: Optional[str], factory: Callable[[], Iterator[str]]):
+        self.key = key
+        self.factory = factory
+        self.chunks: list[str] = []
+        self.subscribers: list[_Subscriber] = []
+        self.done = False
+        self.lock = threading.Lock()
+
+
+class AsyncEngine:
+    """
+    Long-lived generation loop for async endpoints.
+
+    A fixed set of worker threads drains the job queue and pushes the chunks of each job into
+    per-request asyncio queues, so waiting or idle connections hold no thread at all. Jobs with
+    the same key that are still running are coalesced: followers attach to the leader's stream
+    and get everything produced so far replayed. A job stops once all its consumers are gone.
+    Workers never wait for a client, one that falls max_pending chunks behind is dropped.
+    """
+
+    def __init__(self, workers: int = 1, max_pending: int = 1024, name: str = "engine"):
+        self._max_pending = max(1, int(max_pending))
+        self._jobs: Queue[_Job] = Queue()
+        self._in_flight: dict[str, _Job] = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+        self._running = 0
+        self._submitted = 0
+        self._coalesced = 0
+        self._cancelled = 0
+
+        self._workers = [
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True) for i in range(max(1, int(workers)))
+        ]
+        for worker in self._workers:
+            worker.start()
+        self._logger.info(f"Generation engine started: workers={len(self._workers)}, max_pending={self._max_pending}")
+
+    async def stream(self, factory: Callable[[], Iterator[str]], key: Optional[str] = None) -> AsyncIterator[str]:
+        """ runs factory() on an engine worker and yields its chunks; identical keys share one run """
+        subscriber = _Subscriber(asyncio.get_running_loop(), self._max_pending)
+
+        with self._lock:
+            job = self._in_flight.get(key) if key is not None else None
+            if job is not None:
+                with job.lock:
+                    if job.done:
+                        job = None
+                    else:
+                        for chunk in job.chunks:
+                            subscriber.replay(chunk)
+                        job.subscribers.append(subscriber)
+                        self._coalesced += 1
+                        self._logger.info(f"Request attached to in-flight generation ({len(job.subscribers)} listeners)")
+
+            if job is None:
+                job = _Job(key, factory)
+                job.subscribers.append(subscriber)
+                if key is not None:
+                    self._in_flight[key] = job
+                self._submitted += 1
+                self._jobs.put(job)
+
+        try:
+            while True:
+                item, counted = await subscriber.queue.get()
+                if counted:
+                    subscriber.delivered()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            subscriber.gone.set()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            with self._lock:
+                self._running += 1
+            try:
+                self._process(job)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    def _listeners(self, job: _Job) -> list[_Subscriber]:
+        with job.lock:
+            return [s for s in job.subscribers if not s.gone.is_set()]
+
+    def _retire(self, job: _Job) -> list[_Subscriber]:
+        """ ends coalescing onto the job, identical requests from now on start a new one """
+        with self._lock:
+            if job.key is not None and self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+            with job.lock:
+                job.done = True
+                return list(job.subscribers)
+
+    def _process(self, job: _Job):
+        chunks = None
+        result = _END
+        try:
+            if not self._listeners(job):
+                # every client left while the job was queued
+                self._cancelled += 1
+                result = _CANCELLED
+                return
+
+            chunks = job.factory()
+            for chunk in chunks:
+                with job.lock:
+                    job.chunks.append(chunk)
+                    listeners = [s for s in job.subscribers if not s.gone.is_set()]
+                if not listeners:
+                    self._logger.info("All listeners left, stopping generation")
+                    self._cancelled += 1
+                    result = _CANCELLED
+                    break
+                for subscriber in listeners:
+                    subscriber.push(chunk)
+
+        except Exception as exc:
+            self._logger.exception("Generation failed")
+            result = exc
+        finally:
+            # retired before close(), which can take a while, so nobody attaches to a job that is ending
+            subscribers = self._retire(job)
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            for subscriber in subscribers:
+                # anyone still listening on a cancelled job attached after its clients left,
+                # the replayed text is incomplete and must not pass for a result
+                subscriber.finish(RuntimeError("Generation was cancelled, retry the request")
+                                  if result is _CANCELLED else result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "running": self._running,
+                "waiting": self._jobs.qsize(),
+                "submitted": self._submitted,
+                "coalesced": self._coalesced,
+                "cancelled": self._cancelled,
+            }
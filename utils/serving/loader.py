@@ -0,0 +1,146 @@
+from typing import Callable, Generic, Optional, TypeVar
+import asyncio
+import logging
+import threading
+import time
+
+T = TypeVar("T")
+
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+
+class ModelLoader(Generic[T]):
+    """
+    Builds the model on a background thread so the server binds its port right away.
+
+    load(progress) returns the model and may call progress(stage, fraction) to report how far
+    it got; warmup(model, progress) runs representative generations before the loader turns
+    ready, so the first real request does not pay for kernel compilation and allocator growth.
+    Requests that arrive in the meantime wait via wait()/get() up to a timeout.
+    """
+
+    def __init__(self, load: Callable[[Callable[[str, float], None]], T],
+                 warmup: Optional[Callable[[T, Callable[[str, float], None]], None]] = None,
+                 name: str = "model"):
+        self._load = load
+        self._warmup = warmup
+        self._name = name
+        self._logger = logging.getLogger(__name__)
+
+        self._model: Optional[T] = None
+        self._error: Optional[BaseException] = None
+        self._ready = threading.Event()
+
+        self._state = LOADING
+        self._stage = "starting"
+        self._progress = 0.0
+        self._started = time.monotonic()
+        self._load_s: Optional[float] = None
+        self._warmup_s: Optional[float] = None
+        self._waiting = 0
+        self._timeouts = 0
+        self._lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, name=f"{name}-loader", daemon=True)
+
+    def start(self) -> "ModelLoader[T]":
+        self._started = time.monotonic()
+        self._thread.start()
+        return self
+
+    def _report(self, stage: str, fraction: float = 0.0):
+        self._stage = stage
+        self._progress = min(max(float(fraction), 0.0), 1.0)
+        self._logger.info(f"{self._name}: {self._state} {stage} ({self._progress:.0%})")
+
+    def _run(self):
+        try:
+            self._report("loading weights")
+            model = self._load(self._report)
+            self._load_s = time.monotonic() - self._started
+
+            if self._warmup is not None:
+                self._state = WARMING
+                self._report("warm-up")
+                begin = time.monotonic()
+                self._warmup(model, self._report)
+                self._warmup_s = time.monotonic() - begin
+
+            self._model = model
+            self._state = READY
+            self._report("ready", 1.0)
+        except BaseException as exc:
+            self._logger.exception(f"{self._name}: loading failed")
+            self._error = exc
+            self._state = FAILED
+        finally:
+            self._ready.set()
+
+    @property
+    def ready(self) -> bool:
+        return self._state == READY
+
+    def _result(self) -> T:
+        if self._error is not None:
+            raise RuntimeError(f"{self._name} failed to load: {self._error}") from self._error
+        return self._model
+
+    def _timed_out(self, timeout: float):
+        with self._lock:
+            self._timeouts += 1
+        raise TimeoutError(f"{self._name} is still {self._state} ({self._stage}) after waiting {timeout:.0f}s")
+
+    def get(self, timeout: Optional[float] = None) -> T:
+        """ blocking: the loaded model, TimeoutError if it is not ready in time, RuntimeError if loading failed """
+        if not self._ready.is_set():
+            with self._lock:
+                self._waiting += 1
+            try:
+                if not self._ready.wait(timeout):
+                    self._timed_out(timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+        return self._result()
+
+    async def wait(self, timeout: Optional[float] = None) -> T:
+        """ async variant of get(), polls so waiting requests hold no thread """
+        if not self._ready.is_set():
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with self._lock:
+                self._waiting += 1
+            try:
+                while not self._ready.is_set():
+                    if deadline is not None and time.monotonic() >= deadline:
+                        self._timed_out(timeout)
+                    await asyncio.sleep(0.25)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+        return self._result()
+
+    @property
+    def model(self) -> Optional[T]:
+        """ the model once ready, None before """
+        return self._model
+
+    def status(self) -> dict:
+        status = {
+            "status": self._state,
+            "stage": self._stage,
+            "progress": round(self._progress, 3),
+            "waiting_requests": self._waiting,
+            "timed_out_requests": self._timeouts,
+        }
+        if self._state in (LOADING, WARMING):
+            status["elapsed_s"] = round(time.monotonic() - self._started, 1)
+        if self._load_s is not None:
+            status["load_s"] = round(self._load_s, 1)
+        if self._warmup_s is not None:
+            status["warmup_s"] = round(self._warmup_s, 1)
+        if self._error is not None:
+            status["error"] = str(self._error)
+        return status
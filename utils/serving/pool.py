@@ -0,0 +1,69 @@
+from typing import Callable, Generic, Iterator, TypeVar
+from contextlib import contextmanager
+from queue import Queue
+import logging
+import threading
+import time
+
+T = TypeVar("T")
+
+
+class InstancePool(Generic[T]):
+    """
+    Fixed set of interchangeable instances (e.g. llama.cpp contexts over one mapped model).
+
+    acquire() hands out a free instance and blocks while all of them are busy, the time spent
+    waiting is tracked so queueing shows up in /health instead of only as slow responses.
+    """
+
+    def __init__(self, factory: Callable[[int], T], size: int = 1, name: str = "pool"):
+        self._name = name
+        self._logger = logging.getLogger(__name__)
+        self.instances = [factory(i) for i in range(max(1, int(size)))]
+        self._free: Queue[T] = Queue()
+        for instance in self.instances:
+            self._free.put(instance)
+
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._acquired = 0
+        self._queued = 0
+        self._wait_s = 0.0
+        self._max_wait_s = 0.0
+
+    @contextmanager
+    def acquire(self) -> Iterator[T]:
+        begin = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+        try:
+            instance = self._free.get()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        waited = time.perf_counter() - begin
+
+        with self._lock:
+            self._acquired += 1
+            self._wait_s += waited
+            self._max_wait_s = max(self._max_wait_s, waited)
+            if waited > 0.01:
+                self._queued += 1
+        if waited > 0.01:
+            self._logger.info(f"{self._name}: waited {waited:.2f}s for a free instance")
+        try:
+            yield instance
+        finally:
+            self._free.put(instance)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self.instances),
+                "busy": len(self.instances) - self._free.qsize(),
+                "waiting_requests": self._waiting,
+                "acquired": self._acquired,
+                "queued": self._queued,
+                "avg_wait_s": round(self._wait_s / self._acquired, 3) if self._acquired else None,
+                "max_wait_s": round(self._max_wait_s, 3),
+            }
@@ -0,0 +1,276 @@
+from typing import Callable, Iterator, Optional
+from multiprocessing.connection import Connection, wait
+from pathlib import Path
+from queue import Queue, Empty
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from .loader import ModelLoader
+
+_REPLICA: Optional[int] = None
+
+
+def replica_count() -> int:
+    """ CPU_REPLICAS, 1 (default) serves from the server process itself """
+    return max(1, int(os.getenv("CPU_REPLICAS", "1")))
+
+
+def current_replica() -> Optional[int]:
+    """ index of the replica this process serves, None in the server process """
+    return _REPLICA
+
+
+def replica_threads() -> Optional[int]:
+    """ cores this replica is pinned to, for libraries that size their thread pool themselves """
+    return len(os.sched_getaffinity(0)) if _REPLICA is not None else None
+
+
+def numa_nodes() -> list[list[int]]:
+    """ usable cores grouped by NUMA node, one group if the topology is unknown """
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for cpulist in sorted(Path("/sys/devices/system/node").glob("node*/cpulist")):
+        cores = set()
+        for part in cpulist.read_text().strip().split(","):
+            if part:
+                first, _, last = part.partition("-")
+                cores.update(range(int(first), int(last or first) + 1))
+        if cores & allowed:
+            nodes.append(sorted(cores & allowed))
+    return nodes or [sorted(allowed)]
+
+
+def cpu_sets(replicas: int) -> list[list[int]]:
+    """
+    Splits the usable cores into one set per replica. Replicas go round-robin over the NUMA
+    nodes and never span two of them, so activations and KV cache stay node-local.
+    """
+    nodes = numa_nodes()
+    members = [list(range(i, replicas, len(nodes))) for i in range(len(nodes))]
+    sets: list[list[int]] = [[] for _ in range(replicas)]
+    for cores, indices in zip(nodes, members):
+        if not indices:
+            continue
+        size = max(1, len(cores) // len(indices))
+        for j, index in enumerate(indices):
+            # more replicas than cores: they share the node
+            sets[index] = cores[j * size:(j + 1) * size] or cores
+    return sets
+
+
+def _serve(index: int, cores: list[int], load: Callable, warmup: Optional[Callable], conn: Connection):
+    """ replica process: pin, load, warm up, then run one job at a time from the dispatcher """
+    global _REPLICA
+    _REPLICA = index
+    os.sched_setaffinity(0, cores)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(len(cores))
+
+    def progress(stage: str, fraction: float = 0.0):
+        conn.send(("progress", stage, fraction))
+
+    try:
+        model = load(progress)
+        if warmup is not None:
+            progress("warm-up", 0.9)
+            warmup(model, progress)
+    except BaseException as exc:
+        conn.send(("failed", f"{type(exc).__name__}: {exc}"))
+        return
+    conn.send(("ready",))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if message is None:
+            return
+        if message == "cancel":
+            # arrived after the job had finished already
+            continue
+
+        method, args, kwargs = message
+        chunks = None
+        try:
+            result = getattr(model, method)(*args, **kwargs)
+            chunks = iter([result] if isinstance(result, str) else result)
+            for chunk in chunks:
+                if conn.poll() and conn.recv() == "cancel":
+                    break
+                conn.send(("token", chunk))
+            conn.send(("done",))
+        except Exception as exc:
+            conn.send(("error", f"{type(exc).__name__}: {exc}"))
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+
+class ReplicaPool:
+    """
+    Serves one model from several pinned CPU processes behind a single dispatcher.
+
+    start() forks the replicas right away (call it at import time, before the server starts any
+    thread), each one pins itself to its core set, builds the model with load(progress) and warms
+    it up. Weights are shared instead of copied: llama.cpp maps the GGUF and the HF loader maps
+    the safetensors shards (MODEL_LOAD_MMAP), so all replicas read the same page cache.
+
+    The pool stands in for the model: stream()/invoke() send the call to an idle replica and
+    relay its chunks, requests queue while all replicas are busy.
+    """
+
+    def __init__(self, load: Callable, warmup: Optional[Callable] = None, name: str = "model",
+                 replicas: int = 2):
+        self._load = load
+        self._warmup = warmup
+        self._name = name
+        self._replicas = max(1, int(replicas))
+        self._logger = logging.getLogger(__name__)
+
+        self._conns: list[Connection] = []
+        self._processes: list[multiprocessing.Process] = []
+        self._cores: list[list[int]] = []
+        self._idle: Queue[int] = Queue()
+        self._dead: set[int] = set()
+        self._jobs = [0] * self._replicas
+        self._busy_s = [0.0] * self._replicas
+        self._wait_s = 0.0
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> ModelLoader["ReplicaPool"]:
+        """ forks the replicas and returns a started loader that turns ready with all of them """
+        context = multiprocessing.get_context("fork")
+        self._cores = cpu_sets(self._replicas)
+        for index, cores in enumerate(self._cores):
+            parent, child = context.Pipe()
+            process = context.Process(target=_serve, args=(index, cores, self._load, self._warmup, child),
+                                      name=f"{self._name}-replica-{index}", daemon=True)
+            process.start()
+            child.close()
+            self._conns.append(parent)
+            self._processes.append(process)
+            self._logger.info(f"{self._name}: replica {index} (pid {process.pid}) on cores {cores}")
+        return ModelLoader(self._await_replicas, name=self._name).start()
+
+    def _await_replicas(self, progress: Callable[[str, float], None]) -> "ReplicaPool":
+        pending = dict(enumerate(self._conns))
+        stages: dict[int, float] = {index: 0.0 for index in pending}
+        while pending:
+            for conn in wait(list(pending.values())):
+                index = self._conns.index(conn)
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    message = ("failed", f"exited with code {self._processes[index].exitcode}")
+                if message[0] == "progress":
+                    stages[index] = message[2]
+                    progress(f"replica {index}: {message[1]}", sum(stages.values()) / len(stages))
+                elif message[0] == "ready":
+                    stages[index] = 1.0
+                    self._idle.put(index)
+                    del pending[index]
+                elif message[0] == "failed":
+                    self._logger.error(f"{self._name}: replica {index} failed: {message[1]}")
+                    self._dead.add(index)
+                    del pending[index]
+        if len(self._dead) == self._replicas:
+            raise RuntimeError(f"all {self._replicas} replicas failed to load")
+        return self
+
+    def _acquire(self) -> int:
+        begin = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                try:
+                    index = self._idle.get(timeout=1.0)
+                except Empty:
+                    if len(self._dead) == self._replicas:
+                        raise RuntimeError(f"{self._name}: no replica left")
+                    continue
+                if self._processes[index].is_alive():
+                    return index
+                self._retire(index)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                self._wait_s += time.perf_counter() - begin
+
+    def _retire(self, index: int):
+        self._logger.error(f"{self._name}: replica {index} exited with code {self._processes[index].exitcode}")
+        with self._lock:
+            self._dead.add(index)
+
+    def _call(self, method: str, args: tuple, kwargs: dict) -> Iterator[str]:
+        index = self._acquire()
+        conn = self._conns[index]
+        begin = time.perf_counter()
+        finished = False
+        try:
+            conn.send((method, args, kwargs))
+            while True:
+                message = conn.recv()
+                if message[0] == "token":
+                    yield message[1]
+                    continue
+                finished = True
+                if message[0] == "error":
+                    raise RuntimeError(message[1])
+                return
+        except EOFError:
+            finished = True
+            self._retire(index)
+            raise RuntimeError(f"{self._name}: replica {index} died during the request")
+        finally:
+            if not finished:
+                # consumer left early: stop the replica and drain until it acknowledges
+                try:
+                    conn.send("cancel")
+                    while conn.recv()[0] == "token":
+                        pass
+                except (EOFError, OSError):
+                    self._retire(index)
+            with self._lock:
+                self._jobs[index] += 1
+                self._busy_s[index] += time.perf_counter() - begin
+            if index not in self._dead:
+                self._idle.put(index)
+
+    def stream(self, *args, **kwargs) -> Iterator[str]:
+        yield from self._call("stream", args, kwargs)
+
+    def invoke(self, *args, **kwargs) -> str:
+        return "".join(self._call("invoke", args, kwargs))
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = sum(self._jobs)
+            return {
+                "replicas": self._replicas,
+                "alive": self._replicas - len(self._dead),
+                "idle": self._idle.qsize(),
+                "waiting_requests": self._waiting,
+                "jobs": jobs,
+                "avg_queue_wait_s": round(self._wait_s / jobs, 3) if jobs else None,
+                "per_replica": [
+                    {"cores": cores, "jobs": self._jobs[i],
+                     "busy_s": round(self._busy_s[i], 1), "alive": i not in self._dead}
+                    for i, cores in enumerate(self._cores)
+                ],
+            }
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
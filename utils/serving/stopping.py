@@ -0,0 +1,66 @@
+from typing import Iterable, Iterator, Optional
+
+
+class StopSequenceFilter:
+    """
+    Cuts streamed text at the first stop string.
+
+    Text that could be the beginning of a stop string is held back until it is decided,
+    so a stop string is never emitted partially.
+    """
+
+    def __init__(self, stop: Iterable[str]):
+        self._stop = [s for s in stop if s]
+        self._buffer = ""
+        self._stopped = False
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    def feed(self, text: str) -> str:
+        """ returns the part of the text that is safe to emit """
+        if self._stopped:
+            return ""
+        self._buffer += text
+
+        cut = min((i for i in (self._buffer.find(s) for s in self._stop) if i >= 0), default=-1)
+        if cut >= 0:
+            self._stopped = True
+            out, self._buffer = self._buffer[:cut], ""
+            return out
+
+        hold = 0
+        for s in self._stop:
+            for n in range(min(len(s) - 1, len(self._buffer)), hold, -1):
+                if self._buffer.endswith(s[:n]):
+                    hold = n
+                    break
+
+        out = self._buffer[:len(self._buffer) - hold]
+        self._buffer = self._buffer[len(out):]
+        return out
+
+    def flush(self) -> str:
+        out, self._buffer = ("" if self._stopped else self._buffer), ""
+        return out
+
+
+def stop_at(chunks: Iterable[str], stop: Optional[Iterable[str]]) -> Iterator[str]:
+    """ passes text chunks through up to (excluding) the first stop string """
+    stop = [s for s in (stop or []) if s]
+    if not stop:
+        yield from chunks
+        return
+
+    stop_filter = StopSequenceFilter(stop)
+    for chunk in chunks:
+        text = stop_filter.feed(chunk)
+        if text:
+            yield text
+        if stop_filter.stopped:
+            return
+
+    text = stop_filter.flush()
+    if text:
+        yield text
@@ -0,0 +1,61 @@
+from typing import Callable, Iterable, Optional, Union
+import logging
+import os
+import time
+
+# Shaped like the reports of the web interface: long German system prompt, short clinical notes.
+# Covers a sampled report (server temperature) and a greedy correction (prompt lookup path,
+# which only runs at temperature 0).
+WARMUP_PROMPTS = [
+    {
+        "system_prompt": (
+            "Du bist ein präziser, detailorientierter medizinischer Schreibassistent. "
+            "Erstelle einen vollständigen, zusammenhängenden Austrittsbericht auf Basis der Informationen. "
+            "Jeder Abschnitt soll nur einmal vorkommen."
+        ),
+        "prompt": (
+            "Patient: Max Mustermann, Geburtsdatum 01.01.1980. Aufnahmegrund: Sturz mit Oberschenkelhalsfraktur. "
+            "Diagnose: Fraktur des rechten Oberschenkelhalses. Verlauf: operativ versorgt und mobilisiert. "
+            "Medikation: Ibuprofen 600mg, Marcumar. Empfehlung: Kontrolle beim Hausarzt in 7 Tagen."
+        ),
+        "prompt_lookup": False,
+    },
+    {
+        "system_prompt": (
+            "Korrigiere den folgenden Text ausschließlich hinsichtlich Rechtschreibung, Grammatik und Zeichensetzung. "
+            "Behalte jede Zeile und die Reihenfolge exakt bei. Kommentiere nichts, erkläre nichts."
+        ),
+        "prompt": "Die Patientin klagt über seit 3 Tagen bestehenden Schmerzen. Sie wurde von der Arzt untersucht.",
+        "temperature": 0.0,
+        "prompt_lookup": True,
+    },
+]
+
+
+def warmup_max_tokens() -> int:
+    """ WARMUP_MAX_TOKENS, 0 disables the warm-up """
+    return max(0, int(os.getenv("WARMUP_MAX_TOKENS", "32")))
+
+
+def warm_up(generate: Callable[[dict, int], Union[str, Iterable[str]]],
+            progress: Optional[Callable[[str, float], None]] = None,
+            prompts: Optional[list] = None) -> int:
+    """
+    Runs generate(sample, max_tokens) for every warm-up prompt and drains the result,
+    streaming backends return an iterator. Returns the number of prompts that ran.
+    """
+    logger = logging.getLogger(__name__)
+    max_tokens = warmup_max_tokens()
+    prompts = WARMUP_PROMPTS if prompts is None else prompts
+    if max_tokens == 0:
+        return 0
+
+    for i, sample in enumerate(prompts):
+        if progress is not None:
+            progress(f"warm-up {i + 1}/{len(prompts)}", i / len(prompts))
+        begin = time.perf_counter()
+        result = generate(sample, max_tokens)
+        if not isinstance(result, str):
+            result = "".join(result)
+        logger.info(f"Warm-up {i + 1}/{len(prompts)}: {len(result)} chars in {time.perf_counter() - begin:.2f}s")
+    return len(prompts)
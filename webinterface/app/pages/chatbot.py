@@ -6,6 +6,7 @@ import html
 from system_messages_helper import render_system_message as render_sysmsg
 
 API_BASE_URL = os.getenv("API_BASE_URL", "http://inference:8100")
+MODEL_NAME = os.getenv("STREAMLIT_MODEL_SELECT", "Mistral7B")
 session = requests.Session()
 session.trust_env = False
 
@@ -63,10 +64,13 @@ if user_msg and user_msg.strip():
         render_chat()
 
     # Systemprompt laden + API aufrufen
-    system_prompt = render_sysmsg("Chatbot")
+    # serverseitig gerendert, wenn SYSTEM_PROMPTS_SERVER_SIDE gesetzt ist
+    server_side = os.getenv("SYSTEM_PROMPTS_SERVER_SIDE", "false").lower() == "true"
     payload = {
+        "model": MODEL_NAME,
         "prompt": user_msg.strip(),
-        "system_prompt": system_prompt,
+        "system_prompt": None if server_side else render_sysmsg("Chatbot"),
+        "system_prompt_id": "Chatbot" if server_side else None,
         "temperature": st.session_state.get("temperature", 0.8),
         "top_p": st.session_state.get("top_p", 0.9),
         "max_tokens": 300,
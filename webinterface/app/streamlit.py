@@ -7,7 +7,7 @@ import docker
 
 from utils import setup_logging
 from systemmessage_dialog import render_systemmessage_dialog
-from system_messages_helper import load_messages, render_system_message as render_sysmsg
+from system_messages_helper import load_messages, requires_reasoning, render_system_message as render_sysmsg
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -50,6 +50,16 @@ LLM_MODELS = {
     }
 }
 
+# Multi-Model-Host (DOCKER_INFERENCE=multi): ein Endpoint, das Feld 'model' wählt das Backend
+MULTI_MODEL = os.getenv("DOCKER_INFERENCE", "") == "multi"
+if MULTI_MODEL:
+    for cfg in LLM_MODELS.values():
+        cfg['api_url'] = f'{API_BASE_URL}/generate_stream'
+
+# Systemprompt serverseitig: nur der Schlüssel aus system_messages.yml geht mit (system_prompt_id),
+# der Inferenz-Server hält die gerenderten Prompts selbst (SYSTEM_PROMPTS_PATH)
+SYSTEM_PROMPTS_SERVER_SIDE = os.getenv("SYSTEM_PROMPTS_SERVER_SIDE", "false").lower() == "true"
+
 # === Logging Setup ===
 LOGGER = setup_logging(app_name='streamlit-web', retention=30, to_stdout=True)
 
@@ -58,7 +68,7 @@ def fetch_llm_defaults() -> dict:
     api_url = LLM_MODELS[MODEL_NAME]['api_url']
     base = api_url.rsplit("/", 1)[0]
     try:
-        r = session.get(f"{base}/config", timeout=10)
+        r = session.get(f"{base}/config", params={"model": MODEL_NAME}, timeout=10)
         r.raise_for_status()
         data = r.json()
         return data.get("defaults", {})
@@ -284,6 +294,8 @@ class Webber:
         override = st.session_state.get('sysmsg_overrides', {}).get(active_key)
         if override and override.strip():
             system_message = override.strip()
+        elif SYSTEM_PROMPTS_SERVER_SIDE:
+            system_message = None
         else:
             system_message = self.render_system_message(active_key)
 
@@ -291,18 +303,29 @@ class Webber:
         temperature = st.session_state.get('temperature', 0.8)
         top_p = st.session_state.get('top_p', 0.9)
 
-        # Override für Korrigieren
-        if active_key == "Korrigieren":
+        # Override für Korrigieren (Ausgabe ist grösstenteils eine Kopie der Eingabe -> Prompt-Lookup)
+        prompt_lookup = active_key == "Korrigieren"
+        if prompt_lookup:
             temperature = 0.0
             top_p = 1.0
 
+        # Berichtstypen ohne Reasoning laufen immer ohne Thinking (Qwen3: Nicht-Thinking-Modell)
+        disable_think = bool(st.session_state.get("disable_think_ui", False))
+        try:
+            disable_think = disable_think or not requires_reasoning(active_key)
+        except Exception as e:
+            LOGGER.warning(f"Reasoning-Flag konnte nicht gelesen werden: {e}")
+
         payload = {
+            'model': MODEL_NAME,
             'prompt': text.strip(),
             'system_prompt': system_message,
+            'system_prompt_id': active_key if system_message is None else None,
             'temperature': temperature,
             'top_p': top_p,
             'max_tokens': st.session_state.get('max_tokens', 200),
-            'disable_think': bool(st.session_state.get("disable_think_ui", False))
+            'disable_think': disable_think,
+            'prompt_lookup': prompt_lookup
         }
 
         # 1) Live anzeigen mit write_stream (Markdown), **ein** Platzhalter
@@ -1,8 +1,16 @@
 # webinterface/app/system_messages_helper.py
+from functools import lru_cache
 from pathlib import Path
-from jinja2 import Template
-import yaml
+import threading
 
+from utils.prompts import TemplateStore
+
+# ein Store pro Datei für den ganzen Prozess, also für alle Streamlit-Sessions:
+# YAML geparst und Templates kompiliert im Speicher, neu geladen nur wenn sich die Datei ändert
+_STORES: dict[Path, TemplateStore] = {}
+_STORES_LOCK = threading.Lock()
+
+@lru_cache(maxsize=8)
 def _find_yaml(yaml_path: str | None = None) -> Path:
     if yaml_path:
         return Path(yaml_path).resolve()
@@ -18,14 +26,22 @@ def _find_yaml(yaml_path: str | None = None) -> Path:
     raise FileNotFoundError("system_messages.yml nicht gefunden (getestete Pfade: {})"
                             .format([str(c) for c in candidates]))
 
-def load_messages(yaml_path: str | None = None) -> dict:
+def _store(yaml_path: str | None = None) -> TemplateStore:
     path = _find_yaml(yaml_path)
-    with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f) or {}
+    store = _STORES.get(path)
+    if store is None:
+        with _STORES_LOCK:
+            store = _STORES.setdefault(path, TemplateStore(path))
+    return store
+
+def load_messages(yaml_path: str | None = None) -> dict:
+    """Geparste YAML aus dem Cache, wird von allen Sessions geteilt und darf nicht verändert werden."""
+    return _store(yaml_path).messages()
 
 def render_system_message(key: str, overrides: dict | None = None, yaml_path: str | None = None) -> str:
-    data = load_messages(yaml_path)
-    entry = data.get(key) or {}
-    template_str = (overrides or {}).get(key) or entry.get("template", "")
-    context = entry.get("context", {}) or {}
-    return Template(template_str).render(context)
+    return _store(yaml_path).render(key, (overrides or {}).get(key))
+
+def requires_reasoning(key: str, yaml_path: str | None = None) -> bool:
+    """Berichtstypen mit `reasoning: false` werden ohne Thinking generiert."""
+    entry = _store(yaml_path).entry(key)
+    return bool(entry.get("reasoning", True))